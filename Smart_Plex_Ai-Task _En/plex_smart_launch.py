@@ -1,16 +1,29 @@
+import os
+import re
 import json
+import pickle
+import tempfile
 import aiohttp
+import asyncio
 import random
+import time
+import heapq
+import hashlib
 import xml.etree.ElementTree as ET
-from difflib import SequenceMatcher
+from urllib.parse import urlparse
+from array import array
+from bisect import insort
+from collections import Counter
+from difflib import SequenceMatcher, get_close_matches
 
 # =================================================================================
 # SCRIPT: plex_smart_launch
-# VERSION: v5.4
+# VERSION: v5.28
 # CHANGES:
-#   - FIX: Client scanning is now done in a loop.
-#          The script waits up to 30 seconds for the player to appear, 
-#          pressing Scan every 3 seconds.
+#   - PERF: Live library updates. The script follows the Plex server's notification websocket:
+#           added, changed and deleted items reach the cache within seconds through a delta
+#           refresh. The hourly poll only runs while the stream is down, and the stream reconnects
+#           with growing pauses. Status in sensor.smartplex_notifications (LIVE_UPDATES = False to turn off).
 # =================================================================================
 
 # === 1. SETTINGS === Replace with your own values
@@ -19,27 +32,97 @@ PLEX_TOKEN = "XyZ987PvQgRtLmNoKjHs"                # Insert your Plex Token
 PLEX_SCAN_BUTTON = "button.plex_190_scan_clients"  # Scan Clients Button (Find in HA Plex Integration)
 VERIFY_SSL = False 
 AI_ENTITY_ID = "ai_task.google_ai_task"            # Specify your Ai Task entity
+AI_COMPACT_PROMPT = True                           # Short prompt + JSON schema (fewer tokens, faster). False = full prompt in section 5
+DIRECT_PLAY = True                                 # Start found items through the Plex server (zones with plex_client_id). False = always play_media
+TRACE_LOG = False                                  # True = log the timings of every command and cache refresh as JSON
+TRACE_HISTORY = 10                                 # Commands kept in the sensor.smartplex_last_command attributes
+LIVE_UPDATES = True                                # Follow library changes through Plex server notifications. False = hourly refresh only
 
 # Cache (No editing/configuration needed)
-PLEX_LIBS = {} 
-PLEX_CACHE = {"movie": [], "show": [], "music": []}
+PLEX_LIBS = {}                                       # type -> [{"id", "title"}] of every section of that type
+PLEX_CACHE = {}                                      # type -> section id -> columns, see new_columns() (read items with cache_item)
+PLEX_INDEX = {}                                      # type -> section id -> trigram search index, artist -> positions for the music tiers
+FACET_TAGS = {"Genre": "genre", "Role": "actor",     # Movie tags indexed as filters -> query field
+              "Director": "director", "Collection": "collection", "Country": "country"}
+FACET_ATTRS = ["studio", "contentRating"]            # Movie attributes indexed as filters
+FACET_PARTIAL = ["actor", "director"]                # Filters the section listing only has in part (top-billed cast): one local match is not all of them
+FACET_MIN_SCORE = 0.8                                # How close a misspelled filter value must be to a known one
+MUSIC_TIERS = ["album", "track"]                     # Music levels cached below the artists ([] = artists only)
+TIER_TYPES = {"album": 9, "track": 10}               # Plex type numbers of the music tiers
+INDEX_CANDIDATES = 64                                # How many index candidates get full scoring
+INDEX_TRUST_SCORE = 0.8                              # Index candidates scoring below this get checked by a full scan
+SERVER_SEARCH_TIMEOUT = 1.5                          # How long (sec) the Plex server's search may take when the cache is not sure (0 = cache only)
+SERVER_SEARCH_LIMIT = 10                             # Server search results per type
+PLEX_SYNC = {}                                       # section id -> newest updatedAt / lastViewedAt and the items read at that time, last deletion check
+RECONCILE_INTERVAL = 24 * 3600                       # How often (sec) to check sections for deleted items
+PAGE_SIZE = 500                                      # Items per request when reading a library section
+CHUNK_SIZE = 64 * 1024                               # Bytes fed to the XML parser at a time
+FETCH_CONCURRENCY = 3                                # Library sections downloaded in parallel
+PLEX_SESSION = None                                  # Shared HTTP session to the Plex server
+PLEX_MACHINE_ID = None                               # Server machineIdentifier for direct play, read once from /identity
+PLEX_COMMAND_ID = 0                                  # commandID of the last player command sent to a client
+SNAPSHOT_PATH = "/config/smartplex_cache.pickle"     # Cache copy on disk for instant startup
+SNAPSHOT_VERSION = 5                                 # Bump when the cache layout changes
+SNAPSHOT_SAVES = {}                                  # path -> newest data waiting for the running save_snapshot
+PLEX_REFRESH = None                                  # Running cache refresh, shared by all callers
+PLEX_WARMUP = None                                   # Running snapshot load / first download
+SCAN_TIMEOUT = 30                                    # How long (sec) to wait for the Plex client to appear
+SCAN_FIRST_GAP = 1                                   # Pause after the first Scan press, doubled after each press
+SCAN_MAX_GAP = 8                                     # Longest pause between Scan presses
+ZONE_TIMINGS = None                                  # zone -> {"boot": [sec...], "app": [sec...]}, measured
+TIMINGS_PATH = "/config/smartplex_timings.pickle"    # Measured timings on disk
+TIMING_SAMPLES = 20                                  # Measurements kept per zone and stage
+TIMING_MIN_SAMPLES = 3                               # Below this the config delays are used
+TIMING_PERCENTILE = 0.9                              # Wait bound = this percentile of the measurements...
+TIMING_MARGIN = 1.25                                 # ...times this safety margin
+TRACE_COMMANDS = []                                  # Timings of the last TRACE_HISTORY commands
+EPISODE_INDEX = {}                                   # show id -> its episodes, loaded on first use (load_episode_index)
+EPISODE_TTL = 6 * 3600                               # How long (sec) a loaded episode list is trusted
+INTENT_CACHE = None                                  # Remembered AI answers and hit/miss counters, loaded from INTENT_PATH
+INTENT_PATH = "/config/smartplex_intents.pickle"     # Remembered AI answers on disk
+INTENT_CACHE_SIZE = 200                              # Commands remembered, least recently used are dropped (0 = always ask the AI)
+INTENT_TTL = 7 * 24 * 3600                           # How long (sec) a remembered answer is reused
+COMMAND_SEQ = 0                                      # Commands numbered in arrival order
+ZONE_COMMANDS = {}                                   # room -> latest command {"seq", "task"}
+ZONE_BOOTS = {}                                      # room -> latest boot {"task", "users", "was_off"}
+COMMAND_BUDGET = 90                                  # Longest time (sec) a command may take from start to play
+STAGE_DEADLINES = {"cache": 5, "ai": 20,             # Longest time (sec) of each stage, cut to what is left of the budget
+                   "match": 5, "hardware": 60, "play": 15}
+DIRECT_PLAY_SHARE = 0.5                              # Part of the play deadline direct play may use, play_media gets the rest
+PLEX_CONNECT_TIMEOUT = 5                             # Plex HTTP: connection timeout (sec)...
+PLEX_READ_TIMEOUT = 20                               # ...and longest silence (sec) while reading an answer
+BREAKERS = {}                                        # "plex" / "ai" -> circuit breaker state, see breaker_allows()
+BREAKER_THRESHOLD = 3                                # Failures in a row that open a breaker
+BREAKER_COOLDOWN = 60                                # How long (sec) an open breaker skips the dependency before trying again
+NOTIFY_STATE = {"connected": False, "since": None,   # Notification stream status, shown in sensor.smartplex_notifications
+                "connects": 0, "changes": 0, "refreshes": 0}
+NOTIFY_PENDING = None                                # Library changes announced but not applied yet, see read_timeline()
+NOTIFY_APPLY = None                                  # Running apply_notifications
+NOTIFY_TYPES = [1, 2, 4, 8, 9, 10]                   # Plex types that change the cache: movie, show, episode, artist, album, track
+NOTIFY_DEBOUNCE = 2                                  # Changes are collected this long (sec) before one delta refresh
+NOTIFY_HEARTBEAT = 30                                # Ping (sec) that detects a dead notification connection
+NOTIFY_BACKOFF_MIN = 1                               # First pause (sec) before reconnecting, doubled after each failure...
+NOTIFY_BACKOFF_MAX = 300                             # ...up to this
 
 # === 2. ZONES === Specify your entity IDs and Zone names (living_room, guest_room, bedroom)
 ZONES = {
     "living_room": {
         "plex_client": "media_player.plex_plex_for_apple_tv_apple_tv", 
         "plex_device_id": "2d3845xxxxxxxxxxxxxxxxxxxx7ac3299ae", 
+        "plex_client_id": "",                # Optional, for DIRECT_PLAY: clientIdentifier of the Plex app (plex.tv/devices.xml)
         "hardware_device_id": "84971xxxxxxxxxxxxx999e9edd1f3d6a", 
         "hardware_entity": "media_player.apple_tv_4k", 
         "power_method": "apple_tv_device",   # Do not edit or replace in code below
-        "boot_delay": 2, "app_load_delay": 6 # Time required to start TV and Plex App
+        "boot_delay": 2, "app_load_delay": 6, # Max time to start TV and Plex App, until real timings are learned
+        "aliases": ["living room", "hall", "main room"]  # How the room is called in commands (lowercase)
     },
     "guest_room": {
         "plex_client": "media_player.plex_plex_for_lg_lg_oled42c2rlb",
         "hardware_device_id": "d025f3xxxxxxxxxxda8128644844", 
         "hardware_entity": "media_player.lg_webos_tv_oled42c2rlb",
         "power_method": "lg_device",          # Do not edit or replace in code below
-        "boot_delay": 6, "app_load_delay": 12      
+        "boot_delay": 6, "app_load_delay": 12,
+        "aliases": ["guest room", "kids room", "small room"]
     },
     "bedroom": {
         "plex_client": "media_player.plex_plex_for_samsung_tv_2019",
@@ -47,62 +130,806 @@ ZONES = {
         "remote_entity": "remote.samsung_the_frame_49_qe49ls03rauxru",
         "hardware_entity": "media_player.samsung_the_frame_49_qe49ls03rauxru", 
         "power_method": "samsung_remote",     # Do not edit or replace in code below
-        "boot_delay": 6, "app_load_delay": 15
+        "boot_delay": 6, "app_load_delay": 15,
+        "aliases": ["bedroom", "bed"]
     }
 }
+
+# === LOCAL PARSER === Simple commands ("play Inception in the bedroom") are parsed without the AI
+LOCAL_PARSER = True                # False = always ask the AI
+LOCAL_PARSER_MIN_SCORE = 0.9       # How sure the title match must be to skip the AI
+LOCAL_PARSER_FALLBACK_SCORE = 0.7  # Same, while the AI is unavailable (timeouts, errors)
+SPECULATIVE_BOOT = True            # Turn on the TV of the room named in the command before the AI answers
+PARSER_WORDS = {                   # Lowercase
+    "start": ["play", "watch", "start", "turn on", "put on", "launch"],
+    "resume": ["resume", "continue", "finish", "keep watching"],
+    "shuffle": ["shuffle", "mix", "shuffled"],
+    "movie": ["movie", "film", "the movie", "the film"],
+    "show": ["show", "series", "tv show", "the show", "the series"],
+    "music": ["music", "songs", "music by", "songs by"],
+    "room_prefix": ["in the", "in", "on the", "on", "at"]
+}
 # ======== End of Settings, Only the Prompt can be edited below ========
 
 
 # === 3. AUTO-DISCOVERY OF LIBRARIES & CACHE ===
-async def update_plex_cache():
-    global PLEX_CACHE, PLEX_LIBS
-    conn = aiohttp.TCPConnector(ssl=VERIFY_SSL)
-    async with aiohttp.ClientSession(connector=conn) as session:
+async def update_plex_cache(full=False):
+    # Single flight: callers that arrive while a refresh is running wait for that refresh
+    global PLEX_REFRESH
+    if PLEX_REFRESH is None or PLEX_REFRESH.done():
+        PLEX_REFRESH = task.create(build_plex_cache, full)
+    await asyncio.shield(PLEX_REFRESH)
+
+async def ensure_plex_cache():
+    # Empty cache after a reload: snapshot if there is one, otherwise wait for the download
+    global PLEX_WARMUP
+    if PLEX_LIBS: return
+    if PLEX_WARMUP is None or PLEX_WARMUP.done():
+        PLEX_WARMUP = task.create(warm_plex_cache)
+    await asyncio.shield(PLEX_WARMUP)
+
+async def warm_plex_cache():
+    if not await load_cache_snapshot(): await update_plex_cache()
+
+async def build_plex_cache(full):
+    global PLEX_CACHE, PLEX_LIBS, PLEX_INDEX, PLEX_SYNC
+    started = time.monotonic()
+    # Server down or hanging: commands keep using the cache we have, the next refresh tries again
+    if not breaker_allows("plex"):
+        log.debug("SmartPlex: Plex server unavailable, cache refresh skipped")
+        return
+    session = plex_session()
+    libs = {}
+    try:
+        url_libs = f"{PLEX_URL}/library/sections?X-Plex-Token={PLEX_TOKEN}"
+        async with session.get(url_libs) as resp:
+            if resp.status != 200: raise RuntimeError(f"HTTP {resp.status}")
+            root = ET.fromstring(await resp.text())
+            for directory in root.findall(".//Directory"):
+                l_type = directory.get("type")
+                if l_type == "artist": l_type = "music"
+                if l_type in ["movie", "show", "music"]:
+                    libs.setdefault(l_type, []).append({"id": directory.get("key"), "title": directory.get("title")})
+    except Exception as e:
+        log.warning(f"SmartPlex: library sections not read, cache kept as is: {repr(e)}")
+        breaker_result("plex", False, e)
+        return
+    breaker_result("plex", True)
+    if not libs: return
+
+    # Every section (and every music tier of every music section) is a shard with its own job,
+    # all download at once, FETCH_CONCURRENCY caps parallel requests to the server
+    limiter = asyncio.Semaphore(FETCH_CONCURRENCY)
+    parts = [(l_type, lib_info) for l_type, sections in libs.items() for lib_info in sections]
+    parts += [(tier, lib_info) for lib_info in libs.get("music", []) for tier in MUSIC_TIERS]
+    jobs = {task.create(refresh_section, session, limiter, l_type, lib_info, full) for l_type, lib_info in parts}
+    done, _ = await task.wait(jobs)
+
+    # Swap everything in one step, find_in_cache never sees a half-built cache.
+    # Shards of sections that are gone from the server are dropped
+    ids = {lib_info["id"] for _, lib_info in parts}
+    cache = {t: {k: v for k, v in shards.items() if k in ids} for t, shards in PLEX_CACHE.items()}
+    index = {t: {k: v for k, v in shards.items() if k in ids} for t, shards in PLEX_INDEX.items()}
+    sync = {k: v for k, v in PLEX_SYNC.items() if k.split(":")[0] in ids}
+    mode = "full" if full or not PLEX_SYNC else "delta"
+    changed = set()
+    for job in done:
+        result = job.result()
+        if not result: continue
+        sync[result["id"]] = result["sync"]
+        if result["items"] is None: continue
+        cache.setdefault(result["type"], {})[result["section"]] = result["items"]
+        index.setdefault(result["type"], {})[result["section"]] = result["index"]
+        changed.add(result["type"])
+    PLEX_LIBS, PLEX_CACHE, PLEX_INDEX, PLEX_SYNC = libs, cache, index, sync
+    publish_cache_stats(mode, started, sorted(changed))
+    if changed: await save_cache_snapshot()
+
+async def refresh_section(session, limiter, l_type, lib_info, full):
+    # Returns the new section state without touching the globals, items is None when nothing changed
+    async with limiter:
         try:
-            url_libs = f"{PLEX_URL}/library/sections?X-Plex-Token={PLEX_TOKEN}"
-            async with session.get(url_libs) as resp:
-                if resp.status == 200:
-                    root = ET.fromstring(await resp.text())
-                    for directory in root.findall(".//Directory"):
-                        l_type = directory.get("type")
-                        if l_type == "artist": l_type = "music"
-                        if l_type in ["movie", "show", "music"]:
-                            PLEX_LIBS[l_type] = {"id": directory.get("key"), "title": directory.get("title")}
-        except: return 
-
-        for l_type, lib_info in PLEX_LIBS.items():
-            try:
-                url = f"{PLEX_URL}/library/sections/{lib_info['id']}/all?X-Plex-Token={PLEX_TOKEN}"
-                async with session.get(url) as resp:
-                    if resp.status == 200:
-                        xml_data = await resp.text()
-                        root = ET.fromstring(xml_data)
-                        items = []
-                        if l_type == "movie":
-                            for node in root.findall(".//Video"):
-                                items.append({"title": node.get("title", "").lower(), "orig": node.get("originalTitle", "").lower(), "year": node.get("year"), "id": node.get("ratingKey")})
-                        elif l_type in ["show", "music"]:
-                            for node in root.findall(".//Directory"):
-                                items.append({"title": node.get("title", "").lower(), "orig": node.get("originalTitle", "").lower(), "id": node.get("ratingKey")})
-                        PLEX_CACHE[l_type] = items
-            except: pass
+            lib_id = lib_info["id"]
+            # Music tiers live in the artists' section but are synced on their own
+            sync_key = f"{lib_id}:{l_type}" if l_type in TIER_TYPES else lib_id
+            cached = PLEX_CACHE.get(l_type, {}).get(lib_id)
+            sync = PLEX_SYNC.get(sync_key)
+            now = time.time()
+            if full or not sync or not cache_size(cached):
+                # Full download: first run, forced refresh or empty cache
+                fetched = await fetch_section(session, l_type, lib_id)
+                if fetched is None: return None
+                items, page = fetched
+                sync = advance_sync({"reconciled_at": now}, page)
+            else:
+                # Delta: only items added or changed since the last sync (new items get updatedAt too).
+                # The bound is inclusive, items already merged at the sync point come back and are skipped
+                fetched = await fetch_section(session, l_type, lib_id, since=sync["updated_at"], seen=sync.get("updated_keys"))
+                if fetched is None: return None
+                changed, page = fetched
+                items = await task.executor(merge_items, cached, changed) if cache_size(changed) else cached
+                sync = advance_sync(dict(sync), page, ["updated"])
+                # Watching changes viewCount / lastViewedAt but not updatedAt: items viewed since the last sync are read too
+                # (once all of them for a sync point from an older version)
+                if l_type in ["movie", "show"]:
+                    fetched = await fetch_section(session, l_type, lib_id, since=sync.get("viewed_at", 0), field="lastViewedAt", seen=sync.get("viewed_keys"))
+                    if fetched is None: return None
+                    played, page = fetched
+                    if cache_size(played): items = await task.executor(merge_items, items, played)
+                    sync = advance_sync(sync, page, ["viewed"])
+                # Deletions: every merge is complete, so more cached items than on the server means something was removed
+                if now - sync["reconciled_at"] >= RECONCILE_INTERVAL:
+                    total = await fetch_section_size(session, l_type, lib_id)
+                    # Marking an item unwatched moves no timestamp, the count of unwatched items catches it within a day
+                    unwatched = await fetch_section_size(session, l_type, lib_id, unwatched=True) if l_type in ["movie", "show"] else None
+                    if (total is not None and total != cache_size(items)) or (unwatched is not None and unwatched != items["watched"].count(0)):
+                        log.debug(f"SmartPlex: {l_type} cache has {cache_size(items)} items, server {total}. Reloading.")
+                        fetched = await fetch_section(session, l_type, lib_id)
+                        if fetched is None: return None
+                        items, page = fetched
+                        sync = advance_sync({}, page)
+                    sync["reconciled_at"] = now
+                if items is cached:
+                    return {"type": l_type, "section": lib_id, "id": sync_key, "sync": sync, "items": None, "index": None}
+            if l_type in TIER_TYPES:
+                index = await task.executor(build_parent_index, items)
+            else:
+                index = await task.executor(build_ngram_index, items)
+                index["sorted"] = await task.executor(build_sort_index, items)
+                if "facets" in items: index["years"] = await task.executor(build_year_index, items)
+            return {"type": l_type, "section": lib_id, "id": sync_key, "sync": sync, "items": items, "index": index}
+        except Exception as e:
+            # The section keeps its cached items and sync point, the next refresh starts from there
+            log.warning(f"SmartPlex: {l_type} section {lib_info['title']} not refreshed: {repr(e)}")
+            breaker_result("plex", False, e)
+            return None
+
+# Snapshot on disk: after a reload or HA restart the cache is back in milliseconds,
+# and the next refresh is a delta because PLEX_SYNC is restored as well
+# One writer per file: a save that arrives while another one is writing leaves its data
+# to that writer, which writes the newest data it was given once the current write is done
+async def save_snapshot(path, data):
+    if path in SNAPSHOT_SAVES:
+        SNAPSHOT_SAVES[path] = data
+        return
+    SNAPSHOT_SAVES[path] = data
+    try:
+        while SNAPSHOT_SAVES[path] is not None:
+            data, SNAPSHOT_SAVES[path] = SNAPSHOT_SAVES[path], None
+            await task.executor(write_snapshot, path, data)
+    finally:
+        del SNAPSHOT_SAVES[path]
+
+async def save_cache_snapshot():
+    # Search hits and notifications replace sections in place: the executor pickles its own copy of the per-type dicts
+    cache = {l_type: dict(sections) for l_type, sections in PLEX_CACHE.items()}
+    index = {l_type: dict(sections) for l_type, sections in PLEX_INDEX.items()}
+    data = {"version": SNAPSHOT_VERSION, "saved_at": time.time(), "libs": PLEX_LIBS, "cache": cache, "index": index, "sync": dict(PLEX_SYNC)}
+    try: await save_snapshot(SNAPSHOT_PATH, data)
+    except Exception as e: log.warning(f"SmartPlex: cache snapshot not saved: {e}")
+
+async def load_cache_snapshot():
+    global PLEX_LIBS, PLEX_CACHE, PLEX_INDEX, PLEX_SYNC
+    started = time.monotonic()
+    data = await task.executor(read_snapshot, SNAPSHOT_PATH)
+    if not data or data.get("version") != SNAPSHOT_VERSION: return False
+    PLEX_LIBS, PLEX_CACHE, PLEX_INDEX, PLEX_SYNC = data["libs"], data["cache"], data["index"], data["sync"]
+    publish_cache_stats("snapshot", started, sorted(PLEX_CACHE))
+    log.debug(f"SmartPlex: cache snapshot loaded ({int(time.time() - data['saved_at'])} s old)")
+    return True
+
+def plex_session():
+    # One keep-alive session for the whole script lifetime, closed by close_plex_session on reload
+    global PLEX_SESSION
+    if PLEX_SESSION is None or PLEX_SESSION.closed:
+        # No total timeout (a big section takes a while to download), but a server that stops answering is given up on
+        conn = aiohttp.TCPConnector(ssl=VERIFY_SSL, limit=FETCH_CONCURRENCY * 2, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=PLEX_CONNECT_TIMEOUT, sock_read=PLEX_READ_TIMEOUT)
+        PLEX_SESSION = aiohttp.ClientSession(connector=conn, timeout=timeout, headers={"Accept-Encoding": "gzip"})
+    return PLEX_SESSION
+
+async def fetch_section(session, l_type, lib_id, since=None, field="updatedAt", seen=None):
+    # Reads the section page by page and parses each page while it downloads,
+    # so neither the whole XML nor the whole element tree is ever held in memory.
+    # since: delta from that time of field on, seen: ratingKeys already merged at exactly that time
+    items, start = new_columns(l_type in TIER_TYPES, l_type == "movie"), 0
+    page = {"updated": 0, "updated_keys": set(), "viewed": 0, "viewed_keys": set(),
+            "field": "viewed" if field == "lastViewedAt" else "updated", "since": since or 0, "seen": seen or set()}
+    while True:
+        url = f"{PLEX_URL}/library/sections/{lib_id}/all?X-Plex-Container-Start={start}&X-Plex-Container-Size={PAGE_SIZE}&X-Plex-Token={PLEX_TOKEN}"
+        if l_type in TIER_TYPES: url += f"&type={TIER_TYPES[l_type]}"
+        if since is not None: url += f"&{field}>>={since - 1}"
+        async with session.get(url) as resp:
+            if resp.status != 200: return None
+            parser = ET.XMLPullParser(events=("end",))
+            page.update({"count": 0, "total": None})
+            while True:
+                chunk = await resp.content.read(CHUNK_SIZE)
+                if not chunk: break
+                parse_chunk(parser, chunk, l_type, items, page)
+            parser.close()
+        start += page["count"]
+        if page["count"] < PAGE_SIZE or (page["total"] is not None and start >= page["total"]): break
+    return items, page
+
+async def fetch_section_size(session, l_type, lib_id, unwatched=False):
+    # An empty page still reports totalSize, so this costs a few hundred bytes
+    url = f"{PLEX_URL}/library/sections/{lib_id}/all?X-Plex-Container-Start=0&X-Plex-Container-Size=0&X-Plex-Token={PLEX_TOKEN}"
+    if l_type in TIER_TYPES: url += f"&type={TIER_TYPES[l_type]}"
+    if unwatched: url += "&unwatched=1"
+    async with session.get(url) as resp:
+        if resp.status != 200: return None
+        total = ET.fromstring(await resp.text()).get("totalSize")
+        return int(total) if total else None
+
+async def load_episode_index(show_id, need_next=False):
+    # Episodes of one show, downloaded the first time the show is asked for by episode or resume.
+    # The next-episode pointer is reloaded once something of the show has been played through it
+    entry = EPISODE_INDEX.get(show_id)
+    if entry and time.time() - entry["loaded_at"] < EPISODE_TTL and not (need_next and entry["played"]): return entry
+    # Server unavailable: an outdated list is still better than a search by show title
+    if not breaker_allows("plex"): return entry
+    url = f"{PLEX_URL}/library/metadata/{show_id}/allLeaves?X-Plex-Token={PLEX_TOKEN}"
+    episodes = []
+    try:
+        async with plex_session().get(url) as resp:
+            if resp.status != 200: return None
+            parser = ET.XMLPullParser(events=("end",))
+            while True:
+                chunk = await resp.content.read(CHUNK_SIZE)
+                if not chunk: break
+                parse_episode_chunk(parser, chunk, episodes)
+            parser.close()
+    except Exception as e:
+        log.warning(f"SmartPlex: episodes of show {show_id} not loaded: {repr(e)}")
+        breaker_result("plex", False, e)
+        return entry
+    breaker_result("plex", True)
+    entry = build_episode_index(episodes)
+    entry.update({"loaded_at": time.time(), "played": False})
+    EPISODE_INDEX[show_id] = entry
+    return entry
+
+# Native helpers (compiled by pyscript, run at full Python speed)
+@pyscript_compile
+def new_columns(with_parent=False, with_facets=False):
+    # One column per field, item N is position N in every column. Numbers live in typed arrays
+    # (8 and 2 bytes each), "orig" only holds the positions whose originalTitle differs from the title.
+    # Albums and tracks also keep the artist's ratingKey in "parent", library items keep what the
+    # sort indexes need: addedAt, release date as YYYYMMDD, audienceRating x 10 and watched (0/1).
+    # Movies also keep "facets": query field -> lowercase value -> positions, in ascending order
+    columns = {"title": [], "orig": {}, "id": array("q"), "year": array("H")}
+    if with_parent: columns["parent"] = array("q")
+    else: columns.update({"added": array("I"), "released": array("I"), "rating": array("B"), "watched": array("B")})
+    if with_facets: columns["facets"] = {}
+    return columns
+
+@pyscript_compile
+def cache_size(columns):
+    return len(columns["title"]) if columns else 0
+
+@pyscript_compile
+def cache_item(columns, pos):
+    # The item as a dict, same shape as before the columns: string id and year
+    year = columns["year"][pos]
+    item = {"title": columns["title"][pos], "orig": columns["orig"].get(pos, ""), "id": str(columns["id"][pos]),
+            "year": str(year) if year else None}
+    if "parent" in columns: item["parent"] = str(columns["parent"][pos])
+    return item
+
+@pyscript_compile
+def add_column_item(columns, title, orig, rating_key, year, parent=0, sort=(0, 0, 0, 0)):
+    pos = len(columns["title"])
+    columns["title"].append(title)
+    if orig and orig != title: columns["orig"][pos] = orig
+    columns["id"].append(rating_key)
+    columns["year"].append(year)
+    if "parent" in columns: columns["parent"].append(parent)
+    if "added" in columns:
+        added, released, rating, watched = sort
+        columns["added"].append(added)
+        columns["released"].append(released)
+        columns["rating"].append(rating)
+        columns["watched"].append(watched)
+
+@pyscript_compile
+def sort_fields(node):
+    # (addedAt, originallyAvailableAt as YYYYMMDD, audienceRating x 10, watched) of a library item.
+    # A show counts as watched when all its episodes are
+    released = (node.get("originallyAvailableAt") or "")[:10].replace("-", "")
+    rating = node.get("audienceRating")
+    leaves = int(node.get("leafCount") or 0)
+    # A show's viewCount counts plays of any episode, so only the episode counts decide
+    watched = int(node.get("viewedLeafCount") or 0) >= leaves if leaves else int(node.get("viewCount") or 0) > 0
+    return (int(node.get("addedAt") or 0), int(released) if released.isdigit() else 0,
+            min(100, round(float(rating) * 10)) if rating else 0, 1 if watched else 0)
+
+@pyscript_compile
+def advance_sync(sync, page, names=("updated", "viewed")):
+    # Moves each sync point (time + ratingKeys read at that time) to the newest time on the page
+    for name in names:
+        at, keys = sync.get(f"{name}_at", 0), sync.get(f"{name}_keys", set())
+        if page[name] > at: at, keys = page[name], page[f"{name}_keys"]
+        elif page[name] == at: keys = set(keys) | page[f"{name}_keys"]
+        sync.update({f"{name}_at": at, f"{name}_keys": keys})
+    return sync
+
+@pyscript_compile
+def parse_chunk(parser, chunk, l_type, items, page):
+    parser.feed(chunk)
+    tag = {"movie": "Video", "track": "Track"}.get(l_type, "Directory")
+    # Tracks point to the artist through their album (grandparent); a track's originalTitle is its artist, not a title
+    parent_key = {"album": "parentRatingKey", "track": "grandparentRatingKey"}.get(l_type)
+    for _, node in parser.read_events():
+        if node.tag == tag:
+            rating_key = int(node.get("ratingKey") or 0)
+            stamps = {"updated": int(node.get("updatedAt") or node.get("addedAt") or 0), "viewed": int(node.get("lastViewedAt") or 0)}
+            for name, stamp in stamps.items():
+                if stamp > page[name]: page[name], page[f"{name}_keys"] = stamp, {rating_key}
+                elif stamp and stamp == page[name]: page[f"{name}_keys"].add(rating_key)
+            page["count"] += 1
+            # Items already merged at the sync point itself are read but not returned again
+            if stamps[page["field"]] <= page["since"] and rating_key in page["seen"]:
+                node.clear()
+                continue
+            year = node.get("year")
+            add_column_item(items, node.get("title", "").lower(), node.get("originalTitle", "").lower() if not parent_key else "",
+                            rating_key, int(year) if year and year.isdigit() else 0,
+                            int(node.get(parent_key) or 0) if parent_key else 0, sort_fields(node) if not parent_key else (0, 0, 0, 0))
+            if "facets" in items: add_facets(items["facets"], node, len(items["title"]) - 1)
+            node.clear()  # Drop attributes and child tags (Media, Genre, Role...) right away
+        elif node.tag == "MediaContainer" and node.get("totalSize"):
+            page["total"] = int(node.get("totalSize"))
+
+@pyscript_compile
+def add_facets(facets, node, pos):
+    # Tag children (<Genre tag="Comedy"/>, <Role tag="..."/>...) and facet attributes of one movie.
+    # Positions only grow while a section is read, so every posting list stays sorted
+    values = [(FACET_TAGS[child.tag], child.get("tag")) for child in node if child.tag in FACET_TAGS]
+    values += [(field, node.get(field)) for field in FACET_ATTRS]
+    for field, value in values:
+        if not value: continue
+        postings = facets.setdefault(field, {}).setdefault(value.lower(), array("I"))
+        if not postings or postings[-1] != pos: postings.append(pos)
+
+@pyscript_compile
+def parse_episode_chunk(parser, chunk, episodes):
+    # (season, episode, ratingKey, viewCount, viewOffset, lastViewedAt) per episode
+    parser.feed(chunk)
+    for _, node in parser.read_events():
+        if node.tag == "Video":
+            episodes.append((int(node.get("parentIndex") or 0), int(node.get("index") or 0), node.get("ratingKey"),
+                             int(node.get("viewCount") or 0), int(node.get("viewOffset") or 0), int(node.get("lastViewedAt") or 0)))
+            node.clear()
+
+@pyscript_compile
+def build_episode_index(episodes):
+    # {"episodes": {(season, episode): ratingKey}, "seasons": [...], "next": ratingKey to resume or None}
+    episodes = sorted(episodes)
+    regular = [ep for ep in episodes if ep[0] > 0]  # Season 0 is specials
+    # Watched or started, the episode viewed last decides: an old half-watched episode does not
+    # beat the ones watched through since
+    viewed = [pos for pos, ep in enumerate(regular) if ep[3] or ep[4] > 0]
+    if viewed:
+        last = max(viewed, key=lambda pos: regular[pos][5])
+        if not regular[last][3]:
+            # Stopped in the middle of it: resume that one
+            next_key = regular[last][2]
+        else:
+            # First unwatched episode after it
+            after = [ep for ep in regular[last + 1:] if not ep[3]]
+            next_key = after[0][2] if after else None
+    else:
+        next_key = regular[0][2] if regular else None
+    return {"episodes": {(ep[0], ep[1]): ep[2] for ep in episodes}, "seasons": sorted({ep[0] for ep in regular}), "next": next_key}
+
+@pyscript_compile
+def write_snapshot(path, data):
+    # Own temp file next to the target for every write, then an atomic rename:
+    # never a half-written snapshot, and two writers never share a file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except BaseException:
+        try: os.unlink(tmp)
+        except OSError: pass
+        raise
+
+@pyscript_compile
+def read_snapshot(path):
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        return None
+
+@pyscript_compile
+def merge_items(items, changed):
+    # Every number column is an array of the same length, they are copied and updated alike
+    numbers = [field for field, column in items.items() if isinstance(column, array)]
+    merged = {"title": list(items["title"]), "orig": dict(items["orig"])}
+    for field in numbers: merged[field] = array(items[field].typecode, items[field])
+    positions = {rating_key: pos for pos, rating_key in enumerate(merged["id"])}
+    moved, updated = [], set()
+    for i, rating_key in enumerate(changed["id"]):
+        title, orig = changed["title"][i], changed["orig"].get(i, "")
+        pos = positions.get(rating_key)
+        if pos is None:
+            pos = len(merged["title"])
+            merged["title"].append(title)
+            for field in numbers: merged[field].append(changed[field][i])
+        else:
+            updated.add(pos)
+            merged["title"][pos] = title
+            for field in numbers: merged[field][pos] = changed[field][i]
+        moved.append(pos)
+        if orig: merged["orig"][pos] = orig
+        else: merged["orig"].pop(pos, None)
+    if "facets" in items: merged["facets"] = merge_facets(items["facets"], changed["facets"], updated, moved)
+    return merged
+
+@pyscript_compile
+def merge_facets(facets, changed, updated, moved):
+    # Posting lists are shared with the cache in use, a list is copied before it changes.
+    # Updated items leave all their old values, then every changed item joins its current ones
+    # (moved: changed position -> merged position)
+    merged = {}
+    for field in set(facets) | set(changed):
+        postings = merged[field] = dict(facets.get(field, {}))
+        if updated:
+            for value, positions in facets.get(field, {}).items():
+                if not any(pos in updated for pos in positions): continue
+                kept = array("I", [pos for pos in positions if pos not in updated])
+                if kept: postings[value] = kept
+                else: del postings[value]
+        for value, positions in changed.get(field, {}).items():
+            postings[value] = array("I", sorted(set(postings.get(value, ())) | {moved[i] for i in positions}))
+    return merged
+
+@pyscript_compile
+def ngrams(text):
+    if not text: return set()
+    t = f" {text} "
+    return {t[i:i + 3] for i in range(len(t) - 2)}
+
+@pyscript_compile
+def build_ngram_index(items):
+    grams, sizes = {}, []
+    origs = items["orig"]
+    for pos, title in enumerate(items["title"]):
+        item_grams = ngrams(title) | ngrams(origs.get(pos, ""))
+        sizes.append(len(item_grams))
+        for g in item_grams:
+            grams.setdefault(g, []).append(pos)
+    return {"grams": grams, "sizes": sizes}
+
+@pyscript_compile
+def build_sort_index(items):
+    # Positions in ascending order, a pick reads one end: "released" (oldest first, addedAt breaks ties)
+    # and "rating" (lowest first). Items without a release date / rating are left out, as on the server
+    added, released, rating = items["added"], items["released"], items["rating"]
+    positions = range(len(added))
+    return {"released": array("I", sorted((pos for pos in positions if released[pos]), key=lambda pos: (released[pos], added[pos]))),
+            "rating": array("I", sorted((pos for pos in positions if rating[pos]), key=lambda pos: (rating[pos], added[pos])))}
+
+@pyscript_compile
+def build_year_index(items):
+    # Year -> positions, the year and decade filters read it like the tag facets
+    years = {}
+    for pos, year in enumerate(items["year"]):
+        if year: years.setdefault(year, array("I")).append(pos)
+    return years
+
+@pyscript_compile
+def sorted_pick(items, order, from_end, unwatched):
+    # First position from one end of a sort index, watched items skipped when asked
+    for pos in (reversed(order) if from_end else order):
+        if not (unwatched and items["watched"][pos]): return pos
+    return None
+
+@pyscript_compile
+def ranked_pick(pool, field, lowest):
+    # (lib_info, shard, pos) with the highest / lowest field value, addedAt breaks ties.
+    # Items without the value only count when no item has it
+    pool = [c for c in pool if c[1][field][c[2]]] or pool
+    rank = lambda c: (c[1][field][c[2]], c[1]["added"][c[2]])
+    return min(pool, key=rank) if lowest else max(pool, key=rank)
+
+@pyscript_compile
+def build_parent_index(items):
+    # Music tiers: artist ratingKey -> positions of its albums / tracks, a search only scans one artist
+    by_parent = {}
+    for pos, parent in enumerate(items["parent"]):
+        by_parent.setdefault(parent, array("I")).append(pos)
+    return {"by_parent": by_parent}
+
+@pyscript_compile
+def fuzzy_search(items, index, q, limit, scope=None):
+    # Returns (position of the best item or None, score). scope: only these positions are scored.
+    # Short queries or an empty index: plain scan, same as before the index existed
+    titles = items["title"]
+    positions = range(len(titles)) if scope is None else scope
+    if scope is None and index and len(q) >= 3:
+        q_grams = ngrams(q)
+        hits = Counter()
+        for g in q_grams:
+            hits.update(index["grams"].get(g, ()))
+        # Rank by Dice similarity so long titles sharing common grams don't crowd out the real match
+        sizes, q_size = index["sizes"], len(q_grams)
+        top = heapq.nlargest(limit, hits.items(), key=lambda h: h[1] / (q_size + sizes[h[0]]))
+        # Keep library order so ties and the 0.95 early exit pick the same item as a full scan
+        positions = sorted(pos for pos, _ in top)
+        best, highest = score_titles(items, q, positions)
+        # Dice ranks short titles contained in the query above typo matches of the whole title: a weak
+        # or missing best candidate is checked against the whole shard, like the scan before the index
+        if highest >= INDEX_TRUST_SCORE: return best, highest
+        positions = range(len(titles))
+    return score_titles(items, q, positions)
+
+@pyscript_compile
+def score_titles(items, q, positions):
+    titles, origs = items["title"], items["orig"]
+    best, highest = None, 0.0
+    for pos in positions:
+        r = SequenceMatcher(None, q, titles[pos]).ratio()
+        if pos in origs: r = max(r, SequenceMatcher(None, q, origs[pos]).ratio())
+        if r > 0.95: return pos, r
+        if r > 0.6 and r > highest: highest = r; best = pos
+    return best, highest
+
+@pyscript_compile
+def best_match(parts, q, limit):
+    # ((lib_info, shard, position) or None, score) of the best match over [(lib_info, shard, index)].
+    # Only reads the shards, so it also runs in an executor thread
+    best, highest = None, 0.0
+    for lib_info, shard, index in parts:
+        pos, score = fuzzy_search(shard, index, q, limit)
+        if pos is None or score <= highest: continue
+        best, highest = (lib_info, shard, pos), score
+        if score > 0.95: break
+    return best, highest
+
+@pyscript_compile
+def best_search_hit(root, kind, q):
+    # Server search results of one type ("movie", "show", "artist"), scored against the query with the
+    # same similarity as fuzzy_search. Returns (score, node) of the best one above 0.6, or None
+    best = None
+    for node in root.iter():
+        if node.get("type") != kind or not node.get("ratingKey") or not node.get("librarySectionID"): continue
+        score = max(SequenceMatcher(None, q, (node.get(field) or "").lower()).ratio() for field in ["title", "originalTitle"])
+        if score > 0.6 and (best is None or score > best[0]): best = (score, node)
+    return best
+
+@pyscript_compile
+def search_hit_columns(node, with_facets):
+    # One search result as columns, parsed like a section listing
+    year = node.get("year")
+    columns = new_columns(False, with_facets)
+    add_column_item(columns, node.get("title", "").lower(), node.get("originalTitle", "").lower(), int(node.get("ratingKey") or 0),
+                    int(year) if year and year.isdigit() else 0, 0, sort_fields(node))
+    if with_facets: add_facets(columns["facets"], node, 0)
+    return columns
+
+@pyscript_compile
+def add_search_hit(items, index, node):
+    # Copies of a section's columns and indexes with the search result appended as the last item
+    merged = merge_items(items, search_hit_columns(node, "facets" in items))
+    pos = len(merged["title"]) - 1
+    item_grams = ngrams(merged["title"][pos]) | ngrams(merged["orig"].get(pos, ""))
+    grams = dict(index["grams"])
+    for g in item_grams: grams[g] = grams.get(g, []) + [pos]
+    updated = {"grams": grams, "sizes": index["sizes"] + [len(item_grams)]}
+    if "sorted" in index:
+        updated["sorted"] = {}
+        for field, order in index["sorted"].items():
+            order = array("I", order)
+            if merged[field][pos]: insort(order, pos, key=lambda p: (merged[field][p], merged["added"][p]))
+            updated["sorted"][field] = order
+    if "years" in index:
+        updated["years"] = dict(index["years"])
+        year = merged["year"][pos]
+        if year: updated["years"][year] = array("I", list(index["years"].get(year, ())) + [pos])
+    return merged, updated
+
+def cache_count(l_type):
+    return sum(cache_size(shard) for shard in PLEX_CACHE.get(l_type, {}).values())
 
 def find_in_cache(target_type, query_string):
-    lib = PLEX_CACHE.get(target_type, [])
-    if not lib or not query_string: return None
+    return match_in_cache(target_type, query_string)[0]
+
+def match_in_cache(target_type, query_string):
+    # Same as find_in_cache, but also returns the similarity score of the match.
+    # Every section of the type is searched, the best match wins (the first section on a tie)
+    # and carries its "section" and "library_name"
+    if not query_string: return None, 0.0
+    found, score = best_match(cache_parts(target_type), query_string.lower().strip(), INDEX_CANDIDATES)
+    return (shard_item(*found) if found else None), score
+
+def cache_parts(l_type):
+    # (lib_info, shard, index) of every cached section of the type, in server order
+    parts = []
+    for lib_info in PLEX_LIBS.get(l_type, []):
+        shard = PLEX_CACHE.get(l_type, {}).get(lib_info["id"])
+        if cache_size(shard): parts.append((lib_info, shard, PLEX_INDEX.get(l_type, {}).get(lib_info["id"])))
+    return parts
+
+async def find_title(l_type, query_string):
+    # find_in_cache raced against the Plex server's own search: the cache is searched in an executor thread
+    # while /hubs/search runs, the better scored item wins. A certain cache match (> 0.95) does not wait
+    # for the server, and the server gets SERVER_SEARCH_TIMEOUT seconds at most. A server hit that is
+    # missing from the cache (added since the last refresh) is written into it, the next command finds it locally
+    if not query_string: return None
     q = query_string.lower().strip()
-    best, highest = None, 0.0
-    for item in lib:
-        r = max(SequenceMatcher(None, q, item["title"]).ratio(), SequenceMatcher(None, q, item.get("orig", "")).ratio())
-        if r > 0.95: return item
-        if r > 0.6 and r > highest: highest = r; best = item
+    search = task.create(search_server, l_type, q) if SERVER_SEARCH_TIMEOUT and breaker_allows("plex") else None
+    found, score = await task.executor(best_match, cache_parts(l_type), q, INDEX_CANDIDATES)
+    cached = shard_item(*found) if found else None
+    if search is None: return cached
+    if score > 0.95:
+        task.cancel(search)
+        return cached
+    done, _ = await task.wait({search}, timeout=SERVER_SEARCH_TIMEOUT)
+    if search not in done:
+        task.cancel(search)
+        log.debug(f"SmartPlex: server search for '{q}' took longer than {SERVER_SEARCH_TIMEOUT} s, using the cache")
+        return cached
+    hit = search.result()
+    if not hit or hit[0] <= score: return cached
+    log.debug(f"SmartPlex: '{q}' found by the server search ({hit[0]:.2f} vs {score:.2f} in the cache)")
+    return remember_search_hit(l_type, hit[1])
+
+async def search_server(l_type, q):
+    # (score, XML node) of the best /hubs/search result of the type, scored like the cache, or None
+    params = {"query": q, "limit": SERVER_SEARCH_LIMIT, "X-Plex-Token": PLEX_TOKEN}
+    try:
+        async with plex_session().get(f"{PLEX_URL}/hubs/search", params=params) as resp:
+            if resp.status != 200: return None
+            root = ET.fromstring(await resp.text())
+    except Exception as e:
+        log.warning(f"SmartPlex: server search for '{q}' failed: {repr(e)}")
+        breaker_result("plex", False, e)
+        return None
+    breaker_result("plex", True)
+    return best_search_hit(root, "artist" if l_type == "music" else l_type, q)
+
+def remember_search_hit(l_type, node):
+    # The hit as a cache item. Unless its section already has it, the item is appended to a copy of the
+    # section's shard and indexes that then replaces the one in use (nothing shared is changed in place)
+    section = node.get("librarySectionID")
+    lib_info = {"id": section, "title": node.get("librarySectionTitle")}
+    for known in PLEX_LIBS.get(l_type, []):
+        if known["id"] == section: lib_info = known
+    shard = PLEX_CACHE.get(l_type, {}).get(section)
+    index = PLEX_INDEX.get(l_type, {}).get(section)
+    if shard is None or index is None or int(node.get("ratingKey") or 0) in shard["id"]:
+        return shard_item(lib_info, search_hit_columns(node, False), 0)
+    started = time.monotonic()
+    shard, index = add_search_hit(shard, index, node)
+    PLEX_CACHE[l_type][section], PLEX_INDEX[l_type][section] = shard, index
+    publish_cache_stats("search", started, [l_type])
+    task.create(save_cache_snapshot)
+    return shard_item(lib_info, shard, cache_size(shard) - 1)
+
+def shard_item(lib_info, shard, pos):
+    item = cache_item(shard, pos)
+    item.update({"section": lib_info["id"], "library_name": lib_info["title"]})
+    return item
+
+def pick_in_cache(l_type, sort_mode, unwatched=False):
+    # "newest" / "oldest" / "top_rated" / "random" item of the type from the sort indexes of all its
+    # sections, None when nothing qualifies (the server picks then)
+    shards = []
+    for lib_info in PLEX_LIBS.get(l_type, []):
+        shard = PLEX_CACHE.get(l_type, {}).get(lib_info["id"])
+        orders = PLEX_INDEX.get(l_type, {}).get(lib_info["id"], {}).get("sorted")
+        if cache_size(shard) and orders: shards.append((lib_info, shard, orders))
+    if not shards: return None
+    if sort_mode == "random": return random_pick(shards, unwatched)
+    field = "rating" if sort_mode == "top_rated" else "released"
+    best, best_rank = None, None
+    for lib_info, shard, orders in shards:
+        pos = sorted_pick(shard, orders[field], sort_mode != "oldest", unwatched)
+        if pos is None: continue
+        rank = (shard[field][pos], shard["added"][pos])
+        if best_rank is None or (rank < best_rank if sort_mode == "oldest" else rank > best_rank):
+            best, best_rank = shard_item(lib_info, shard, pos), rank
     return best
 
+def random_pick(shards, unwatched):
+    # Uniform over all cached items of the sections: one draw over their total size. With "unwatched"
+    # a watched draw is repeated a few times, then the choice is made among the unwatched ones
+    total = sum(cache_size(shard) for _, shard, _ in shards)
+    for _ in range(8):
+        pos = random.randrange(total)
+        for lib_info, shard, _ in shards:
+            if pos < cache_size(shard): break
+            pos -= cache_size(shard)
+        if not (unwatched and shard["watched"][pos]): return shard_item(lib_info, shard, pos)
+    pool = [(lib_info, shard, pos) for lib_info, shard, _ in shards for pos in range(cache_size(shard)) if not shard["watched"][pos]]
+    return shard_item(*random.choice(pool)) if pool else None
+
+def filter_in_cache(l_type, query):
+    # Items matching every filter of the query: the posting lists of each filter value are
+    # intersected per section, smallest first. Misspelled values are replaced by the closest known
+    # value (FACET_MIN_SCORE). Returns ([(lib_info, shard, positions)], {field: corrected value}),
+    # or None when the query has something the facets do not cover (the server filters then)
+    text_fields = list(FACET_TAGS.values()) + FACET_ATTRS
+    if set(query) <= {"unwatched"} or set(query) - set(text_fields) - {"year", "decade", "unwatched"}: return None
+    found, corrected = [], {}
+    for lib_info in PLEX_LIBS.get(l_type, []):
+        shard = PLEX_CACHE.get(l_type, {}).get(lib_info["id"])
+        years = PLEX_INDEX.get(l_type, {}).get(lib_info["id"], {}).get("years")
+        if not cache_size(shard) or "facets" not in shard or years is None: return None
+        lists = []
+        for field in text_fields:
+            if not query.get(field): continue
+            postings = shard["facets"].get(field, {})
+            value = query[field].lower()
+            if value not in postings:
+                close = get_close_matches(value, list(postings), 1, FACET_MIN_SCORE)
+                value = close[0] if close else None
+                if value: corrected.setdefault(field, value)
+            lists.append(postings.get(value, ()))
+        if query.get("year"): lists.append(years.get(int(query["year"]), ()))
+        if query.get("decade"):
+            decade = int(query["decade"]) // 10 * 10
+            lists.append([pos for year in range(decade, decade + 10) for pos in years.get(year, ())])
+        lists.sort(key=len)
+        positions = set(lists[0]) if lists else set(range(cache_size(shard)))
+        for other in lists[1:]:
+            if not positions: break
+            positions.intersection_update(other)
+        if query.get("unwatched"): positions = {pos for pos in positions if not shard["watched"][pos]}
+        if positions: found.append((lib_info, shard, sorted(positions)))
+    return found, corrected
+
+def pick_among(found, sort_mode):
+    # One item of filter_in_cache's result: newest / oldest / top rated, anything else is random
+    pool = [(lib_info, shard, pos) for lib_info, shard, positions in found for pos in positions]
+    if not pool: return None
+    if sort_mode in ["newest", "oldest", "top_rated"]:
+        return shard_item(*ranked_pick(pool, "rating" if sort_mode == "top_rated" else "released", sort_mode == "oldest"))
+    return shard_item(*random.choice(pool))
+
+def library_name(l_type, cached=None):
+    # Section of the cached item, otherwise the first section of the type (the server searches there)
+    if cached: return cached["library_name"]
+    sections = PLEX_LIBS.get(l_type)
+    return sections[0]["title"] if sections else None
+
+def find_by_artist(tier, artist, query_string):
+    # Album or track of one cached artist ("album" / "track"), None when the tier is not cached.
+    # The tiers are sharded like the artists, so only the artist's own music section is searched
+    lib = PLEX_CACHE.get(tier, {}).get(artist["section"])
+    if not cache_size(lib) or not query_string: return None
+    scope = PLEX_INDEX.get(tier, {}).get(artist["section"], {}).get("by_parent", {}).get(int(artist["id"]))
+    if not scope: return None
+    pos, _ = fuzzy_search(lib, None, query_string.lower().strip(), INDEX_CANDIDATES, scope)
+    return cache_item(lib, pos) if pos is not None else None
+
+async def resolve_episode(show, query):
+    # ratingKey of the requested episode, or of the next one to watch when no episode is given.
+    # None = not in the index, the server searches as before
+    episode = query.get("episode")
+    entry = await load_episode_index(show["id"], need_next=not episode)
+    if not entry: return None
+    if episode:
+        seasons = entry["seasons"]
+        season = int(query["season"]) if query.get("season") else (seasons[0] if len(seasons) == 1 else None)
+        key = entry["episodes"].get((season, int(episode)))
+    else:
+        key = entry["next"]
+    if key: entry["played"] = True
+    return key
+
 # === 4. HARDWARE (HABR STYLE SCAN) ===
-async def boot_hardware_process(zone_config):
+async def boot_hardware_process(zone_config, room=None):
     hw_entity = zone_config.get("hardware_entity")
     plex_client = zone_config["plex_client"]
     power = zone_config.get("power_method")
+    was_off = state.get(hw_entity) in ["off", "unavailable", "standby"]
+    hw_started = time.monotonic()
     
     # 1. Turn on TV/Set-top box
     if power == "apple_tv_device":
@@ -115,113 +942,588 @@ async def boot_hardware_process(zone_config):
     else:
         await service.call("media_player", "turn_on", entity_id=hw_entity)
 
-    await task.sleep(zone_config["boot_delay"])
+    # Wait until the TV reports it is on, at most the learned boot time (boot_delay until there is history)
+    if was_off:
+        started = time.monotonic()
+        bound = learned_delay(room, "boot", zone_config["boot_delay"])
+        trig = await task.wait_until(state_trigger=f"{hw_entity} not in ['off', 'unavailable', 'standby']", timeout=bound)
+        if trig.get("trigger_type") == "state": await record_timing(room, "boot", time.monotonic() - started)
+        # Timed out: this zone got slower than learned, let the bound grow (up to twice the config value)
+        else: await record_timing(room, "boot", min(bound * 1.5, zone_config["boot_delay"] * 2))
 
     # 2. Launch Plex (if needed)
+    boot_time = time.monotonic() - hw_started
+    app_started = None
     try:
         if power == "apple_tv_device" or state.getattr(hw_entity).get("source") != "Plex":
              await service.call("media_player", "select_source", entity_id=hw_entity, source="Plex")
-             await task.sleep(zone_config["app_load_delay"])
-    except: pass
+             app_started = time.monotonic()
+             # The app is ready when its Plex client shows up, wait for that instead of a fixed app_load_delay
+             await task.wait_until(state_trigger=f"{plex_client} not in ['unavailable', 'unknown', 'off']",
+                                   timeout=learned_delay(room, "app", zone_config["app_load_delay"]))
+    except Exception as e: log.warning(f"SmartPlex: Plex app not started on {hw_entity}, scanning for the client anyway: {e}")
+
+    # 3. Wait for the Plex client (Habr Style scan, event driven)
+    app_time = time.monotonic() - hw_started - boot_time
+    client = await wait_for_plex_client(plex_client)
+    if app_started and client["found"]: await record_timing(room, "app", time.monotonic() - app_started)
+    client.update({"boot": boot_time, "app": app_time})
+    return client
+
+# Learned timings: last TIMING_SAMPLES measurements per zone and stage, kept on disk.
+# The wait bound is their TIMING_PERCENTILE, config delays are used until there are enough samples
+def learned_delay(room, stage, default):
+    samples = sorted((ZONE_TIMINGS or {}).get(room, {}).get(stage, []))
+    if len(samples) < TIMING_MIN_SAMPLES: return default
+    return samples[int(TIMING_PERCENTILE * (len(samples) - 1))] * TIMING_MARGIN
+
+async def record_timing(room, stage, seconds):
+    if not room: return
+    if ZONE_TIMINGS is None: await load_zone_timings()
+    samples = ZONE_TIMINGS.setdefault(room, {}).setdefault(stage, [])
+    samples.append(round(seconds, 2))
+    del samples[:-TIMING_SAMPLES]
+    log.debug(f"SmartPlex: {room} {stage} took {seconds:.1f} s, wait bound now {learned_delay(room, stage, 0):.1f} s")
+    # Copy in the event loop, the sample lists keep changing while the executor pickles
+    data = {zone: {name: list(values) for name, values in stages.items()} for zone, stages in ZONE_TIMINGS.items()}
+    try: await save_snapshot(TIMINGS_PATH, data)
+    except Exception as e: log.warning(f"SmartPlex: zone timings not saved: {e}")
+
+async def load_zone_timings():
+    global ZONE_TIMINGS
+    ZONE_TIMINGS = await task.executor(read_snapshot, TIMINGS_PATH) or {}
 
-    # 3. SCANNING LOOP (Habr Style)
-    # Try 10 times with a 3-second pause (30 sec total) until the client becomes available
-    for i in range(10):
-        # If client appears (not unavailable/unknown/off) — exit loop
+async def wait_for_plex_client(plex_client, timeout=None):
+    # Reacts to the client's state change the moment it appears in HA. Scan is pressed
+    # with growing gaps (1, 2, 4, 8 s) instead of every 3 seconds.
+    # Returns {"found": bool, "elapsed": seconds, "scans": presses}, boot_hardware_process adds "boot" and "app" seconds
+    timeout = SCAN_TIMEOUT if timeout is None else timeout
+    start = time.monotonic()
+    gap, scans = SCAN_FIRST_GAP, 0
+    while True:
+        # If client appears (not unavailable/unknown/off) — done
         current_state = state.get(plex_client)
-        if current_state not in ["unavailable", "unknown", "off"]:
-            log.debug(f"Plex Client found: {plex_client} (State: {current_state})")
-            break
-        
-        # If not found — press Scan
-        log.debug(f"Plex Client not found. Scanning... (Attempt {i+1}/10)")
+        elapsed = time.monotonic() - start
+        if current_state not in ["unavailable", "unknown", "off", None]:
+            log.debug(f"Plex Client found: {plex_client} (State: {current_state}, {elapsed:.1f} s, {scans} scans)")
+            return {"found": True, "elapsed": elapsed, "scans": scans}
+        if elapsed >= timeout:
+            return {"found": False, "elapsed": elapsed, "scans": scans}
+
+        # If not found — press Scan and wait for the state change, at most until the next press
+        scans += 1
+        log.debug(f"Plex Client not found. Scanning... (Attempt {scans})")
         try: await service.call("button", "press", entity_id=PLEX_SCAN_BUTTON)
-        except: pass
-        
-        await task.sleep(3)
+        except Exception as e: log.warning(f"SmartPlex: {PLEX_SCAN_BUTTON} press failed: {e}")
+        wait, waited = min(gap, max(timeout - elapsed, 0.1)), time.monotonic()
+        await task.wait_until(state_trigger=f"{plex_client} not in ['unavailable', 'unknown', 'off', None]", timeout=wait)
+        # A trigger that fired while the client is still missing does not shorten the gap
+        left = wait - (time.monotonic() - waited)
+        if left > 0 and state.get(plex_client) in ["unavailable", "unknown", "off", None]: await task.sleep(left)
+        gap = min(gap * 2, SCAN_MAX_GAP)
+
+async def shutdown_hardware(zone_config):
+    # Rollback of a speculative boot, mirrors step 1 of boot_hardware_process
+    hw_entity = zone_config.get("hardware_entity")
+    power = zone_config.get("power_method")
+    if power in ["apple_tv_device", "lg_device"]:
+        await service.call("media_player", "turn_off", device_id=zone_config["hardware_device_id"])
+    elif power == "samsung_remote":
+        await service.call("remote", "turn_off", entity_id=zone_config["remote_entity"])
+    else:
+        await service.call("media_player", "turn_off", entity_id=hw_entity)
+
+# One boot per zone, shared by every command for that zone. Commands await it through
+# wait_for_boot, so cancelling a superseded command never stops the boot the next one needs
+def claim_zone_boot(room, seq):
+    boot = ZONE_BOOTS.get(room)
+    if boot is None or boot["task"].done():
+        was_off = state.get(ZONES[room].get("hardware_entity")) in ["off", "unavailable", "standby"]
+        boot = {"task": task.create(boot_hardware_process, ZONES[room], room), "users": set(), "was_off": was_off}
+        ZONE_BOOTS[room] = boot
+    boot["users"].add(seq)
+    return boot["task"]
+
+def release_zone_boot(room, seq):
+    # The command does not need the zone any more. The last one out stops a boot nobody
+    # waits for and switches off the TV it turned on, also when the boot has already finished
+    boot = ZONE_BOOTS.get(room)
+    if not boot or seq not in boot["users"]: return
+    boot["users"].discard(seq)
+    if boot["users"]: return
+    del ZONE_BOOTS[room]
+    if not boot["task"].done():
+        log.debug(f"SmartPlex: boot of {room} cancelled, no command needs it")
+        task.cancel(boot["task"])
+    if boot["was_off"]:
+        log.debug(f"SmartPlex: switching {room} off again, nothing was played there")
+        task.create(shutdown_hardware, ZONES[room])
+
+def claim_zone_command(room, seq):
+    # The latest command for a zone wins: a running older one is cancelled, and an older command
+    # that only now learns its room (slow AI answer) gives up. Returns False for the loser
+    current, me = ZONE_COMMANDS.get(room), task.current_task()
+    if current and current["seq"] > seq: return False
+    if current and current["task"] is not me and not current["task"].done():
+        log.debug(f"SmartPlex: command {current['seq']} for {room} superseded by {seq}")
+        task.cancel(current["task"])
+    ZONE_COMMANDS[room] = {"seq": seq, "task": me}
+    return True
+
+async def wait_for_boot(hw_task, timeout):
+    # Waits for the zone's boot without owning it: neither the deadline nor a cancelled command stops it.
+    # Past the deadline the command goes on as if the client had not appeared
+    done, _ = await task.wait({hw_task}, timeout=timeout)
+    if hw_task in done: return hw_task.result()
+    return {"found": False, "elapsed": timeout, "scans": 0, "deadline": True}
+
+# Deadlines: every stage of a command gets STAGE_DEADLINES[stage] seconds, but never more than is
+# left of COMMAND_BUDGET. A stage that runs out raises asyncio.TimeoutError or takes its degraded path
+def stage_deadline(trace, stage):
+    left = COMMAND_BUDGET - (time.monotonic() - trace["start"])
+    return max(min(STAGE_DEADLINES[stage], left), 0.1)
+
+async def run_within(seconds, func, *args, **kwargs):
+    # func(*args, **kwargs) as its own task, cancelled when it is not done in time
+    job = task.create(func, *args, **kwargs)
+    try:
+        done, _ = await task.wait({job}, timeout=seconds)
+    except asyncio.CancelledError:
+        task.cancel(job)
+        raise
+    if job not in done:
+        task.cancel(job)
+        raise asyncio.TimeoutError(f"no answer in {seconds:.1f} s")
+    return job.result()
+
+# Circuit breakers around the Plex server and the AI entity. After BREAKER_THRESHOLD failures in a row
+# the breaker opens: the dependency is not called for BREAKER_COOLDOWN seconds and commands take the
+# degraded paths (cached library, remembered answers, local parser). Then it is half open, the next
+# call is a trial that closes it again or reopens it
+def breaker_state(name):
+    return BREAKERS.setdefault(name, {"state": "closed", "failures": 0, "trips": 0, "opened_at": None, "error": None})
+
+def breaker_allows(name):
+    breaker = breaker_state(name)
+    if breaker["state"] == "open" and time.time() - breaker["opened_at"] >= BREAKER_COOLDOWN:
+        breaker["state"] = "half_open"
+        publish_breakers()
+    return breaker["state"] != "open"
+
+def breaker_result(name, ok, error=None):
+    breaker = breaker_state(name)
+    before = breaker["state"]
+    if ok:
+        breaker.update({"state": "closed", "failures": 0})
+    else:
+        breaker["failures"] += 1
+        breaker["error"] = repr(error)[:200] if error else None
+        if before == "half_open" or breaker["failures"] >= BREAKER_THRESHOLD:
+            if before != "open":
+                breaker["trips"] += 1
+                log.warning(f"SmartPlex: {name} unavailable ({breaker['failures']} failures), skipped for {BREAKER_COOLDOWN} s")
+            breaker.update({"state": "open", "opened_at": time.time()})
+    if breaker["state"] != before or not ok: publish_breakers()
+
+def publish_breakers():
+    attrs = {}
+    for name, breaker in BREAKERS.items():
+        attrs[name] = dict(breaker)
+        if breaker["opened_at"]: attrs[name]["opened_at"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(breaker["opened_at"]))
+    healthy = all(breaker["state"] == "closed" for breaker in BREAKERS.values())
+    attrs["friendly_name"] = "SmartPlex health"
+    state.set("sensor.smartplex_health", "ok" if healthy else "degraded", new_attributes=attrs)
+
+# Direct play: the same request the Plex apps send when you press Play on another device
+async def direct_play(zone_config, payload, media_type):
+    # Play queue for the found item on the server, then playMedia to the zone's client through the server.
+    # Returns False when direct play does not apply or fails, the caller uses play_media then
+    global PLEX_MACHINE_ID, PLEX_COMMAND_ID
+    client_id = zone_config.get("plex_client_id")
+    if not DIRECT_PLAY or not client_id or "id" not in payload or payload.get("resume"): return False
+    if set(payload) - {"allow_multiple", "resume", "offset", "shuffle", "library_name", "id"}: return False
+    if not breaker_allows("plex"): return False
+    session = plex_session()
+    headers = {"X-Plex-Client-Identifier": "smartplex", "X-Plex-Target-Client-Identifier": client_id}
+    try:
+        if PLEX_MACHINE_ID is None:
+            async with session.get(f"{PLEX_URL}/identity?X-Plex-Token={PLEX_TOKEN}") as resp:
+                if resp.status != 200: return False
+                PLEX_MACHINE_ID = ET.fromstring(await resp.text()).get("machineIdentifier")
+        kind = "audio" if media_type == "MUSIC" else "video"
+        params = {"type": kind, "uri": f"server://{PLEX_MACHINE_ID}/com.plexapp.plugins.library/library/metadata/{payload['id']}",
+                  "shuffle": payload.get("shuffle", 0), "continuous": 1 if media_type == "EPISODE" else 0, "X-Plex-Token": PLEX_TOKEN}
+        async with session.post(f"{PLEX_URL}/playQueues", params=params, headers=headers) as resp:
+            if resp.status != 200: return False
+            queue = ET.fromstring(await resp.text())
+        # The selected queue item is the first track of an artist, the item itself otherwise
+        key = f"/library/metadata/{payload['id']}"
+        for node in queue:
+            if node.get("playQueueItemID") == queue.get("playQueueSelectedItemID"): key = node.get("key", key)
+        server = urlparse(PLEX_URL)
+        PLEX_COMMAND_ID += 1
+        params = {"key": key, "offset": 0, "type": kind, "machineIdentifier": PLEX_MACHINE_ID,
+                  "protocol": server.scheme, "address": server.hostname, "port": server.port or (443 if server.scheme == "https" else 32400),
+                  "containerKey": f"/playQueues/{queue.get('playQueueID')}?own=1&window=200",
+                  "commandID": PLEX_COMMAND_ID, "X-Plex-Token": PLEX_TOKEN}
+        async with session.get(f"{PLEX_URL}/player/playback/playMedia", params=params, headers=headers) as resp:
+            if resp.status != 200:
+                log.warning(f"SmartPlex: client {client_id} refused direct play (HTTP {resp.status}), using play_media")
+                return False
+        breaker_result("plex", True)
+        return True
+    except Exception as e:
+        log.warning(f"SmartPlex: direct play failed, using play_media: {repr(e)}")
+        breaker_result("plex", False, e)
+        return False
 
 # === 5. LOGIC ===
+def parse_command_locally(cmd, min_score=None):
+    # Returns the same control/query JSON as the AI, or None when the command is not a plain
+    # "<verb> [type] <title> [in <room>]" or the title match is below min_score (LOCAL_PARSER_MIN_SCORE)
+    min_score = LOCAL_PARSER_MIN_SCORE if min_score is None else min_score
+    words = command_words(cmd)
+
+    # Room is cut out together with "in the" before it
+    room, span = detect_room(words)
+    if span:
+        start = span[0]
+        for prefix in sorted(PARSER_WORDS["room_prefix"], key=len, reverse=True):
+            p = prefix.split()
+            if start >= len(p) and words[start - len(p):start] == p:
+                start -= len(p); break
+        words = words[:start] + words[span[1]:]
+
+    # Verbs in any order: "play", "resume", "shuffle", "play shuffled"...
+    verbs = set()
+    for _ in range(3):
+        for key in ["resume", "start", "shuffle"]:
+            found, words = take_phrase(words, key)
+            if found: verbs.add(key)
+    if not verbs: return None
+    resume, shuffle = "resume" in verbs, "shuffle" in verbs
+    m_type = None
+    for t in ["movie", "show", "music"]:
+        found, words = take_phrase(words, t)
+        if found: m_type = t; break
+    title = " ".join(words)
+    if not title: return None
+
+    matches = []
+    for t in [m_type] if m_type else ["movie", "show", "music"]:
+        item, score = match_in_cache(t, title)
+        if item and score >= min_score: matches.append((t, item))
+    # The same title in several libraries is for the AI to sort out
+    if len(matches) != 1: return None
+    m_type, item = matches[0]
+
+    query = {"movie": {"title": item["title"]}, "show": {"show_name": item["title"]}, "music": {"artist": item["title"]}}[m_type]
+    control = {"room": room, "type": m_type, "resume_mode": "resume" if resume else "start", "sort_order": "default", "shuffle": shuffle}
+    return {"control": control, "query": query}
+
+def command_words(cmd):
+    return re.sub(r"[^\w]+", " ", cmd.lower()).split()
+
+def detect_room(words):
+    # Room named in the command: the longest alias wins ("small room" over "room").
+    # Returns (room, (start, end) of the alias in words) or (None, None)
+    room, span = None, None
+    for key, zone in ZONES.items():
+        for alias in [key.replace("_", " ")] + zone.get("aliases", []):
+            a = alias.split()
+            for i in range(len(words) - len(a) + 1):
+                if words[i:i + len(a)] == a and (span is None or len(a) > span[1] - span[0]):
+                    room, span = key, (i, i + len(a))
+    return room, span
+
+def take_phrase(words, key):
+    # Cuts the longest PARSER_WORDS[key] phrase off the start of words
+    for phrase in sorted(PARSER_WORDS[key], key=len, reverse=True):
+        p = phrase.split()
+        if words[:len(p)] == p: return True, words[len(p):]
+    return False, words
+
+# AI answer schema: allowed control values and query fields
+AI_TYPES = ["movie", "show", "music", "music_video", "playlist"]
+AI_CHOICES = {"resume_mode": ["start", "resume"], "sort_order": ["default", "newest", "oldest", "top_rated", "random"]}
+AI_TEXT_FIELDS = ["title", "show_name", "artist", "album", "actor", "director", "genre", "studio", "collection", "country", "contentRating", "mood"]
+AI_NUMBER_FIELDS = ["season", "episode", "year", "decade"]
+
+def build_compact_prompt():
+    # Same text for every command, the command itself is appended at the end (providers cache the common prefix)
+    rooms = "; ".join([f"{', '.join(zone.get('aliases', [])) or key} -> {key}" for key, zone in ZONES.items()])
+    return (
+        "You are SmartPlex, a Plex voice command parser. Fill the fields for the user command.\n"
+        "type: movie, show (TV series), music, music_video (clips) or playlist.\n"
+        f"room: {rooms}.\n"
+        "resume_mode: resume for continue/finish/resume, otherwise start.\n"
+        f"sort_order: newest for fresh/new/latest (year={time.localtime().tm_year}), oldest for old/classic (year=2000), "
+        "top_rated for best/top/popular, random for any/something (shuffle=true), otherwise default.\n"
+        "shuffle: true for shuffle/mix or a generic request.\n"
+        "unwatched: true for unwatched/unseen/not watched yet.\n"
+        "Remove 4k/uhd/imax/hdr from titles. Shows: show_name, season, episode. Music: artist, album, title (song), mood. "
+        "Genres as standard English Plex names (Comedy, Action, Drama, Sci-Fi). Leave unknown fields empty.\n"
+    )
+
+def build_ai_structure():
+    # ai_task "structure": flat fields with HA selectors, normalize_ai_data splits them into control/query
+    structure = {
+        "room": {"required": True, "selector": {"select": {"options": list(ZONES)}}},
+        "type": {"required": True, "selector": {"select": {"options": AI_TYPES}}},
+        "shuffle": {"selector": {"boolean": {}}},
+        "unwatched": {"selector": {"boolean": {}}},
+    }
+    for field, options in AI_CHOICES.items():
+        structure[field] = {"selector": {"select": {"options": options}}}
+    for field in AI_TEXT_FIELDS: structure[field] = {"selector": {"text": {}}}
+    for field in AI_NUMBER_FIELDS: structure[field] = {"selector": {"number": {"mode": "box"}}}
+    return structure
+
+AI_PROMPT_STATIC = build_compact_prompt()
+AI_STRUCTURE = build_ai_structure()
+
+def normalize_ai_data(data):
+    # Any AI answer (JSON text, maybe wrapped in prose or ```json fences, or the structured dict; nested
+    # control/query or flat fields) -> {"control": {...}, "query": {...}} with every control field valid
+    # and only the filled query fields. Raises ValueError when there is no JSON object at all
+    if isinstance(data, str):
+        found = re.search(r"\{.*\}", data, re.S)
+        if not found: raise ValueError(f"no JSON in AI answer: {data[:100]}")
+        data = json.loads(found.group(0))
+    if not isinstance(data, dict): raise ValueError(f"AI answer is not a JSON object: {data}")
+    src_control = data["control"] if isinstance(data.get("control"), dict) else data
+    src_query = data["query"] if isinstance(data.get("query"), dict) else data
+
+    room = src_control.get("room")
+    control = {
+        "room": room if isinstance(room, str) and room in ZONES else next(iter(ZONES)),
+        "type": src_control.get("type") if src_control.get("type") in AI_TYPES else "movie",
+        "shuffle": ai_flag(src_control.get("shuffle")),
+    }
+    for field, options in AI_CHOICES.items():
+        control[field] = src_control.get(field) if src_control.get(field) in options else options[0]
+
+    query = {}
+    for field in AI_TEXT_FIELDS:
+        value = src_query.get(field)
+        if isinstance(value, (int, float)) and not isinstance(value, bool): value = str(value)
+        if isinstance(value, str) and value.strip() and value.strip().lower() not in ["...", "null", "none"]:
+            query[field] = value.strip()
+    for field in AI_NUMBER_FIELDS:
+        try: query[field] = int(float(src_query[field]))
+        except (KeyError, TypeError, ValueError): pass
+    if ai_flag(src_query.get("unwatched")): query["unwatched"] = True
+    return {"control": control, "query": query}
+
+def ai_flag(value):
+    # Booleans may come as text ("false", "yes")
+    if isinstance(value, str): return value.strip().lower() in ["true", "1", "yes"]
+    return bool(value)
+
+# Remembered AI answers: normalized command text -> control/query, least recently used first.
+# The fingerprint covers the prompt, ZONES and the AI entity, any change starts from scratch
+def intent_fingerprint(prompt_text):
+    text = json.dumps([prompt_text, ZONES, AI_ENTITY_ID], sort_keys=True, ensure_ascii=False)
+    return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+async def lookup_intent(key, fingerprint):
+    if INTENT_CACHE is None: await load_intent_cache()
+    if INTENT_CACHE["fingerprint"] != fingerprint:
+        INTENT_CACHE.update({"fingerprint": fingerprint, "entries": {}})
+    entries = INTENT_CACHE["entries"]
+    entry = entries.get(key)
+    # Expired answers stay until they are replaced or pushed out, stale_intent still uses them
+    if entry and time.time() - entry["at"] < INTENT_TTL:
+        entries[key] = entries.pop(key)  # Most recently used goes last
+        INTENT_CACHE["hits"] += 1
+    else:
+        entry = None
+        INTENT_CACHE["misses"] += 1
+    publish_intent_stats()
+    return entry["data"] if entry else None
+
+def stale_intent(key):
+    # Remembered answer of any age, for when the AI is unavailable
+    entry = INTENT_CACHE["entries"].get(key) if INTENT_CACHE else None
+    return entry["data"] if entry else None
+
+def remember_intent(key, data):
+    entries = INTENT_CACHE["entries"]
+    entries[key] = {"data": data, "at": time.time()}
+    while len(entries) > INTENT_CACHE_SIZE: del entries[next(iter(entries))]
+    task.create(save_intent_cache)
+
+async def load_intent_cache():
+    global INTENT_CACHE
+    INTENT_CACHE = await task.executor(read_snapshot, INTENT_PATH) or {"fingerprint": None, "entries": {}, "hits": 0, "misses": 0}
+
+async def save_intent_cache():
+    # Copy in the event loop, the executor thread must not see the dict change while pickling
+    data = dict(INTENT_CACHE)
+    data["entries"] = dict(INTENT_CACHE["entries"])
+    try: await save_snapshot(INTENT_PATH, data)
+    except Exception as e: log.warning(f"SmartPlex: remembered commands not saved: {e}")
+
+def publish_intent_stats():
+    hits, misses = INTENT_CACHE["hits"], INTENT_CACHE["misses"]
+    state.set("sensor.smartplex_intent_cache", len(INTENT_CACHE["entries"]),
+              new_attributes={"hits": hits, "misses": misses, "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None,
+                              "unit_of_measurement": "commands", "friendly_name": "SmartPlex remembered commands"})
+
+@service
+async def plex_smart_forget_commands():
+    # Forget every remembered AI answer, e.g. after the AI misunderstood a command
+    if INTENT_CACHE is None: await load_intent_cache()
+    INTENT_CACHE["entries"] = {}
+    publish_intent_stats()
+    await save_intent_cache()
+
 @service
 def plex_smart_launch(command_text=None):
     if not command_text: return
     task.create(smartplex_execution, cmd=command_text)
 
 async def smartplex_execution(cmd):
-    if not PLEX_LIBS: await update_plex_cache()
-
-    # === PROMPT ===
-    prompt = (
-        "You are SmartPlex, a Plex API driver. Output JSON only.\n"
-        "CLEANUP: Remove '4k', 'uhd', 'imax', 'hdr' from title.\n\n"
-        "1. HARD SCENARIOS (PRIORITY):\n"
-        "- 'fresh', 'new', 'latest' -> sort_order='newest', shuffle=false, year=2024 (do not leave year empty).\n"
-        "- 'old', 'classic', 'early' -> sort_order='oldest', year=2000 (approximate limit).\n"
-        "- 'best', 'top', 'popular' -> sort_order='top_rated'.\n"
-        "- 'Any', 'Random', 'Something' -> sort_order='random', shuffle=true.\n"
-        "- 'Linkin Park 2023' (Music + Year) -> {artist: 'Linkin Park', year: 2023}.\n\n"
-
-        "2. LANGUAGE RULES:\n"
-        "- Genres MUST be in English: 'Comedy', 'Action', 'Drama', 'Sci-Fi'.\n"
-        "- Use standard Plex genre names.\n\n"
-
-        "3. ZONES (room):\n"
-        "- 'living room', 'hall', 'main room' -> 'living_room'\n"
-        "- 'guest room', 'kids room', 'small room' -> 'guest_room'\n"
-        "- 'bedroom', 'bed' -> 'bedroom'\n\n"
+    global COMMAND_SEQ
+    COMMAND_SEQ += 1
+    seq = COMMAND_SEQ
+    trace = trace_start()
+    info = {"command": cmd, "parsed_by": "ai"}
+    # First download still running after a reload without snapshot: go on without the cache (server search)
+    try: await run_within(stage_deadline(trace, "cache"), ensure_plex_cache)
+    except asyncio.TimeoutError:
+        log.warning("SmartPlex: library cache not ready, searching on the Plex server")
+        info["degraded"] = ["cache"]
+    trace_span(trace, "cache")
+
+    # Simple commands are resolved from the cache, the AI is asked only when the local parser is not sure
+    data = parse_command_locally(cmd) if LOCAL_PARSER else None
+    trace_span(trace, "parse")
+    if data: info["parsed_by"] = "local"
+
+    spec_room, room_key, playing = None, None, False
+    try:
+        # Speculative boot: the TV in the room named in the command starts while the AI is thinking
+        if data is None and SPECULATIVE_BOOT:
+            spec_room = detect_room(command_words(cmd))[0]
+            if spec_room: claim_zone_boot(spec_room, seq)
+
+        # === PROMPT ===
+        prompt_rules = (
+            "You are SmartPlex, a Plex API driver. Output JSON only.\n"
+            "CLEANUP: Remove '4k', 'uhd', 'imax', 'hdr' from title.\n\n"
+            "1. HARD SCENARIOS (PRIORITY):\n"
+            "- 'fresh', 'new', 'latest' -> sort_order='newest', shuffle=false, year=2024 (do not leave year empty).\n"
+            "- 'old', 'classic', 'early' -> sort_order='oldest', year=2000 (approximate limit).\n"
+            "- 'best', 'top', 'popular' -> sort_order='top_rated'.\n"
+            "- 'Any', 'Random', 'Something' -> sort_order='random', shuffle=true.\n"
+            "- 'Linkin Park 2023' (Music + Year) -> {artist: 'Linkin Park', year: 2023}.\n\n"
+
+            "2. LANGUAGE RULES:\n"
+            "- Genres MUST be in English: 'Comedy', 'Action', 'Drama', 'Sci-Fi'.\n"
+            "- Use standard Plex genre names.\n\n"
+
+            "3. ZONES (room):\n"
+            "- 'living room', 'hall', 'main room' -> 'living_room'\n"
+            "- 'guest room', 'kids room', 'small room' -> 'guest_room'\n"
+            "- 'bedroom', 'bed' -> 'bedroom'\n\n"
         
-        "4. TYPES (type):\n"
-        "- 'movie': Movies.\n"
-        "- 'show': TV Shows / Series.\n"
-        "- 'music': Music.\n"
-        "- 'music_video': Music Videos / Clips.\n"
-        "- 'playlist': Playlists.\n\n"
-
-        "5. QUERY FILLING RULES:\n"
-        "--- MOVIE ---\n"
-        "   * ALLOWED: title, year, genre, actor, director, studio, collection, country, decade, contentRating.\n"
-        "--- SHOW ---\n"
-        "   * ALLOWED: show_name, season, episode, genre, year, studio.\n"
-        "--- MUSIC ---\n"
-        "   * ALLOWED: artist, album, title, year, genre, mood.\n"
-        "--- MUSIC_VIDEO ---\n"
-        "   * ALLOWED: artist.\n\n"
-
-        "6. CONTROLS (control):\n"
-        "- resume_mode: 'resume' (continue, finish, resume), 'start' (play, watch, start). DEFAULT: 'start'.\n"
-        "- sort_order: 'newest', 'oldest', 'top_rated', 'random', 'default'.\n"
-        "- shuffle: true (if 'shuffle', 'mix' or request is generic).\n\n"
+            "4. TYPES (type):\n"
+            "- 'movie': Movies.\n"
+            "- 'show': TV Shows / Series.\n"
+            "- 'music': Music.\n"
+            "- 'music_video': Music Videos / Clips.\n"
+            "- 'playlist': Playlists.\n\n"
+
+            "5. QUERY FILLING RULES:\n"
+            "--- MOVIE ---\n"
+            "   * ALLOWED: title, year, genre, actor, director, studio, collection, country, decade, contentRating.\n"
+            "--- SHOW ---\n"
+            "   * ALLOWED: show_name, season, episode, genre, year, studio.\n"
+            "--- MUSIC ---\n"
+            "   * ALLOWED: artist, album, title, year, genre, mood.\n"
+            "--- MUSIC_VIDEO ---\n"
+            "   * ALLOWED: artist.\n\n"
+
+            "6. CONTROLS (control):\n"
+            "- resume_mode: 'resume' (continue, finish, resume), 'start' (play, watch, start). DEFAULT: 'start'.\n"
+            "- sort_order: 'newest', 'oldest', 'top_rated', 'random', 'default'.\n"
+            "- shuffle: true (if 'shuffle', 'mix' or request is generic).\n\n"
         
-        "JSON OUTPUT:\n"
-        "{\n"
-        "  \"control\": { \"room\": \"...\", \"type\": \"...\", \"resume_mode\": \"start/resume\", \"sort_order\": \"...\", \"shuffle\": false },\n"
-        "  \"query\": { \"title\": \"...\", \"show_name\": \"...\", \"artist\": \"...\", \"album\": \"...\", \"season\": null, \"episode\": null, \"actor\": \"...\", \"genre\": \"...\", \"year\": null, \"studio\": \"...\", \"collection\": \"...\", \"decade\": null, \"contentRating\": \"...\", \"mood\": \"...\" }\n"
-        "}\n"
-        f"USER COMMAND: {cmd}"
-    )
+            "JSON OUTPUT:\n"
+            "{\n"
+            "  \"control\": { \"room\": \"...\", \"type\": \"...\", \"resume_mode\": \"start/resume\", \"sort_order\": \"...\", \"shuffle\": false },\n"
+            "  \"query\": { \"title\": \"...\", \"show_name\": \"...\", \"artist\": \"...\", \"album\": \"...\", \"season\": null, \"episode\": null, \"actor\": \"...\", \"genre\": \"...\", \"year\": null, \"studio\": \"...\", \"collection\": \"...\", \"decade\": null, \"contentRating\": \"...\", \"mood\": \"...\" }\n"
+            "}\n"
+        )
+        prompt = f"{prompt_rules}USER COMMAND: {cmd}"
 
-    try:
-        response = await service.call("ai_task", "generate_data", 
-                                      entity_id=AI_ENTITY_ID, 
-                                      task_name="SmartPlex", 
-                                      instructions=prompt, return_response=True)
-        data = json.loads(response.get('data', '').replace('```json', '').replace('```', '').strip())
+        # Same command as before with the same prompt and zones: the remembered answer, no AI call
+        intent_key = None
+        if data is None and INTENT_CACHE_SIZE:
+            intent_key = " ".join(command_words(cmd))
+            data = await lookup_intent(intent_key, intent_fingerprint(AI_PROMPT_STATIC if AI_COMPACT_PROMPT else prompt_rules))
+            if data: info["parsed_by"] = "memory"
+            trace_span(trace, "memory")
+
+        if data is None and breaker_allows("ai"):
+            if AI_COMPACT_PROMPT:
+                # Static rules first and the command last, the answer comes back in the AI_STRUCTURE fields
+                ai_args = {"instructions": f"{AI_PROMPT_STATIC}USER COMMAND: {cmd}", "structure": AI_STRUCTURE}
+            else:
+                ai_args = {"instructions": prompt}
+            try:
+                response = await run_within(stage_deadline(trace, "ai"), service.call, "ai_task", "generate_data", 
+                                            entity_id=AI_ENTITY_ID, 
+                                            task_name="SmartPlex", 
+                                            return_response=True, **ai_args)
+                data = response.get("data")
+                breaker_result("ai", True)
+            except Exception as e:
+                log.warning(f"SmartPlex: {AI_ENTITY_ID} did not answer: {repr(e)}")
+                breaker_result("ai", False, e)
+            trace_span(trace, "ai")
+        elif data is not None:
+            log.debug(f"SmartPlex: parsed locally, AI skipped: {data}")
+
+        if data is None:
+            # AI unavailable: the remembered answer even if it expired, otherwise the local parser with a lower bar
+            data = stale_intent(intent_key) if intent_key else None
+            info["parsed_by"] = "memory_stale"
+            if data is None and LOCAL_PARSER:
+                data = parse_command_locally(cmd, LOCAL_PARSER_FALLBACK_SCORE)
+                info["parsed_by"] = "local_fallback"
+            if data is None: info["parsed_by"] = None; raise RuntimeError(f"{AI_ENTITY_ID} unavailable and the command is not understood without it")
+            info.setdefault("degraded", []).append("ai")
+            log.warning(f"SmartPlex: AI unavailable, command parsed by {info['parsed_by']}: {data}")
         
-        control = data.get("control", {})
-        query = data.get("query", {})
+        data = normalize_ai_data(data)
+        if intent_key and info["parsed_by"] == "ai": remember_intent(intent_key, data)
+        control = data["control"]
+        query = data["query"]
         
-        room_key = control.get("room", "living_room")
-        if room_key not in ZONES: room_key = "living_room"
+        room_key = control["room"]
         zone = ZONES[room_key]
+        info.update({"room": room_key, "type": control["type"]})
         
-        hw_task = task.create(boot_hardware_process(zone))
+        if spec_room and spec_room != room_key:
+            # The AI picked another room: drop the guess (switched off again unless another command uses it)
+            log.debug(f"SmartPlex: speculative boot of {spec_room} not needed, AI chose {room_key}")
+            release_zone_boot(spec_room, seq)
+        if not claim_zone_command(room_key, seq):
+            info["error"] = "superseded"
+            log.debug(f"SmartPlex: a newer command for {room_key} is running, dropping '{cmd}'")
+            return
+        # Reuses the boot already running for this zone (speculative or from an earlier command)
+        hw_task = claim_zone_boot(room_key, seq)
         
         payload = {"allow_multiple": 1}
-        m_type = control.get("type", "movie")
+        m_type = control["type"]
         
-        if control.get("resume_mode") == "resume": payload["resume"] = 1
+        if control["resume_mode"] == "resume": payload["resume"] = 1
         else: payload["resume"] = 0; payload["offset"] = 0
 
-        sort_mode = control.get("sort_order", "default")
+        sort_mode = control["sort_order"]
         
         if sort_mode == "newest": 
             payload["sort"] = "originallyAvailableAt:desc"
@@ -232,7 +1534,7 @@ async def smartplex_execution(cmd):
         elif sort_mode == "top_rated": 
             payload["sort"] = "audienceRating:desc"
             payload["shuffle"] = 0
-        elif control.get("shuffle") or sort_mode == "random": 
+        elif control["shuffle"] or sort_mode == "random": 
             payload["shuffle"] = 1
 
         media_type = "MOVIE"
@@ -240,38 +1542,58 @@ async def smartplex_execution(cmd):
         # >>> SHOWS
         if m_type == "show":
             media_type = "EPISODE"
-            lib_data = PLEX_LIBS.get("show")
-            if lib_data: payload["library_name"] = lib_data["title"]
             
             s_name = query.get("show_name") or query.get("title")
-            cached = find_in_cache("show", s_name)
+            cached = await find_title("show", s_name)
+            lib_name = library_name("show", cached)
+            if lib_name: payload["library_name"] = lib_name
             exact_episode = query.get("episode")
-            
-            if cached:
-                if exact_episode: payload["show.id"] = cached["id"]
-                else: payload["show.title"] = cached["title"] 
+            resume = control["resume_mode"] == "resume"
+
+            # Exact episode or "resume X": the episode index gives the episode id, no search on the server
+            episode_key = None
+            if cached and (exact_episode or (resume and not query.get("season"))):
+                try: episode_key = await run_within(stage_deadline(trace, "match"), resolve_episode, cached, query)
+                except asyncio.TimeoutError as e:
+                    log.warning("SmartPlex: episode list not loaded in time, searching on the Plex server")
+                    breaker_result("plex", False, e)
+                    info.setdefault("degraded", []).append("episodes")
+
+            if episode_key:
+                payload["id"] = episode_key
             else:
-                if s_name: payload["show.title"] = s_name
+                if cached:
+                    if exact_episode: payload["show.id"] = cached["id"]
+                    else: payload["show.title"] = cached["title"] 
+                else:
+                    if s_name: payload["show.title"] = s_name
 
-            if query.get("season"): payload["season.index"] = int(query["season"])
-            if query.get("episode"): payload["episode.index"] = int(query["episode"])
-            
-            if not exact_episode and control.get("resume_mode") == "resume":
-                payload["episode.unwatched"] = 1 
-                payload["resume"] = 1
+                if query.get("season"): payload["season.index"] = int(query["season"])
+                if query.get("episode"): payload["episode.index"] = int(query["episode"])
+                
+                if not exact_episode and resume:
+                    payload["episode.unwatched"] = 1 
+                    payload["resume"] = 1
 
         # >>> MUSIC
         elif m_type == "music":
             media_type = "MUSIC"
-            lib_data = PLEX_LIBS.get("music")
-            if lib_data: payload["library_name"] = lib_data["title"]
             
             artist = query.get("artist")
-            cached = find_in_cache("music", artist)
+            cached = await find_title("music", artist)
+            lib_name = library_name("music", cached)
+            if lib_name: payload["library_name"] = lib_name
             
             filter_active = query.get("year") or query.get("album") or query.get("title") or query.get("genre") or query.get("mood")
+            # Song or album of a known artist: looked up among that artist's tracks / albums
+            tier_item = None
+            if cached and not (query.get("year") or query.get("genre") or query.get("mood")):
+                if query.get("title"): tier_item = find_by_artist("track", cached, query["title"])
+                elif query.get("album"): tier_item = find_by_artist("album", cached, query["album"])
             
-            if cached and not filter_active:
+            if tier_item:
+                payload["id"] = tier_item["id"]
+            elif cached and not filter_active:
                 payload["id"] = cached["id"]
                 payload["shuffle"] = 1
             else:
@@ -286,11 +1608,11 @@ async def smartplex_execution(cmd):
         # >>> MUSIC VIDEOS
         elif m_type == "music_video":
             media_type = "MUSIC" 
-            lib_data = PLEX_LIBS.get("music")
-            if lib_data: payload["library_name"] = lib_data["title"]
             
             artist = query.get("artist")
-            cached = find_in_cache("music", artist)
+            cached = await find_title("music", artist)
+            lib_name = library_name("music", cached)
+            if lib_name: payload["library_name"] = lib_name
             
             if cached:
                 payload["id"] = cached["id"]
@@ -302,14 +1624,36 @@ async def smartplex_execution(cmd):
         # >>> MOVIES
         elif m_type == "movie":
             media_type = "MOVIE"
-            lib_data = PLEX_LIBS.get("movie")
-            if lib_data: payload["library_name"] = lib_data["title"]
             
             f_title = query.get("title")
             has_filters = query.get("actor") or query.get("genre") or query.get("studio") or query.get("collection") or query.get("decade")
+            cached = await find_title("movie", f_title) if f_title and not has_filters else None
+            # Newest / oldest / top rated / random movie and nothing else to filter by: picked from the cache
+            pick_mode = "random" if sort_mode == "default" and control["shuffle"] else sort_mode
+            if not f_title and pick_mode != "default" and not set(query) - {"unwatched"}:
+                cached = pick_in_cache("movie", pick_mode, query.get("unwatched"))
+            elif not f_title:
+                # Filters: matching movies from the facet index, misspelled values corrected. One match
+                # (not for actor / director, the cache only has part of them), or a sort / random pick among
+                # the matches, plays by id; otherwise the server gets the corrected filters and plays all matches as before
+                filtered = filter_in_cache("movie", query)
+                if filtered:
+                    found, corrected = filtered
+                    if corrected:
+                        log.debug(f"SmartPlex: filters corrected {corrected}")
+                        query = dict(query, **corrected)
+                    single = sum(len(positions) for _, _, positions in found) == 1 and not set(query) & set(FACET_PARTIAL)
+                    if pick_mode != "default" or single:
+                        cached = pick_among(found, pick_mode)
+            if cached and not f_title:
+                payload.pop("sort", None)
+                payload["shuffle"] = 0
+            lib_name = library_name("movie", cached)
+            if lib_name: payload["library_name"] = lib_name
             
-            if f_title and not has_filters:
-                cached = find_in_cache("movie", f_title)
+            if cached and not f_title:
+                payload["id"] = cached["id"]
+            elif f_title and not has_filters:
                 if cached: payload["id"] = cached["id"]
                 else: payload["title"] = f_title
             else:
@@ -329,30 +1673,210 @@ async def smartplex_execution(cmd):
         elif m_type == "playlist":
             media_type = "PLAYLIST"
             p_title = query.get("title")
-            await hw_task
+            trace_span(trace, "match")
+            client = await wait_for_boot(hw_task, stage_deadline(trace, "hardware"))
+            trace_span(trace, "hardware")
+            info["device"] = device_timings(client)
+            if client.get("deadline"): info.setdefault("degraded", []).append("hardware")
+            if not client["found"]: log.warning(f"SmartPlex: {zone['plex_client']} did not appear in {client['elapsed']:.0f} s, trying anyway")
             target_dev = zone.get("plex_device_id")
             target_ent = zone.get("plex_client")
-            await service.call("media_player", "play_media", 
-                               device_id=target_dev, entity_id=target_ent,
-                               media_content_id=json.dumps({"playlist_name": p_title, "shuffle": 1}), 
-                               media_content_type="PLAYLIST")
+            playing = True
+            await run_within(stage_deadline(trace, "play"), service.call, "media_player", "play_media", 
+                             device_id=target_dev, entity_id=target_ent,
+                             media_content_id=json.dumps({"playlist_name": p_title, "shuffle": 1}), 
+                             media_content_type="PLAYLIST")
+            trace_span(trace, "play_media")
             return
 
         # 3. FINAL EXECUTION
-        await hw_task 
+        trace_span(trace, "match")
+        client = await wait_for_boot(hw_task, stage_deadline(trace, "hardware"))
+        trace_span(trace, "hardware")
+        info["device"] = device_timings(client)
+        if client.get("deadline"): info.setdefault("degraded", []).append("hardware")
+        if not client["found"]: log.warning(f"SmartPlex: {zone['plex_client']} did not appear in {client['elapsed']:.0f} s, trying anyway")
         log.debug(f"SmartPlex Payload: {payload}")
         target_dev = zone.get("plex_device_id")
         target_ent = zone.get("plex_client") if not target_dev else None
         
-        await service.call("media_player", "play_media", 
-                           device_id=target_dev, entity_id=target_ent,
-                           media_content_id=json.dumps(payload), 
-                           media_content_type=media_type)
+        # From here on the TV stays on: a play request that times out may still start playback
+        playing = True
+        # Direct play gets its share of the play deadline, play_media whatever is left
+        play_deadline, play_started = stage_deadline(trace, "play"), time.monotonic()
+        try: direct = await run_within(play_deadline * DIRECT_PLAY_SHARE, direct_play, zone, payload, media_type)
+        except asyncio.TimeoutError as e:
+            log.warning("SmartPlex: direct play timed out, using play_media")
+            breaker_result("plex", False, e)
+            direct = False
+        info["dispatch"] = "direct" if direct else "play_media"
+        if info["dispatch"] == "play_media":
+            await run_within(max(play_deadline - (time.monotonic() - play_started), 0.1), service.call, "media_player", "play_media", 
+                             device_id=target_dev, entity_id=target_ent,
+                             media_content_id=json.dumps(payload), 
+                             media_content_type=media_type)
+        trace_span(trace, "play_media")
 
+    except asyncio.CancelledError:
+        # A newer command for the same zone took over
+        info["error"] = "superseded"
+        raise
     except Exception as e:
+        info["error"] = str(e)
         log.error(f"SmartPlex Error: {e}")
+    finally:
+        # Superseded, failed or dropped before playing: boots only this command wanted are stopped or rolled back
+        if not playing:
+            for room in {spec_room, room_key}:
+                if room: release_zone_boot(room, seq)
+        publish_command_trace(trace, info)
+
+# === 6. TIMINGS ===
+# Each command is timed stage by stage: "spans" run one after another and add up to the total,
+# "device" shows how long the TV took in the background (boot, app start, client scan)
+def trace_start():
+    now = time.monotonic()
+    return {"at": time.strftime("%Y-%m-%d %H:%M:%S"), "start": now, "mark": now, "spans": {}}
+
+def trace_span(trace, stage):
+    # Time since the previous span, in ms
+    now = time.monotonic()
+    trace["spans"][stage] = trace["spans"].get(stage, 0) + round((now - trace["mark"]) * 1000)
+    trace["mark"] = now
+
+def device_timings(client):
+    return {"boot": round(client.get("boot", 0) * 1000), "app": round(client.get("app", 0) * 1000),
+            "scan": round(client["elapsed"] * 1000), "scans": client["scans"], "found": client["found"]}
+
+def publish_command_trace(trace, info):
+    entry = dict(info)
+    entry.update({"at": trace["at"], "total_ms": round((time.monotonic() - trace["start"]) * 1000), "spans": trace["spans"]})
+    TRACE_COMMANDS.append(entry)
+    del TRACE_COMMANDS[:-TRACE_HISTORY]
+    attrs = dict(entry)
+    attrs.update({"history": list(TRACE_COMMANDS), "unit_of_measurement": "ms", "friendly_name": "SmartPlex last command"})
+    state.set("sensor.smartplex_last_command", entry["total_ms"], new_attributes=attrs)
+    if TRACE_LOG: log.info(f"SmartPlex trace: {json.dumps(entry, ensure_ascii=False)}")
+
+def publish_cache_stats(mode, started, changed):
+    # mode: "full" download, "delta" refresh or "snapshot" load; changed: library types that got new data
+    counts = {l_type: cache_count(l_type) for l_type in PLEX_CACHE}
+    sections = {lib_info["title"]: cache_size(PLEX_CACHE.get(l_type, {}).get(lib_info["id"]))
+                for l_type, libs in PLEX_LIBS.items() for lib_info in libs}
+    stats = {"mode": mode, "duration_ms": round((time.monotonic() - started) * 1000), "changed": changed,
+             "items": counts, "sections": sections, "at": time.strftime("%Y-%m-%d %H:%M:%S")}
+    attrs = dict(stats)
+    attrs.update({"unit_of_measurement": "items", "friendly_name": "SmartPlex cache"})
+    state.set("sensor.smartplex_cache", sum(counts.values()), new_attributes=attrs)
+    if TRACE_LOG: log.info(f"SmartPlex cache: {json.dumps(stats)}")
 
 @time_trigger('startup')
 @time_trigger('cron(0 * * * *)') 
 async def cron_cache():
+    # Serve commands from the snapshot right away, the refresh below brings it up to date
+    await ensure_plex_cache()
+    if ZONE_TIMINGS is None: await load_zone_timings()
+    if INTENT_CACHE is None: await load_intent_cache()
+    # sensor.smartplex_health lists both breakers from the start
+    for name in ["plex", "ai"]: breaker_state(name)
+    publish_breakers()
+    # While the notification stream is up it keeps the cache current, polling is only the fallback
+    if NOTIFY_STATE["connected"]: return
     await update_plex_cache()
+
+@time_trigger('shutdown')
+async def close_plex_session():
+    global PLEX_SESSION
+    if PLEX_SESSION is not None:
+        await PLEX_SESSION.close()
+        PLEX_SESSION = None
+
+# === 7. SERVER NOTIFICATIONS ===
+# The Plex server announces library changes on a websocket. Each change reaches the cache within
+# seconds through a delta refresh, deletions through the section size check of refresh_section
+@time_trigger('startup')
+async def plex_notifications():
+    # Runs for the whole script lifetime. After a drop it reconnects with growing pauses
+    # (NOTIFY_BACKOFF_MIN doubled up to NOTIFY_BACKOFF_MAX), cron_cache polls meanwhile
+    if not LIVE_UPDATES: return
+    task.unique("smartplex_notifications")
+    backoff = NOTIFY_BACKOFF_MIN
+    while True:
+        connected_at = time.monotonic()
+        try:
+            url = f"{PLEX_URL}/:/websockets/notifications?X-Plex-Token={PLEX_TOKEN}"
+            async with plex_session().ws_connect(url, heartbeat=NOTIFY_HEARTBEAT) as ws:
+                publish_notify_state(True)
+                # Whatever changed while the stream was down is picked up by the first refresh
+                queue_notifications(None)
+                while True:
+                    msg = await ws.receive()
+                    if msg.type != aiohttp.WSMsgType.TEXT: break
+                    queue_notifications(msg.data)
+            log.debug("SmartPlex: notification stream closed by the server")
+        except Exception as e:
+            log.warning(f"SmartPlex: notification stream unavailable, hourly refresh until it is back: {type(e).__name__} {e}")
+        publish_notify_state(False)
+        # A connection that lasted a while starts over from the shortest pause
+        if time.monotonic() - connected_at > NOTIFY_BACKOFF_MAX: backoff = NOTIFY_BACKOFF_MIN
+        await task.sleep(backoff * random.uniform(0.5, 1.0))
+        backoff = min(backoff * 2, NOTIFY_BACKOFF_MAX)
+
+def queue_notifications(text):
+    # text: one notification message, None = refresh anyway. Changes wait in NOTIFY_PENDING for apply_notifications
+    global NOTIFY_PENDING, NOTIFY_APPLY
+    if NOTIFY_PENDING is None: NOTIFY_PENDING = {"changes": 0, "deleted": set(), "episodes": False}
+    if text is not None and not read_timeline(text, NOTIFY_PENDING): return
+    if text is None: NOTIFY_PENDING["changes"] += 1
+    if NOTIFY_APPLY is None or NOTIFY_APPLY.done(): NOTIFY_APPLY = task.create(apply_notifications)
+
+async def apply_notifications():
+    # A library scan sends bursts of changes: they are collected for NOTIFY_DEBOUNCE seconds and applied
+    # by one delta refresh. Sections with deletions get their size checked right away
+    global NOTIFY_PENDING
+    while NOTIFY_PENDING and NOTIFY_PENDING["changes"]:
+        await task.sleep(NOTIFY_DEBOUNCE)
+        pending, NOTIFY_PENDING = NOTIFY_PENDING, None
+        # A refresh that started before these changes would not see them, and its section jobs would
+        # write back the sync points they read: the deletion checks are set once it is done
+        while PLEX_REFRESH is not None and not PLEX_REFRESH.done(): await asyncio.shield(PLEX_REFRESH)
+        for key, sync in PLEX_SYNC.items():
+            if key.split(":")[0] in pending["deleted"] or "" in pending["deleted"]: PLEX_SYNC[key] = dict(sync, reconciled_at=0)
+        if pending["episodes"]: EPISODE_INDEX.clear()
+        await update_plex_cache()
+        NOTIFY_STATE["changes"] += pending["changes"]
+        NOTIFY_STATE["refreshes"] += 1
+        publish_notify_state(NOTIFY_STATE["connected"])
+
+def publish_notify_state(connected):
+    if connected and not NOTIFY_STATE["connected"]:
+        NOTIFY_STATE.update({"since": time.strftime("%Y-%m-%d %H:%M:%S"), "connects": NOTIFY_STATE["connects"] + 1})
+    NOTIFY_STATE["connected"] = connected
+    attrs = dict(NOTIFY_STATE)
+    attrs["friendly_name"] = "SmartPlex notifications"
+    state.set("sensor.smartplex_notifications", "connected" if connected else "disconnected", new_attributes=attrs)
+
+@pyscript_compile
+def read_timeline(text, pending):
+    # Library changes in one notification ({"NotificationContainer": {"type": "timeline", "TimelineEntry": [...]}}).
+    # Finished items (state 5) count as changes, deleted ones (state 9) also mark their section for the
+    # size check, episodes drop the loaded episode lists. Returns how many entries counted
+    try: data = json.loads(text)
+    except ValueError: return 0
+    container = data.get("NotificationContainer") if isinstance(data, dict) else None
+    if not isinstance(container, dict): return 0
+    if container.get("type") == "playing":
+        # A stopped playback may have changed watched state, the delta refresh reads it
+        count = sum(1 for entry in container.get("PlaySessionStateNotification", []) if entry.get("state") == "stopped")
+        pending["changes"] += count
+        return count
+    if container.get("type") != "timeline": return 0
+    count = 0
+    for entry in container.get("TimelineEntry", []):
+        if entry.get("identifier") != "com.plexapp.plugins.library" or entry.get("type") not in NOTIFY_TYPES: continue
+        if entry.get("state") == 9: pending["deleted"].add(str(entry.get("sectionID", "")))
+        elif entry.get("state") != 5: continue
+        if entry.get("type") == 4: pending["episodes"] = True
+        count += 1
+    pending["changes"] += count
+    return count
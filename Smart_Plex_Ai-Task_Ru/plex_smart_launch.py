@@ -1,15 +1,29 @@
+import os
+import re
 import json
+import pickle
+import tempfile
 import aiohttp
+import asyncio
 import random
+import time
+import heapq
+import hashlib
 import xml.etree.ElementTree as ET
-from difflib import SequenceMatcher
+from urllib.parse import urlparse
+from array import array
+from bisect import insort
+from collections import Counter
+from difflib import SequenceMatcher, get_close_matches
 
 # =================================================================================
 # SCRIPT: plex_smart_launch
-# VERSION: v5.4
+# VERSION: v5.28
 # CHANGES:
-#   - FIX: Сканирование клиентов теперь в цикле.
-#          Скрипт ждет до 30 секунд, пока плеер не появится, нажимая Scan каждые 3 сек.
+#   - PERF: Живое обновление библиотеки. Скрипт слушает websocket уведомлений сервера Plex:
+#           добавленные, измененные и удаленные элементы попадают в кэш за секунды через дельта-
+#           обновление. Ежечасный опрос идет, только пока поток недоступен, а поток переподключается
+#           с растущими паузами. Состояние в sensor.smartplex_notifications (LIVE_UPDATES = False — выключить).
 # =================================================================================
 
 # === 1. НАСТРОЙКИ === Нужно заменить на свои
@@ -18,27 +32,97 @@ PLEX_TOKEN = "XyZ987PvQgRtLmNoKjHs"               # Вствьте свой То
 PLEX_SCAN_BUTTON = "button.plex_190_scan_clients" # Кнопка Сканирование клиентов Найдёте в интеграции Plex Serve
 VERIFY_SSL = False 
 AI_ENTITY_ID = "ai_task.google_ai_task"           # Укажите свой Ai Task
+AI_COMPACT_PROMPT = True                          # Короткий промпт + JSON-схема (меньше токенов, быстрее). False = полный промпт в разделе 5
+DIRECT_PLAY = True                                # Запускать найденное через сервер Plex (зоны с plex_client_id). False = всегда play_media
+TRACE_LOG = False                                 # True = писать в лог время каждой команды и обновления кеша в JSON
+TRACE_HISTORY = 10                                # Сколько команд хранить в атрибутах sensor.smartplex_last_command
+LIVE_UPDATES = True                               # Следить за изменениями библиотеки по уведомлениям сервера Plex. False = только ежечасное обновление
 
 # Кэш (Не нуждается в правке/настройке)
-PLEX_LIBS = {} 
-PLEX_CACHE = {"movie": [], "show": [], "music": []}
+PLEX_LIBS = {}                                       # тип -> [{"id", "title"}] всех разделов этого типа
+PLEX_CACHE = {}                                      # тип -> id раздела -> колонки, см. new_columns() (элементы читает cache_item)
+PLEX_INDEX = {}                                      # тип -> id раздела -> триграммный индекс поиска, артист -> позиции для уровней музыки
+FACET_TAGS = {"Genre": "genre", "Role": "actor",     # Теги фильмов, индексируемые как фильтры -> поле запроса
+              "Director": "director", "Collection": "collection", "Country": "country"}
+FACET_ATTRS = ["studio", "contentRating"]            # Атрибуты фильмов, индексируемые как фильтры
+FACET_PARTIAL = ["actor", "director"]                # Фильтры, которые список раздела содержит не полностью (главные роли): одно совпадение в кэше — не все
+FACET_MIN_SCORE = 0.8                                # Насколько значение фильтра с опечаткой должно быть близко к известному
+MUSIC_TIERS = ["album", "track"]                     # Уровни музыки, кэшируемые под артистами ([] = только артисты)
+TIER_TYPES = {"album": 9, "track": 10}               # Номера типов Plex для уровней музыки
+INDEX_CANDIDATES = 64                                # Сколько кандидатов из индекса проверяется полностью
+INDEX_TRUST_SCORE = 0.8                              # Если кандидаты из индекса набрали меньше, проверяем полным перебором
+SERVER_SEARCH_TIMEOUT = 1.5                          # Сколько (сек) может длиться поиск на сервере Plex, когда кэш не уверен (0 = только кэш)
+SERVER_SEARCH_LIMIT = 10                             # Результатов поиска на сервере на каждый тип
+PLEX_SYNC = {}                                       # id раздела -> последние updatedAt / lastViewedAt и прочитанные в это время элементы, время проверки удалений
+RECONCILE_INTERVAL = 24 * 3600                       # Как часто (сек) проверять разделы на удаленные элементы
+PAGE_SIZE = 500                                      # Элементов за один запрос при чтении раздела
+CHUNK_SIZE = 64 * 1024                               # Сколько байт за раз отдается XML-парсеру
+FETCH_CONCURRENCY = 3                                # Сколько разделов скачивается параллельно
+PLEX_SESSION = None                                  # Общая HTTP-сессия к серверу Plex
+PLEX_MACHINE_ID = None                               # machineIdentifier сервера для прямого запуска, читается один раз из /identity
+PLEX_COMMAND_ID = 0                                  # commandID последней команды плееру, отправленной клиенту
+SNAPSHOT_PATH = "/config/smartplex_cache.pickle"     # Копия кэша на диске для мгновенного старта
+SNAPSHOT_VERSION = 5                                 # Увеличить при изменении структуры кэша
+SNAPSHOT_SAVES = {}                                  # путь -> самые новые данные, ждущие запущенный save_snapshot
+PLEX_REFRESH = None                                  # Текущее обновление кэша, общее для всех вызовов
+PLEX_WARMUP = None                                   # Текущая загрузка снимка / первая загрузка
+SCAN_TIMEOUT = 30                                    # Сколько (сек) ждать появления клиента Plex
+SCAN_FIRST_GAP = 1                                   # Пауза после первого нажатия Scan, удваивается после каждого нажатия
+SCAN_MAX_GAP = 8                                     # Максимальная пауза между нажатиями Scan
+ZONE_TIMINGS = None                                  # зона -> {"boot": [сек...], "app": [сек...]}, измеренные
+TIMINGS_PATH = "/config/smartplex_timings.pickle"    # Измеренные времена на диске
+TIMING_SAMPLES = 20                                  # Сколько измерений хранить на зону и этап
+TIMING_MIN_SAMPLES = 3                               # Пока измерений меньше, используются паузы из настроек
+TIMING_PERCENTILE = 0.9                              # Предел ожидания = этот перцентиль измерений...
+TIMING_MARGIN = 1.25                                 # ...умноженный на этот запас
+TRACE_COMMANDS = []                                  # Время последних TRACE_HISTORY команд
+EPISODE_INDEX = {}                                   # id сериала -> его серии, загружаются при первом обращении (load_episode_index)
+EPISODE_TTL = 6 * 3600                               # Сколько (сек) доверять загруженному списку серий
+INTENT_CACHE = None                                  # Запомненные ответы ИИ и счетчики попаданий/промахов, загружаются из INTENT_PATH
+INTENT_PATH = "/config/smartplex_intents.pickle"     # Запомненные ответы ИИ на диске
+INTENT_CACHE_SIZE = 200                              # Сколько команд помнить, давно не использованные удаляются (0 = всегда спрашивать ИИ)
+INTENT_TTL = 7 * 24 * 3600                           # Сколько (сек) использовать запомненный ответ
+COMMAND_SEQ = 0                                      # Номер команды в порядке поступления
+ZONE_COMMANDS = {}                                   # комната -> последняя команда {"seq", "task"}
+ZONE_BOOTS = {}                                      # комната -> последнее включение {"task", "users", "was_off"}
+COMMAND_BUDGET = 90                                  # Наибольшее время (сек) команды от начала до запуска
+STAGE_DEADLINES = {"cache": 5, "ai": 20,             # Наибольшее время (сек) каждого этапа, не больше остатка бюджета
+                   "match": 5, "hardware": 60, "play": 15}
+DIRECT_PLAY_SHARE = 0.5                              # Доля дедлайна запуска для прямого воспроизведения, остаток получает play_media
+PLEX_CONNECT_TIMEOUT = 5                             # HTTP к Plex: таймаут соединения (сек)...
+PLEX_READ_TIMEOUT = 20                               # ...и наибольшая пауза (сек) при чтении ответа
+BREAKERS = {}                                        # "plex" / "ai" -> состояние автоматического выключателя, см. breaker_allows()
+BREAKER_THRESHOLD = 3                                # Сколько сбоев подряд размыкают выключатель
+BREAKER_COOLDOWN = 60                                # Сколько (сек) разомкнутый выключатель пропускает сервис до новой попытки
+NOTIFY_STATE = {"connected": False, "since": None,   # Состояние потока уведомлений, показывается в sensor.smartplex_notifications
+                "connects": 0, "changes": 0, "refreshes": 0}
+NOTIFY_PENDING = None                                # Объявленные, но еще не примененные изменения библиотеки, см. read_timeline()
+NOTIFY_APPLY = None                                  # Выполняющийся apply_notifications
+NOTIFY_TYPES = [1, 2, 4, 8, 9, 10]                   # Типы Plex, меняющие кэш: фильм, сериал, серия, артист, альбом, трек
+NOTIFY_DEBOUNCE = 2                                  # Столько (сек) изменения собираются перед одним дельта-обновлением
+NOTIFY_HEARTBEAT = 30                                # Пинг (сек), по которому обнаруживается мертвое соединение уведомлений
+NOTIFY_BACKOFF_MIN = 1                               # Первая пауза (сек) перед переподключением, удваивается после каждой неудачи...
+NOTIFY_BACKOFF_MAX = 300                             # ...до этой
 
 # === 2. ЗОНЫ === Укажите свои идентификаторы/сущности и названия Зон (зал, малая_спальня, спальня)
 ZONES = {
     "зал": {
         "plex_client": "media_player.plex_plex_for_apple_tv_apple_tv", 
-        "plex_device_id": "2d3845d40607xxxxxxxxxxxxxf77ac3299ae", 
-        "hardware_device_id": "84971b66xxxxxxxxxxxxxe9edd1f3d6a", 
+        "plex_device_id": "2d3845xxxxxxxxxxxxxxxxxxxx7ac3299ae", 
+        "plex_client_id": "",                # Необязательно, для DIRECT_PLAY: clientIdentifier приложения Plex (plex.tv/devices.xml)
+        "hardware_device_id": "84971xxxxxxxxxxxxx999e9edd1f3d6a", 
         "hardware_entity": "media_player.apple_tv_4k", 
         "power_method": "apple_tv_device",   # Не править или замените в коде ниже
-        "boot_delay": 2, "app_load_delay": 6 # Время необходимое на запуск ТВ и Приложения Plex
+        "boot_delay": 2, "app_load_delay": 6, # Максимальное время на запуск ТВ и Приложения Plex, пока не измерено реальное
+        "aliases": ["зал", "зале", "гостиная", "гостиной"]  # Как комната называется в командах (строчными буквами)
     },
     "малая_спальня": {
         "plex_client": "media_player.plex_plex_for_lg_lg_oled42c2rlb",
         "hardware_device_id": "d025f3fxxxxxxxxxxxxxxa8128644844", 
         "hardware_entity": "media_player.lg_webos_tv_oled42c2rlb",
         "power_method": "lg_device",          # Не править или замените в коде ниже
-        "boot_delay": 6, "app_load_delay": 12     
+        "boot_delay": 6, "app_load_delay": 12,
+        "aliases": ["малой спальне", "малая", "малой", "детская", "детской"]
     },
     "спальня": {
         "plex_client": "media_player.plex_plex_for_samsung_tv_2019",
@@ -46,62 +130,806 @@ ZONES = {
         "remote_entity": "remote.samsung_the_frame_49_qe49ls03rauxru",
         "hardware_entity": "media_player.samsung_the_frame_49_qe49ls03rauxru", 
         "power_method": "samsung_remote",     # Не править или замените в коде ниже
-        "boot_delay": 6, "app_load_delay": 15
+        "boot_delay": 6, "app_load_delay": 15,
+        "aliases": ["спальня", "спальне", "спальню"]
     }
 }
+
+# === ЛОКАЛЬНЫЙ РАЗБОР === Простые команды ("включи Начало в спальне") разбираются без ИИ
+LOCAL_PARSER = True                # False = всегда спрашивать ИИ
+LOCAL_PARSER_MIN_SCORE = 0.9       # Насколько точно должно совпасть название, чтобы обойтись без ИИ
+LOCAL_PARSER_FALLBACK_SCORE = 0.7  # То же, пока ИИ недоступен (таймауты, ошибки)
+SPECULATIVE_BOOT = True            # Включать ТВ названной в команде комнаты, не дожидаясь ответа ИИ
+PARSER_WORDS = {                   # Строчными буквами
+    "start": ["включи", "запусти", "поставь", "покажи", "воспроизведи"],
+    "resume": ["продолжи", "досмотри", "продолжи смотреть"],
+    "shuffle": ["перемешай", "вперемешку"],
+    "movie": ["фильм"],
+    "show": ["сериал"],
+    "music": ["музыку", "музыка", "песни"],
+    "room_prefix": ["в", "во", "на"]
+}
 # ======== Конец настроек, Дальше можно править только Промт ========
 
 
 # === 3. АВТО-ПОИСК БИБЛИОТЕК И КЭШ ===
-async def update_plex_cache():
-    global PLEX_CACHE, PLEX_LIBS
-    conn = aiohttp.TCPConnector(ssl=VERIFY_SSL)
-    async with aiohttp.ClientSession(connector=conn) as session:
+async def update_plex_cache(full=False):
+    # Single flight: кто пришел во время обновления, ждет именно его, а не запускает новое
+    global PLEX_REFRESH
+    if PLEX_REFRESH is None or PLEX_REFRESH.done():
+        PLEX_REFRESH = task.create(build_plex_cache, full)
+    await asyncio.shield(PLEX_REFRESH)
+
+async def ensure_plex_cache():
+    # Пустой кэш после перезагрузки: берем снимок, если он есть, иначе ждем загрузку
+    global PLEX_WARMUP
+    if PLEX_LIBS: return
+    if PLEX_WARMUP is None or PLEX_WARMUP.done():
+        PLEX_WARMUP = task.create(warm_plex_cache)
+    await asyncio.shield(PLEX_WARMUP)
+
+async def warm_plex_cache():
+    if not await load_cache_snapshot(): await update_plex_cache()
+
+async def build_plex_cache(full):
+    global PLEX_CACHE, PLEX_LIBS, PLEX_INDEX, PLEX_SYNC
+    started = time.monotonic()
+    # Сервер недоступен или завис: команды пользуются текущим кэшем, следующее обновление попробует снова
+    if not breaker_allows("plex"):
+        log.debug("SmartPlex: Plex server unavailable, cache refresh skipped")
+        return
+    session = plex_session()
+    libs = {}
+    try:
+        url_libs = f"{PLEX_URL}/library/sections?X-Plex-Token={PLEX_TOKEN}"
+        async with session.get(url_libs) as resp:
+            if resp.status != 200: raise RuntimeError(f"HTTP {resp.status}")
+            root = ET.fromstring(await resp.text())
+            for directory in root.findall(".//Directory"):
+                l_type = directory.get("type")
+                if l_type == "artist": l_type = "music"
+                if l_type in ["movie", "show", "music"]:
+                    libs.setdefault(l_type, []).append({"id": directory.get("key"), "title": directory.get("title")})
+    except Exception as e:
+        log.warning(f"SmartPlex: library sections not read, cache kept as is: {repr(e)}")
+        breaker_result("plex", False, e)
+        return
+    breaker_result("plex", True)
+    if not libs: return
+
+    # Каждый раздел (и каждый уровень музыки каждого музыкального раздела) - отдельная часть кэша со своей задачей,
+    # все загружаются одновременно, FETCH_CONCURRENCY ограничивает параллельные запросы к серверу
+    limiter = asyncio.Semaphore(FETCH_CONCURRENCY)
+    parts = [(l_type, lib_info) for l_type, sections in libs.items() for lib_info in sections]
+    parts += [(tier, lib_info) for lib_info in libs.get("music", []) for tier in MUSIC_TIERS]
+    jobs = {task.create(refresh_section, session, limiter, l_type, lib_info, full) for l_type, lib_info in parts}
+    done, _ = await task.wait(jobs)
+
+    # Подменяем все за один шаг, find_in_cache никогда не видит недостроенный кэш.
+    # Части кэша разделов, которых больше нет на сервере, удаляются
+    ids = {lib_info["id"] for _, lib_info in parts}
+    cache = {t: {k: v for k, v in shards.items() if k in ids} for t, shards in PLEX_CACHE.items()}
+    index = {t: {k: v for k, v in shards.items() if k in ids} for t, shards in PLEX_INDEX.items()}
+    sync = {k: v for k, v in PLEX_SYNC.items() if k.split(":")[0] in ids}
+    mode = "full" if full or not PLEX_SYNC else "delta"
+    changed = set()
+    for job in done:
+        result = job.result()
+        if not result: continue
+        sync[result["id"]] = result["sync"]
+        if result["items"] is None: continue
+        cache.setdefault(result["type"], {})[result["section"]] = result["items"]
+        index.setdefault(result["type"], {})[result["section"]] = result["index"]
+        changed.add(result["type"])
+    PLEX_LIBS, PLEX_CACHE, PLEX_INDEX, PLEX_SYNC = libs, cache, index, sync
+    publish_cache_stats(mode, started, sorted(changed))
+    if changed: await save_cache_snapshot()
+
+async def refresh_section(session, limiter, l_type, lib_info, full):
+    # Возвращает новое состояние раздела, не трогая глобальные переменные; items = None, если ничего не изменилось
+    async with limiter:
         try:
-            url_libs = f"{PLEX_URL}/library/sections?X-Plex-Token={PLEX_TOKEN}"
-            async with session.get(url_libs) as resp:
-                if resp.status == 200:
-                    root = ET.fromstring(await resp.text())
-                    for directory in root.findall(".//Directory"):
-                        l_type = directory.get("type")
-                        if l_type == "artist": l_type = "music"
-                        if l_type in ["movie", "show", "music"]:
-                            PLEX_LIBS[l_type] = {"id": directory.get("key"), "title": directory.get("title")}
-        except: return 
-
-        for l_type, lib_info in PLEX_LIBS.items():
-            try:
-                url = f"{PLEX_URL}/library/sections/{lib_info['id']}/all?X-Plex-Token={PLEX_TOKEN}"
-                async with session.get(url) as resp:
-                    if resp.status == 200:
-                        xml_data = await resp.text()
-                        root = ET.fromstring(xml_data)
-                        items = []
-                        if l_type == "movie":
-                            for node in root.findall(".//Video"):
-                                items.append({"title": node.get("title", "").lower(), "orig": node.get("originalTitle", "").lower(), "year": node.get("year"), "id": node.get("ratingKey")})
-                        elif l_type in ["show", "music"]:
-                            for node in root.findall(".//Directory"):
-                                items.append({"title": node.get("title", "").lower(), "orig": node.get("originalTitle", "").lower(), "id": node.get("ratingKey")})
-                        PLEX_CACHE[l_type] = items
-            except: pass
+            lib_id = lib_info["id"]
+            # Уровни музыки лежат в разделе артистов, но синхронизируются отдельно
+            sync_key = f"{lib_id}:{l_type}" if l_type in TIER_TYPES else lib_id
+            cached = PLEX_CACHE.get(l_type, {}).get(lib_id)
+            sync = PLEX_SYNC.get(sync_key)
+            now = time.time()
+            if full or not sync or not cache_size(cached):
+                # Полная загрузка: первый запуск, принудительное обновление или пустой кэш
+                fetched = await fetch_section(session, l_type, lib_id)
+                if fetched is None: return None
+                items, page = fetched
+                sync = advance_sync({"reconciled_at": now}, page)
+            else:
+                # Дельта: только добавленное или измененное с прошлой синхронизации (у новых тоже есть updatedAt).
+                # Граница включительная, уже слитые в точке синхронизации элементы приходят снова и пропускаются
+                fetched = await fetch_section(session, l_type, lib_id, since=sync["updated_at"], seen=sync.get("updated_keys"))
+                if fetched is None: return None
+                changed, page = fetched
+                items = await task.executor(merge_items, cached, changed) if cache_size(changed) else cached
+                sync = advance_sync(dict(sync), page, ["updated"])
+                # Просмотр меняет viewCount / lastViewedAt, но не updatedAt: элементы, просмотренные с прошлой синхронизации, читаем отдельно
+                # (для точки синхронизации от старой версии один раз все просмотренные)
+                if l_type in ["movie", "show"]:
+                    fetched = await fetch_section(session, l_type, lib_id, since=sync.get("viewed_at", 0), field="lastViewedAt", seen=sync.get("viewed_keys"))
+                    if fetched is None: return None
+                    played, page = fetched
+                    if cache_size(played): items = await task.executor(merge_items, items, played)
+                    sync = advance_sync(sync, page, ["viewed"])
+                # Удаления: слияния полные, поэтому если в кэше больше элементов, чем на сервере, значит что-то удалили
+                if now - sync["reconciled_at"] >= RECONCILE_INTERVAL:
+                    total = await fetch_section_size(session, l_type, lib_id)
+                    # Отметка «не просмотрено» не меняет ни одной даты, ее ловит сверка числа непросмотренных — не позже чем через сутки
+                    unwatched = await fetch_section_size(session, l_type, lib_id, unwatched=True) if l_type in ["movie", "show"] else None
+                    if (total is not None and total != cache_size(items)) or (unwatched is not None and unwatched != items["watched"].count(0)):
+                        log.debug(f"SmartPlex: {l_type} cache has {cache_size(items)} items, server {total}. Reloading.")
+                        fetched = await fetch_section(session, l_type, lib_id)
+                        if fetched is None: return None
+                        items, page = fetched
+                        sync = advance_sync({}, page)
+                    sync["reconciled_at"] = now
+                if items is cached:
+                    return {"type": l_type, "section": lib_id, "id": sync_key, "sync": sync, "items": None, "index": None}
+            if l_type in TIER_TYPES:
+                index = await task.executor(build_parent_index, items)
+            else:
+                index = await task.executor(build_ngram_index, items)
+                index["sorted"] = await task.executor(build_sort_index, items)
+                if "facets" in items: index["years"] = await task.executor(build_year_index, items)
+            return {"type": l_type, "section": lib_id, "id": sync_key, "sync": sync, "items": items, "index": index}
+        except Exception as e:
+            # У раздела остаются кэшированные элементы и точка синхронизации, следующее обновление начнет с нее
+            log.warning(f"SmartPlex: {l_type} section {lib_info['title']} not refreshed: {repr(e)}")
+            breaker_result("plex", False, e)
+            return None
+
+# Снимок на диске: после перезагрузки скрипта или HA кэш восстанавливается за миллисекунды,
+# а следующее обновление идет дельтой, потому что PLEX_SYNC тоже восстанавливается
+# Один писатель на файл: сохранение, пришедшее во время записи, оставляет свои данные
+# этому писателю, и он запишет самые новые из полученных данных после текущей записи
+async def save_snapshot(path, data):
+    if path in SNAPSHOT_SAVES:
+        SNAPSHOT_SAVES[path] = data
+        return
+    SNAPSHOT_SAVES[path] = data
+    try:
+        while SNAPSHOT_SAVES[path] is not None:
+            data, SNAPSHOT_SAVES[path] = SNAPSHOT_SAVES[path], None
+            await task.executor(write_snapshot, path, data)
+    finally:
+        del SNAPSHOT_SAVES[path]
+
+async def save_cache_snapshot():
+    # Находки поиска и уведомления заменяют секции на месте: executor сериализует свою копию словарей по типам
+    cache = {l_type: dict(sections) for l_type, sections in PLEX_CACHE.items()}
+    index = {l_type: dict(sections) for l_type, sections in PLEX_INDEX.items()}
+    data = {"version": SNAPSHOT_VERSION, "saved_at": time.time(), "libs": PLEX_LIBS, "cache": cache, "index": index, "sync": dict(PLEX_SYNC)}
+    try: await save_snapshot(SNAPSHOT_PATH, data)
+    except Exception as e: log.warning(f"SmartPlex: cache snapshot not saved: {e}")
+
+async def load_cache_snapshot():
+    global PLEX_LIBS, PLEX_CACHE, PLEX_INDEX, PLEX_SYNC
+    started = time.monotonic()
+    data = await task.executor(read_snapshot, SNAPSHOT_PATH)
+    if not data or data.get("version") != SNAPSHOT_VERSION: return False
+    PLEX_LIBS, PLEX_CACHE, PLEX_INDEX, PLEX_SYNC = data["libs"], data["cache"], data["index"], data["sync"]
+    publish_cache_stats("snapshot", started, sorted(PLEX_CACHE))
+    log.debug(f"SmartPlex: cache snapshot loaded ({int(time.time() - data['saved_at'])} s old)")
+    return True
+
+def plex_session():
+    # Одна keep-alive сессия на все время жизни скрипта, при перезагрузке ее закрывает close_plex_session
+    global PLEX_SESSION
+    if PLEX_SESSION is None or PLEX_SESSION.closed:
+        # Без общего таймаута (большой раздел скачивается долго), но от сервера, переставшего отвечать, отказываемся
+        conn = aiohttp.TCPConnector(ssl=VERIFY_SSL, limit=FETCH_CONCURRENCY * 2, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=PLEX_CONNECT_TIMEOUT, sock_read=PLEX_READ_TIMEOUT)
+        PLEX_SESSION = aiohttp.ClientSession(connector=conn, timeout=timeout, headers={"Accept-Encoding": "gzip"})
+    return PLEX_SESSION
+
+async def fetch_section(session, l_type, lib_id, since=None, field="updatedAt", seen=None):
+    # Читаем раздел постранично и разбираем страницу прямо во время загрузки,
+    # поэтому ни весь XML, ни все дерево элементов никогда не лежат в памяти.
+    # since: дельта с этого момента по полю field, seen: ratingKey, уже слитые ровно в этот момент
+    items, start = new_columns(l_type in TIER_TYPES, l_type == "movie"), 0
+    page = {"updated": 0, "updated_keys": set(), "viewed": 0, "viewed_keys": set(),
+            "field": "viewed" if field == "lastViewedAt" else "updated", "since": since or 0, "seen": seen or set()}
+    while True:
+        url = f"{PLEX_URL}/library/sections/{lib_id}/all?X-Plex-Container-Start={start}&X-Plex-Container-Size={PAGE_SIZE}&X-Plex-Token={PLEX_TOKEN}"
+        if l_type in TIER_TYPES: url += f"&type={TIER_TYPES[l_type]}"
+        if since is not None: url += f"&{field}>>={since - 1}"
+        async with session.get(url) as resp:
+            if resp.status != 200: return None
+            parser = ET.XMLPullParser(events=("end",))
+            page.update({"count": 0, "total": None})
+            while True:
+                chunk = await resp.content.read(CHUNK_SIZE)
+                if not chunk: break
+                parse_chunk(parser, chunk, l_type, items, page)
+            parser.close()
+        start += page["count"]
+        if page["count"] < PAGE_SIZE or (page["total"] is not None and start >= page["total"]): break
+    return items, page
+
+async def fetch_section_size(session, l_type, lib_id, unwatched=False):
+    # Пустая страница все равно сообщает totalSize, это стоит пару сотен байт
+    url = f"{PLEX_URL}/library/sections/{lib_id}/all?X-Plex-Container-Start=0&X-Plex-Container-Size=0&X-Plex-Token={PLEX_TOKEN}"
+    if l_type in TIER_TYPES: url += f"&type={TIER_TYPES[l_type]}"
+    if unwatched: url += "&unwatched=1"
+    async with session.get(url) as resp:
+        if resp.status != 200: return None
+        total = ET.fromstring(await resp.text()).get("totalSize")
+        return int(total) if total else None
+
+async def load_episode_index(show_id, need_next=False):
+    # Серии одного сериала, загружаются, когда сериал впервые запрошен по серии или «продолжи».
+    # Указатель на следующую серию перезагружается после того, как по нему что-то включили
+    entry = EPISODE_INDEX.get(show_id)
+    if entry and time.time() - entry["loaded_at"] < EPISODE_TTL and not (need_next and entry["played"]): return entry
+    # Сервер недоступен: устаревший список все равно лучше поиска по названию сериала
+    if not breaker_allows("plex"): return entry
+    url = f"{PLEX_URL}/library/metadata/{show_id}/allLeaves?X-Plex-Token={PLEX_TOKEN}"
+    episodes = []
+    try:
+        async with plex_session().get(url) as resp:
+            if resp.status != 200: return None
+            parser = ET.XMLPullParser(events=("end",))
+            while True:
+                chunk = await resp.content.read(CHUNK_SIZE)
+                if not chunk: break
+                parse_episode_chunk(parser, chunk, episodes)
+            parser.close()
+    except Exception as e:
+        log.warning(f"SmartPlex: episodes of show {show_id} not loaded: {repr(e)}")
+        breaker_result("plex", False, e)
+        return entry
+    breaker_result("plex", True)
+    entry = build_episode_index(episodes)
+    entry.update({"loaded_at": time.time(), "played": False})
+    EPISODE_INDEX[show_id] = entry
+    return entry
+
+# Нативные функции (компилируются pyscript, работают на полной скорости Python)
+@pyscript_compile
+def new_columns(with_parent=False, with_facets=False):
+    # Один столбец на поле, элемент N — позиция N в каждом столбце. Числа хранятся в типизированных массивах
+    # (8 и 2 байта), в "orig" только позиции, где originalTitle отличается от названия.
+    # Альбомы и треки также хранят ratingKey артиста в "parent", элементы библиотек хранят то, что нужно
+    # индексам сортировки: addedAt, дату выхода как YYYYMMDD, audienceRating x 10 и просмотрено (0/1).
+    # Фильмы также хранят "facets": поле запроса -> значение в нижнем регистре -> позиции по возрастанию
+    columns = {"title": [], "orig": {}, "id": array("q"), "year": array("H")}
+    if with_parent: columns["parent"] = array("q")
+    else: columns.update({"added": array("I"), "released": array("I"), "rating": array("B"), "watched": array("B")})
+    if with_facets: columns["facets"] = {}
+    return columns
+
+@pyscript_compile
+def cache_size(columns):
+    return len(columns["title"]) if columns else 0
+
+@pyscript_compile
+def cache_item(columns, pos):
+    # Элемент в виде словаря, как до столбцов: id и год строками
+    year = columns["year"][pos]
+    item = {"title": columns["title"][pos], "orig": columns["orig"].get(pos, ""), "id": str(columns["id"][pos]),
+            "year": str(year) if year else None}
+    if "parent" in columns: item["parent"] = str(columns["parent"][pos])
+    return item
+
+@pyscript_compile
+def add_column_item(columns, title, orig, rating_key, year, parent=0, sort=(0, 0, 0, 0)):
+    pos = len(columns["title"])
+    columns["title"].append(title)
+    if orig and orig != title: columns["orig"][pos] = orig
+    columns["id"].append(rating_key)
+    columns["year"].append(year)
+    if "parent" in columns: columns["parent"].append(parent)
+    if "added" in columns:
+        added, released, rating, watched = sort
+        columns["added"].append(added)
+        columns["released"].append(released)
+        columns["rating"].append(rating)
+        columns["watched"].append(watched)
+
+@pyscript_compile
+def sort_fields(node):
+    # (addedAt, originallyAvailableAt как YYYYMMDD, audienceRating x 10, просмотрено) элемента библиотеки.
+    # Сериал считается просмотренным, когда просмотрены все его серии
+    released = (node.get("originallyAvailableAt") or "")[:10].replace("-", "")
+    rating = node.get("audienceRating")
+    leaves = int(node.get("leafCount") or 0)
+    # viewCount сериала считает просмотры любых серий, поэтому решают только счетчики серий
+    watched = int(node.get("viewedLeafCount") or 0) >= leaves if leaves else int(node.get("viewCount") or 0) > 0
+    return (int(node.get("addedAt") or 0), int(released) if released.isdigit() else 0,
+            min(100, round(float(rating) * 10)) if rating else 0, 1 if watched else 0)
+
+@pyscript_compile
+def advance_sync(sync, page, names=("updated", "viewed")):
+    # Сдвигает каждую точку синхронизации (время + ratingKey, прочитанные в это время) к самому новому времени страницы
+    for name in names:
+        at, keys = sync.get(f"{name}_at", 0), sync.get(f"{name}_keys", set())
+        if page[name] > at: at, keys = page[name], page[f"{name}_keys"]
+        elif page[name] == at: keys = set(keys) | page[f"{name}_keys"]
+        sync.update({f"{name}_at": at, f"{name}_keys": keys})
+    return sync
+
+@pyscript_compile
+def parse_chunk(parser, chunk, l_type, items, page):
+    parser.feed(chunk)
+    tag = {"movie": "Video", "track": "Track"}.get(l_type, "Directory")
+    # Треки ссылаются на артиста через альбом (grandparent); originalTitle у трека — это артист, а не название
+    parent_key = {"album": "parentRatingKey", "track": "grandparentRatingKey"}.get(l_type)
+    for _, node in parser.read_events():
+        if node.tag == tag:
+            rating_key = int(node.get("ratingKey") or 0)
+            stamps = {"updated": int(node.get("updatedAt") or node.get("addedAt") or 0), "viewed": int(node.get("lastViewedAt") or 0)}
+            for name, stamp in stamps.items():
+                if stamp > page[name]: page[name], page[f"{name}_keys"] = stamp, {rating_key}
+                elif stamp and stamp == page[name]: page[f"{name}_keys"].add(rating_key)
+            page["count"] += 1
+            # Элементы, уже слитые в самой точке синхронизации, читаем, но повторно не возвращаем
+            if stamps[page["field"]] <= page["since"] and rating_key in page["seen"]:
+                node.clear()
+                continue
+            year = node.get("year")
+            add_column_item(items, node.get("title", "").lower(), node.get("originalTitle", "").lower() if not parent_key else "",
+                            rating_key, int(year) if year and year.isdigit() else 0,
+                            int(node.get(parent_key) or 0) if parent_key else 0, sort_fields(node) if not parent_key else (0, 0, 0, 0))
+            if "facets" in items: add_facets(items["facets"], node, len(items["title"]) - 1)
+            node.clear()  # Сразу освобождаем атрибуты и вложенные теги (Media, Genre, Role...)
+        elif node.tag == "MediaContainer" and node.get("totalSize"):
+            page["total"] = int(node.get("totalSize"))
+
+@pyscript_compile
+def add_facets(facets, node, pos):
+    # Дочерние теги (<Genre tag="Comedy"/>, <Role tag="..."/>...) и атрибуты-фасеты одного фильма.
+    # Пока раздел читается, позиции только растут, поэтому каждый список позиций остается отсортированным
+    values = [(FACET_TAGS[child.tag], child.get("tag")) for child in node if child.tag in FACET_TAGS]
+    values += [(field, node.get(field)) for field in FACET_ATTRS]
+    for field, value in values:
+        if not value: continue
+        postings = facets.setdefault(field, {}).setdefault(value.lower(), array("I"))
+        if not postings or postings[-1] != pos: postings.append(pos)
+
+@pyscript_compile
+def parse_episode_chunk(parser, chunk, episodes):
+    # (сезон, серия, ratingKey, viewCount, viewOffset, lastViewedAt) для каждой серии
+    parser.feed(chunk)
+    for _, node in parser.read_events():
+        if node.tag == "Video":
+            episodes.append((int(node.get("parentIndex") or 0), int(node.get("index") or 0), node.get("ratingKey"),
+                             int(node.get("viewCount") or 0), int(node.get("viewOffset") or 0), int(node.get("lastViewedAt") or 0)))
+            node.clear()
+
+@pyscript_compile
+def build_episode_index(episodes):
+    # {"episodes": {(сезон, серия): ratingKey}, "seasons": [...], "next": ratingKey для продолжения или None}
+    episodes = sorted(episodes)
+    regular = [ep for ep in episodes if ep[0] > 0]  # Сезон 0 — спецвыпуски
+    # Просмотренная или начатая — решает серия, которую смотрели последней: давно брошенная
+    # на середине серия не перебивает те, что досмотрели после неё
+    viewed = [pos for pos, ep in enumerate(regular) if ep[3] or ep[4] > 0]
+    if viewed:
+        last = max(viewed, key=lambda pos: regular[pos][5])
+        if not regular[last][3]:
+            # Остановились посреди неё: продолжаем эту серию
+            next_key = regular[last][2]
+        else:
+            # Первая непросмотренная серия после неё
+            after = [ep for ep in regular[last + 1:] if not ep[3]]
+            next_key = after[0][2] if after else None
+    else:
+        next_key = regular[0][2] if regular else None
+    return {"episodes": {(ep[0], ep[1]): ep[2] for ep in episodes}, "seasons": sorted({ep[0] for ep in regular}), "next": next_key}
+
+@pyscript_compile
+def write_snapshot(path, data):
+    # Свой временный файл рядом с целевым для каждой записи, затем атомарное переименование:
+    # никогда не остается недописанный снимок, и два писателя никогда не делят один файл
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except BaseException:
+        try: os.unlink(tmp)
+        except OSError: pass
+        raise
+
+@pyscript_compile
+def read_snapshot(path):
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        return None
+
+@pyscript_compile
+def merge_items(items, changed):
+    # Каждый числовой столбец - массив одной длины, все они копируются и обновляются одинаково
+    numbers = [field for field, column in items.items() if isinstance(column, array)]
+    merged = {"title": list(items["title"]), "orig": dict(items["orig"])}
+    for field in numbers: merged[field] = array(items[field].typecode, items[field])
+    positions = {rating_key: pos for pos, rating_key in enumerate(merged["id"])}
+    moved, updated = [], set()
+    for i, rating_key in enumerate(changed["id"]):
+        title, orig = changed["title"][i], changed["orig"].get(i, "")
+        pos = positions.get(rating_key)
+        if pos is None:
+            pos = len(merged["title"])
+            merged["title"].append(title)
+            for field in numbers: merged[field].append(changed[field][i])
+        else:
+            updated.add(pos)
+            merged["title"][pos] = title
+            for field in numbers: merged[field][pos] = changed[field][i]
+        moved.append(pos)
+        if orig: merged["orig"][pos] = orig
+        else: merged["orig"].pop(pos, None)
+    if "facets" in items: merged["facets"] = merge_facets(items["facets"], changed["facets"], updated, moved)
+    return merged
+
+@pyscript_compile
+def merge_facets(facets, changed, updated, moved):
+    # Списки позиций общие с используемым кэшем, список копируется перед изменением.
+    # Обновленные элементы уходят из всех старых значений, затем каждый измененный элемент добавляется в свои текущие
+    # (moved: позиция в изменениях -> позиция в объединенном кэше)
+    merged = {}
+    for field in set(facets) | set(changed):
+        postings = merged[field] = dict(facets.get(field, {}))
+        if updated:
+            for value, positions in facets.get(field, {}).items():
+                if not any(pos in updated for pos in positions): continue
+                kept = array("I", [pos for pos in positions if pos not in updated])
+                if kept: postings[value] = kept
+                else: del postings[value]
+        for value, positions in changed.get(field, {}).items():
+            postings[value] = array("I", sorted(set(postings.get(value, ())) | {moved[i] for i in positions}))
+    return merged
+
+@pyscript_compile
+def ngrams(text):
+    if not text: return set()
+    t = f" {text} "
+    return {t[i:i + 3] for i in range(len(t) - 2)}
+
+@pyscript_compile
+def build_ngram_index(items):
+    grams, sizes = {}, []
+    origs = items["orig"]
+    for pos, title in enumerate(items["title"]):
+        item_grams = ngrams(title) | ngrams(origs.get(pos, ""))
+        sizes.append(len(item_grams))
+        for g in item_grams:
+            grams.setdefault(g, []).append(pos)
+    return {"grams": grams, "sizes": sizes}
+
+@pyscript_compile
+def build_sort_index(items):
+    # Позиции по возрастанию, выбор читает один конец: "released" (сначала самые старые, при равенстве решает addedAt)
+    # и "rating" (сначала самые низкие). Элементы без даты выхода / рейтинга не входят, как и на сервере
+    added, released, rating = items["added"], items["released"], items["rating"]
+    positions = range(len(added))
+    return {"released": array("I", sorted((pos for pos in positions if released[pos]), key=lambda pos: (released[pos], added[pos]))),
+            "rating": array("I", sorted((pos for pos in positions if rating[pos]), key=lambda pos: (rating[pos], added[pos])))}
+
+@pyscript_compile
+def build_year_index(items):
+    # Год -> позиции, фильтры года и десятилетия читают его как фасеты тегов
+    years = {}
+    for pos, year in enumerate(items["year"]):
+        if year: years.setdefault(year, array("I")).append(pos)
+    return years
+
+@pyscript_compile
+def sorted_pick(items, order, from_end, unwatched):
+    # Первая позиция с одного конца индекса сортировки, просмотренные пропускаются, если нужно
+    for pos in (reversed(order) if from_end else order):
+        if not (unwatched and items["watched"][pos]): return pos
+    return None
+
+@pyscript_compile
+def ranked_pick(pool, field, lowest):
+    # (lib_info, shard, pos) с наибольшим / наименьшим значением поля, при равенстве решает addedAt.
+    # Элементы без значения учитываются, только если его нет ни у одного элемента
+    pool = [c for c in pool if c[1][field][c[2]]] or pool
+    rank = lambda c: (c[1][field][c[2]], c[1]["added"][c[2]])
+    return min(pool, key=rank) if lowest else max(pool, key=rank)
+
+@pyscript_compile
+def build_parent_index(items):
+    # Уровни музыки: ratingKey артиста -> позиции его альбомов / треков, поиск проходит только по одному артисту
+    by_parent = {}
+    for pos, parent in enumerate(items["parent"]):
+        by_parent.setdefault(parent, array("I")).append(pos)
+    return {"by_parent": by_parent}
+
+@pyscript_compile
+def fuzzy_search(items, index, q, limit, scope=None):
+    # Возвращает (позиция лучшего элемента или None, оценка). scope: only these positions are scored.
+    # Короткий запрос или пустой индекс: простой перебор, как было до индекса
+    titles = items["title"]
+    positions = range(len(titles)) if scope is None else scope
+    if scope is None and index and len(q) >= 3:
+        q_grams = ngrams(q)
+        hits = Counter()
+        for g in q_grams:
+            hits.update(index["grams"].get(g, ()))
+        # Ранжируем по сходству Дайса, чтобы длинные названия с частыми триграммами не вытесняли нужное
+        sizes, q_size = index["sizes"], len(q_grams)
+        top = heapq.nlargest(limit, hits.items(), key=lambda h: h[1] / (q_size + sizes[h[0]]))
+        # Порядок библиотеки сохраняем: при равенстве и выходе по 0.95 выбирается тот же элемент, что и при полном переборе
+        positions = sorted(pos for pos, _ in top)
+        best, highest = score_titles(items, q, positions)
+        # Dice ставит короткие названия, входящие в запрос, выше опечаток в полном названии: слабого
+        # или отсутствующего лучшего кандидата проверяем по всему шарду, как при переборе до индекса
+        if highest >= INDEX_TRUST_SCORE: return best, highest
+        positions = range(len(titles))
+    return score_titles(items, q, positions)
+
+@pyscript_compile
+def score_titles(items, q, positions):
+    titles, origs = items["title"], items["orig"]
+    best, highest = None, 0.0
+    for pos in positions:
+        r = SequenceMatcher(None, q, titles[pos]).ratio()
+        if pos in origs: r = max(r, SequenceMatcher(None, q, origs[pos]).ratio())
+        if r > 0.95: return pos, r
+        if r > 0.6 and r > highest: highest = r; best = pos
+    return best, highest
+
+@pyscript_compile
+def best_match(parts, q, limit):
+    # ((lib_info, shard, позиция) или None, оценка) лучшего совпадения по [(lib_info, shard, index)].
+    # Только читает шарды, поэтому может работать и в потоке executor
+    best, highest = None, 0.0
+    for lib_info, shard, index in parts:
+        pos, score = fuzzy_search(shard, index, q, limit)
+        if pos is None or score <= highest: continue
+        best, highest = (lib_info, shard, pos), score
+        if score > 0.95: break
+    return best, highest
+
+@pyscript_compile
+def best_search_hit(root, kind, q):
+    # Результаты поиска на сервере одного типа ("movie", "show", "artist"), оцененные по запросу тем же
+    # сходством, что и в fuzzy_search. Возвращает (оценка, узел) лучшего выше 0.6 или None
+    best = None
+    for node in root.iter():
+        if node.get("type") != kind or not node.get("ratingKey") or not node.get("librarySectionID"): continue
+        score = max(SequenceMatcher(None, q, (node.get(field) or "").lower()).ratio() for field in ["title", "originalTitle"])
+        if score > 0.6 and (best is None or score > best[0]): best = (score, node)
+    return best
+
+@pyscript_compile
+def search_hit_columns(node, with_facets):
+    # Один результат поиска в виде колонок, разобранный как список раздела
+    year = node.get("year")
+    columns = new_columns(False, with_facets)
+    add_column_item(columns, node.get("title", "").lower(), node.get("originalTitle", "").lower(), int(node.get("ratingKey") or 0),
+                    int(year) if year and year.isdigit() else 0, 0, sort_fields(node))
+    if with_facets: add_facets(columns["facets"], node, 0)
+    return columns
+
+@pyscript_compile
+def add_search_hit(items, index, node):
+    # Копии колонок и индексов раздела с результатом поиска, добавленным последним элементом
+    merged = merge_items(items, search_hit_columns(node, "facets" in items))
+    pos = len(merged["title"]) - 1
+    item_grams = ngrams(merged["title"][pos]) | ngrams(merged["orig"].get(pos, ""))
+    grams = dict(index["grams"])
+    for g in item_grams: grams[g] = grams.get(g, []) + [pos]
+    updated = {"grams": grams, "sizes": index["sizes"] + [len(item_grams)]}
+    if "sorted" in index:
+        updated["sorted"] = {}
+        for field, order in index["sorted"].items():
+            order = array("I", order)
+            if merged[field][pos]: insort(order, pos, key=lambda p: (merged[field][p], merged["added"][p]))
+            updated["sorted"][field] = order
+    if "years" in index:
+        updated["years"] = dict(index["years"])
+        year = merged["year"][pos]
+        if year: updated["years"][year] = array("I", list(index["years"].get(year, ())) + [pos])
+    return merged, updated
+
+def cache_count(l_type):
+    return sum(cache_size(shard) for shard in PLEX_CACHE.get(l_type, {}).values())
 
 def find_in_cache(target_type, query_string):
-    lib = PLEX_CACHE.get(target_type, [])
-    if not lib or not query_string: return None
+    return match_in_cache(target_type, query_string)[0]
+
+def match_in_cache(target_type, query_string):
+    # То же, что find_in_cache, но возвращает еще и степень сходства.
+    # Поиск идет по всем разделам типа, побеждает лучшее совпадение (при равенстве - первый раздел)
+    # и несет свои "section" и "library_name"
+    if not query_string: return None, 0.0
+    found, score = best_match(cache_parts(target_type), query_string.lower().strip(), INDEX_CANDIDATES)
+    return (shard_item(*found) if found else None), score
+
+def cache_parts(l_type):
+    # (lib_info, shard, index) каждого кэшированного раздела типа, в порядке сервера
+    parts = []
+    for lib_info in PLEX_LIBS.get(l_type, []):
+        shard = PLEX_CACHE.get(l_type, {}).get(lib_info["id"])
+        if cache_size(shard): parts.append((lib_info, shard, PLEX_INDEX.get(l_type, {}).get(lib_info["id"])))
+    return parts
+
+async def find_title(l_type, query_string):
+    # find_in_cache наперегонки с поиском самого сервера Plex: кэш ищется в потоке executor,
+    # пока идет /hubs/search, побеждает элемент с лучшей оценкой. Уверенное совпадение в кэше (> 0.95) не ждет
+    # сервер, а серверу дается не больше SERVER_SEARCH_TIMEOUT секунд. Найденное сервером, чего
+    # нет в кэше (добавлено после последнего обновления), записывается в него, следующая команда найдет это локально
+    if not query_string: return None
     q = query_string.lower().strip()
-    best, highest = None, 0.0
-    for item in lib:
-        r = max(SequenceMatcher(None, q, item["title"]).ratio(), SequenceMatcher(None, q, item.get("orig", "")).ratio())
-        if r > 0.95: return item
-        if r > 0.6 and r > highest: highest = r; best = item
+    search = task.create(search_server, l_type, q) if SERVER_SEARCH_TIMEOUT and breaker_allows("plex") else None
+    found, score = await task.executor(best_match, cache_parts(l_type), q, INDEX_CANDIDATES)
+    cached = shard_item(*found) if found else None
+    if search is None: return cached
+    if score > 0.95:
+        task.cancel(search)
+        return cached
+    done, _ = await task.wait({search}, timeout=SERVER_SEARCH_TIMEOUT)
+    if search not in done:
+        task.cancel(search)
+        log.debug(f"SmartPlex: server search for '{q}' took longer than {SERVER_SEARCH_TIMEOUT} s, using the cache")
+        return cached
+    hit = search.result()
+    if not hit or hit[0] <= score: return cached
+    log.debug(f"SmartPlex: '{q}' found by the server search ({hit[0]:.2f} vs {score:.2f} in the cache)")
+    return remember_search_hit(l_type, hit[1])
+
+async def search_server(l_type, q):
+    # (оценка, XML-узел) лучшего результата /hubs/search этого типа, оцененного как в кэше, или None
+    params = {"query": q, "limit": SERVER_SEARCH_LIMIT, "X-Plex-Token": PLEX_TOKEN}
+    try:
+        async with plex_session().get(f"{PLEX_URL}/hubs/search", params=params) as resp:
+            if resp.status != 200: return None
+            root = ET.fromstring(await resp.text())
+    except Exception as e:
+        log.warning(f"SmartPlex: server search for '{q}' failed: {repr(e)}")
+        breaker_result("plex", False, e)
+        return None
+    breaker_result("plex", True)
+    return best_search_hit(root, "artist" if l_type == "music" else l_type, q)
+
+def remember_search_hit(l_type, node):
+    # Найденное как элемент кэша. Если в его разделе этого еще нет, элемент добавляется в копию
+    # шарда и индексов раздела, которая затем заменяет используемую (ничего общего не меняется на месте)
+    section = node.get("librarySectionID")
+    lib_info = {"id": section, "title": node.get("librarySectionTitle")}
+    for known in PLEX_LIBS.get(l_type, []):
+        if known["id"] == section: lib_info = known
+    shard = PLEX_CACHE.get(l_type, {}).get(section)
+    index = PLEX_INDEX.get(l_type, {}).get(section)
+    if shard is None or index is None or int(node.get("ratingKey") or 0) in shard["id"]:
+        return shard_item(lib_info, search_hit_columns(node, False), 0)
+    started = time.monotonic()
+    shard, index = add_search_hit(shard, index, node)
+    PLEX_CACHE[l_type][section], PLEX_INDEX[l_type][section] = shard, index
+    publish_cache_stats("search", started, [l_type])
+    task.create(save_cache_snapshot)
+    return shard_item(lib_info, shard, cache_size(shard) - 1)
+
+def shard_item(lib_info, shard, pos):
+    item = cache_item(shard, pos)
+    item.update({"section": lib_info["id"], "library_name": lib_info["title"]})
+    return item
+
+def pick_in_cache(l_type, sort_mode, unwatched=False):
+    # Элемент "newest" / "oldest" / "top_rated" / "random" этого типа из индексов сортировки всех его
+    # разделов, None, если ничего не подходит (тогда выбирает сервер)
+    shards = []
+    for lib_info in PLEX_LIBS.get(l_type, []):
+        shard = PLEX_CACHE.get(l_type, {}).get(lib_info["id"])
+        orders = PLEX_INDEX.get(l_type, {}).get(lib_info["id"], {}).get("sorted")
+        if cache_size(shard) and orders: shards.append((lib_info, shard, orders))
+    if not shards: return None
+    if sort_mode == "random": return random_pick(shards, unwatched)
+    field = "rating" if sort_mode == "top_rated" else "released"
+    best, best_rank = None, None
+    for lib_info, shard, orders in shards:
+        pos = sorted_pick(shard, orders[field], sort_mode != "oldest", unwatched)
+        if pos is None: continue
+        rank = (shard[field][pos], shard["added"][pos])
+        if best_rank is None or (rank < best_rank if sort_mode == "oldest" else rank > best_rank):
+            best, best_rank = shard_item(lib_info, shard, pos), rank
     return best
 
+def random_pick(shards, unwatched):
+    # Равномерно по всем элементам разделов в кэше: один выбор по их общему размеру. С "unwatched"
+    # при выпадении просмотренного выбор повторяется несколько раз, затем выбирается среди непросмотренных
+    total = sum(cache_size(shard) for _, shard, _ in shards)
+    for _ in range(8):
+        pos = random.randrange(total)
+        for lib_info, shard, _ in shards:
+            if pos < cache_size(shard): break
+            pos -= cache_size(shard)
+        if not (unwatched and shard["watched"][pos]): return shard_item(lib_info, shard, pos)
+    pool = [(lib_info, shard, pos) for lib_info, shard, _ in shards for pos in range(cache_size(shard)) if not shard["watched"][pos]]
+    return shard_item(*random.choice(pool)) if pool else None
+
+def filter_in_cache(l_type, query):
+    # Элементы, подходящие под все фильтры запроса: списки позиций каждого значения фильтра
+    # пересекаются в каждом разделе, начиная с самого короткого. Значения с опечатками заменяются ближайшим известным
+    # значением (FACET_MIN_SCORE). Возвращает ([(lib_info, shard, positions)], {поле: исправленное значение}),
+    # или None, если в запросе есть то, чего нет в фасетах (тогда фильтрует сервер)
+    text_fields = list(FACET_TAGS.values()) + FACET_ATTRS
+    if set(query) <= {"unwatched"} or set(query) - set(text_fields) - {"year", "decade", "unwatched"}: return None
+    found, corrected = [], {}
+    for lib_info in PLEX_LIBS.get(l_type, []):
+        shard = PLEX_CACHE.get(l_type, {}).get(lib_info["id"])
+        years = PLEX_INDEX.get(l_type, {}).get(lib_info["id"], {}).get("years")
+        if not cache_size(shard) or "facets" not in shard or years is None: return None
+        lists = []
+        for field in text_fields:
+            if not query.get(field): continue
+            postings = shard["facets"].get(field, {})
+            value = query[field].lower()
+            if value not in postings:
+                close = get_close_matches(value, list(postings), 1, FACET_MIN_SCORE)
+                value = close[0] if close else None
+                if value: corrected.setdefault(field, value)
+            lists.append(postings.get(value, ()))
+        if query.get("year"): lists.append(years.get(int(query["year"]), ()))
+        if query.get("decade"):
+            decade = int(query["decade"]) // 10 * 10
+            lists.append([pos for year in range(decade, decade + 10) for pos in years.get(year, ())])
+        lists.sort(key=len)
+        positions = set(lists[0]) if lists else set(range(cache_size(shard)))
+        for other in lists[1:]:
+            if not positions: break
+            positions.intersection_update(other)
+        if query.get("unwatched"): positions = {pos for pos in positions if not shard["watched"][pos]}
+        if positions: found.append((lib_info, shard, sorted(positions)))
+    return found, corrected
+
+def pick_among(found, sort_mode):
+    # Один элемент из результата filter_in_cache: самый новый / самый старый / лучший по рейтингу, иначе случайный
+    pool = [(lib_info, shard, pos) for lib_info, shard, positions in found for pos in positions]
+    if not pool: return None
+    if sort_mode in ["newest", "oldest", "top_rated"]:
+        return shard_item(*ranked_pick(pool, "rating" if sort_mode == "top_rated" else "released", sort_mode == "oldest"))
+    return shard_item(*random.choice(pool))
+
+def library_name(l_type, cached=None):
+    # Раздел элемента из кэша, иначе первый раздел типа (там ищет сервер)
+    if cached: return cached["library_name"]
+    sections = PLEX_LIBS.get(l_type)
+    return sections[0]["title"] if sections else None
+
+def find_by_artist(tier, artist, query_string):
+    # Альбом или трек одного артиста из кэша ("album" / "track"), None, если уровень не кэшируется.
+    # Уровни разделены на части так же, как артисты, поэтому ищется только музыкальный раздел самого артиста
+    lib = PLEX_CACHE.get(tier, {}).get(artist["section"])
+    if not cache_size(lib) or not query_string: return None
+    scope = PLEX_INDEX.get(tier, {}).get(artist["section"], {}).get("by_parent", {}).get(int(artist["id"]))
+    if not scope: return None
+    pos, _ = fuzzy_search(lib, None, query_string.lower().strip(), INDEX_CANDIDATES, scope)
+    return cache_item(lib, pos) if pos is not None else None
+
+async def resolve_episode(show, query):
+    # ratingKey запрошенной серии или следующей к просмотру, если серия не указана.
+    # None = нет в индексе, сервер ищет как раньше
+    episode = query.get("episode")
+    entry = await load_episode_index(show["id"], need_next=not episode)
+    if not entry: return None
+    if episode:
+        seasons = entry["seasons"]
+        season = int(query["season"]) if query.get("season") else (seasons[0] if len(seasons) == 1 else None)
+        key = entry["episodes"].get((season, int(episode)))
+    else:
+        key = entry["next"]
+    if key: entry["played"] = True
+    return key
+
 # === 4. ЖЕЛЕЗО (HABR STYLE SCAN) ===
-async def boot_hardware_process(zone_config):
+async def boot_hardware_process(zone_config, room=None):
     hw_entity = zone_config.get("hardware_entity")
     plex_client = zone_config["plex_client"]
     power = zone_config.get("power_method")
+    was_off = state.get(hw_entity) in ["off", "unavailable", "standby"]
+    hw_started = time.monotonic()
     
     # 1. Включаем ТВ/Приставку
     if power == "apple_tv_device":
@@ -114,113 +942,588 @@ async def boot_hardware_process(zone_config):
     else:
         await service.call("media_player", "turn_on", entity_id=hw_entity)
 
-    await task.sleep(zone_config["boot_delay"])
+    # Ждем, пока ТВ сообщит, что включился, но не дольше выученного времени (boot_delay, пока нет истории)
+    if was_off:
+        started = time.monotonic()
+        bound = learned_delay(room, "boot", zone_config["boot_delay"])
+        trig = await task.wait_until(state_trigger=f"{hw_entity} not in ['off', 'unavailable', 'standby']", timeout=bound)
+        if trig.get("trigger_type") == "state": await record_timing(room, "boot", time.monotonic() - started)
+        # Не дождались: зона стала медленнее выученного, даем пределу вырасти (до двойного значения из настроек)
+        else: await record_timing(room, "boot", min(bound * 1.5, zone_config["boot_delay"] * 2))
 
     # 2. Запускаем Plex (если надо)
+    boot_time = time.monotonic() - hw_started
+    app_started = None
     try:
         if power == "apple_tv_device" or state.getattr(hw_entity).get("source") != "Plex":
              await service.call("media_player", "select_source", entity_id=hw_entity, source="Plex")
-             await task.sleep(zone_config["app_load_delay"])
-    except: pass
+             app_started = time.monotonic()
+             # Приложение готово, когда появляется его клиент Plex, ждем этого вместо фиксированной app_load_delay
+             await task.wait_until(state_trigger=f"{plex_client} not in ['unavailable', 'unknown', 'off']",
+                                   timeout=learned_delay(room, "app", zone_config["app_load_delay"]))
+    except Exception as e: log.warning(f"SmartPlex: Plex app not started on {hw_entity}, scanning for the client anyway: {e}")
+
+    # 3. Ждем клиента Plex (Habr Style scan, по событию)
+    app_time = time.monotonic() - hw_started - boot_time
+    client = await wait_for_plex_client(plex_client)
+    if app_started and client["found"]: await record_timing(room, "app", time.monotonic() - app_started)
+    client.update({"boot": boot_time, "app": app_time})
+    return client
+
+# Выученные времена: последние TIMING_SAMPLES измерений на зону и этап, хранятся на диске.
+# Предел ожидания — их TIMING_PERCENTILE, пока измерений мало, используются паузы из настроек
+def learned_delay(room, stage, default):
+    samples = sorted((ZONE_TIMINGS or {}).get(room, {}).get(stage, []))
+    if len(samples) < TIMING_MIN_SAMPLES: return default
+    return samples[int(TIMING_PERCENTILE * (len(samples) - 1))] * TIMING_MARGIN
+
+async def record_timing(room, stage, seconds):
+    if not room: return
+    if ZONE_TIMINGS is None: await load_zone_timings()
+    samples = ZONE_TIMINGS.setdefault(room, {}).setdefault(stage, [])
+    samples.append(round(seconds, 2))
+    del samples[:-TIMING_SAMPLES]
+    log.debug(f"SmartPlex: {room} {stage} took {seconds:.1f} s, wait bound now {learned_delay(room, stage, 0):.1f} s")
+    # Копия в цикле событий: списки замеров продолжают меняться, пока executor сериализует
+    data = {zone: {name: list(values) for name, values in stages.items()} for zone, stages in ZONE_TIMINGS.items()}
+    try: await save_snapshot(TIMINGS_PATH, data)
+    except Exception as e: log.warning(f"SmartPlex: zone timings not saved: {e}")
+
+async def load_zone_timings():
+    global ZONE_TIMINGS
+    ZONE_TIMINGS = await task.executor(read_snapshot, TIMINGS_PATH) or {}
 
-    # 3. ЦИКЛ СКАНИРОВАНИЯ (Habr Style)
-    # Пытаемся 10 раз с паузой 3 секунды (всего 30 сек), пока клиент не станет доступен
-    for i in range(10):
-        # Если клиент появился (не unavailable/unknown/off) — выходим из цикла
+async def wait_for_plex_client(plex_client, timeout=None):
+    # Срабатывает в момент, когда клиент появляется в HA. Scan нажимается
+    # с растущими паузами (1, 2, 4, 8 сек), а не каждые 3 секунды.
+    # Возвращает {"found": bool, "elapsed": секунды, "scans": нажатия}, boot_hardware_process добавляет "boot" и "app" в секундах
+    timeout = SCAN_TIMEOUT if timeout is None else timeout
+    start = time.monotonic()
+    gap, scans = SCAN_FIRST_GAP, 0
+    while True:
+        # Если клиент появился (не unavailable/unknown/off) — готово
         current_state = state.get(plex_client)
-        if current_state not in ["unavailable", "unknown", "off"]:
-            log.debug(f"Plex Client found: {plex_client} (State: {current_state})")
-            break
-        
-        # Если не найден — жмем Scan
-        log.debug(f"Plex Client not found. Scanning... (Attempt {i+1}/10)")
+        elapsed = time.monotonic() - start
+        if current_state not in ["unavailable", "unknown", "off", None]:
+            log.debug(f"Plex Client found: {plex_client} (State: {current_state}, {elapsed:.1f} s, {scans} scans)")
+            return {"found": True, "elapsed": elapsed, "scans": scans}
+        if elapsed >= timeout:
+            return {"found": False, "elapsed": elapsed, "scans": scans}
+
+        # Если не найден — жмем Scan и ждем смены состояния, но не дольше, чем до следующего нажатия
+        scans += 1
+        log.debug(f"Plex Client not found. Scanning... (Attempt {scans})")
         try: await service.call("button", "press", entity_id=PLEX_SCAN_BUTTON)
-        except: pass
-        
-        await task.sleep(3)
+        except Exception as e: log.warning(f"SmartPlex: {PLEX_SCAN_BUTTON} press failed: {e}")
+        wait, waited = min(gap, max(timeout - elapsed, 0.1)), time.monotonic()
+        await task.wait_until(state_trigger=f"{plex_client} not in ['unavailable', 'unknown', 'off', None]", timeout=wait)
+        # Сработавший триггер при все еще отсутствующем клиенте не сокращает паузу
+        left = wait - (time.monotonic() - waited)
+        if left > 0 and state.get(plex_client) in ["unavailable", "unknown", "off", None]: await task.sleep(left)
+        gap = min(gap * 2, SCAN_MAX_GAP)
+
+async def shutdown_hardware(zone_config):
+    # Откат упреждающего включения, зеркало шага 1 в boot_hardware_process
+    hw_entity = zone_config.get("hardware_entity")
+    power = zone_config.get("power_method")
+    if power in ["apple_tv_device", "lg_device"]:
+        await service.call("media_player", "turn_off", device_id=zone_config["hardware_device_id"])
+    elif power == "samsung_remote":
+        await service.call("remote", "turn_off", entity_id=zone_config["remote_entity"])
+    else:
+        await service.call("media_player", "turn_off", entity_id=hw_entity)
+
+# Одно включение на зону, общее для всех команд этой зоны. Команды ждут его через
+# wait_for_boot, поэтому отмена вытесненной команды никогда не останавливает включение, нужное следующей
+def claim_zone_boot(room, seq):
+    boot = ZONE_BOOTS.get(room)
+    if boot is None or boot["task"].done():
+        was_off = state.get(ZONES[room].get("hardware_entity")) in ["off", "unavailable", "standby"]
+        boot = {"task": task.create(boot_hardware_process, ZONES[room], room), "users": set(), "was_off": was_off}
+        ZONE_BOOTS[room] = boot
+    boot["users"].add(seq)
+    return boot["task"]
+
+def release_zone_boot(room, seq):
+    # Команде зона больше не нужна. Последняя ушедшая останавливает включение, которого никто
+    # не ждет, и выключает включенный им телевизор, даже когда включение уже закончилось
+    boot = ZONE_BOOTS.get(room)
+    if not boot or seq not in boot["users"]: return
+    boot["users"].discard(seq)
+    if boot["users"]: return
+    del ZONE_BOOTS[room]
+    if not boot["task"].done():
+        log.debug(f"SmartPlex: boot of {room} cancelled, no command needs it")
+        task.cancel(boot["task"])
+    if boot["was_off"]:
+        log.debug(f"SmartPlex: switching {room} off again, nothing was played there")
+        task.create(shutdown_hardware, ZONES[room])
+
+def claim_zone_command(room, seq):
+    # Побеждает последняя команда зоны: выполняющаяся старая отменяется, а старая команда,
+    # которая только сейчас узнала комнату (медленный ответ ИИ), сдается. Проигравшей возвращает False
+    current, me = ZONE_COMMANDS.get(room), task.current_task()
+    if current and current["seq"] > seq: return False
+    if current and current["task"] is not me and not current["task"].done():
+        log.debug(f"SmartPlex: command {current['seq']} for {room} superseded by {seq}")
+        task.cancel(current["task"])
+    ZONE_COMMANDS[room] = {"seq": seq, "task": me}
+    return True
+
+async def wait_for_boot(hw_task, timeout):
+    # Ждет включения зоны, не владея им: ни дедлайн, ни отмена команды его не останавливают.
+    # После дедлайна команда продолжается так, как будто клиент не появился
+    done, _ = await task.wait({hw_task}, timeout=timeout)
+    if hw_task in done: return hw_task.result()
+    return {"found": False, "elapsed": timeout, "scans": 0, "deadline": True}
+
+# Дедлайны: каждый этап команды получает STAGE_DEADLINES[stage] секунд, но не больше, чем осталось
+# от COMMAND_BUDGET. Не успевший этап вызывает asyncio.TimeoutError или идет запасным путем
+def stage_deadline(trace, stage):
+    left = COMMAND_BUDGET - (time.monotonic() - trace["start"])
+    return max(min(STAGE_DEADLINES[stage], left), 0.1)
+
+async def run_within(seconds, func, *args, **kwargs):
+    # func(*args, **kwargs) отдельной задачей, которая отменяется, если не успела вовремя
+    job = task.create(func, *args, **kwargs)
+    try:
+        done, _ = await task.wait({job}, timeout=seconds)
+    except asyncio.CancelledError:
+        task.cancel(job)
+        raise
+    if job not in done:
+        task.cancel(job)
+        raise asyncio.TimeoutError(f"no answer in {seconds:.1f} s")
+    return job.result()
+
+# Автоматические выключатели вокруг сервера Plex и сущности ИИ. После BREAKER_THRESHOLD сбоев подряд
+# выключатель размыкается: сервис не вызывается BREAKER_COOLDOWN секунд, а команды идут запасными
+# путями (кэш библиотеки, запомненные ответы, локальный разбор). Потом он полуоткрыт, следующий
+# вызов пробный: он снова замыкает выключатель или размыкает его опять
+def breaker_state(name):
+    return BREAKERS.setdefault(name, {"state": "closed", "failures": 0, "trips": 0, "opened_at": None, "error": None})
+
+def breaker_allows(name):
+    breaker = breaker_state(name)
+    if breaker["state"] == "open" and time.time() - breaker["opened_at"] >= BREAKER_COOLDOWN:
+        breaker["state"] = "half_open"
+        publish_breakers()
+    return breaker["state"] != "open"
+
+def breaker_result(name, ok, error=None):
+    breaker = breaker_state(name)
+    before = breaker["state"]
+    if ok:
+        breaker.update({"state": "closed", "failures": 0})
+    else:
+        breaker["failures"] += 1
+        breaker["error"] = repr(error)[:200] if error else None
+        if before == "half_open" or breaker["failures"] >= BREAKER_THRESHOLD:
+            if before != "open":
+                breaker["trips"] += 1
+                log.warning(f"SmartPlex: {name} unavailable ({breaker['failures']} failures), skipped for {BREAKER_COOLDOWN} s")
+            breaker.update({"state": "open", "opened_at": time.time()})
+    if breaker["state"] != before or not ok: publish_breakers()
+
+def publish_breakers():
+    attrs = {}
+    for name, breaker in BREAKERS.items():
+        attrs[name] = dict(breaker)
+        if breaker["opened_at"]: attrs[name]["opened_at"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(breaker["opened_at"]))
+    healthy = all(breaker["state"] == "closed" for breaker in BREAKERS.values())
+    attrs["friendly_name"] = "SmartPlex health"
+    state.set("sensor.smartplex_health", "ok" if healthy else "degraded", new_attributes=attrs)
+
+# Прямой запуск: тот же запрос, что отправляют приложения Plex, когда нажимаешь Play на другом устройстве
+async def direct_play(zone_config, payload, media_type):
+    # Очередь воспроизведения для найденного элемента на сервере, затем playMedia клиенту зоны через сервер.
+    # Возвращает False, если прямой запуск неприменим или не удался, тогда вызывающий использует play_media
+    global PLEX_MACHINE_ID, PLEX_COMMAND_ID
+    client_id = zone_config.get("plex_client_id")
+    if not DIRECT_PLAY or not client_id or "id" not in payload or payload.get("resume"): return False
+    if set(payload) - {"allow_multiple", "resume", "offset", "shuffle", "library_name", "id"}: return False
+    if not breaker_allows("plex"): return False
+    session = plex_session()
+    headers = {"X-Plex-Client-Identifier": "smartplex", "X-Plex-Target-Client-Identifier": client_id}
+    try:
+        if PLEX_MACHINE_ID is None:
+            async with session.get(f"{PLEX_URL}/identity?X-Plex-Token={PLEX_TOKEN}") as resp:
+                if resp.status != 200: return False
+                PLEX_MACHINE_ID = ET.fromstring(await resp.text()).get("machineIdentifier")
+        kind = "audio" if media_type == "MUSIC" else "video"
+        params = {"type": kind, "uri": f"server://{PLEX_MACHINE_ID}/com.plexapp.plugins.library/library/metadata/{payload['id']}",
+                  "shuffle": payload.get("shuffle", 0), "continuous": 1 if media_type == "EPISODE" else 0, "X-Plex-Token": PLEX_TOKEN}
+        async with session.post(f"{PLEX_URL}/playQueues", params=params, headers=headers) as resp:
+            if resp.status != 200: return False
+            queue = ET.fromstring(await resp.text())
+        # Выбранный элемент очереди - первый трек артиста, иначе сам элемент
+        key = f"/library/metadata/{payload['id']}"
+        for node in queue:
+            if node.get("playQueueItemID") == queue.get("playQueueSelectedItemID"): key = node.get("key", key)
+        server = urlparse(PLEX_URL)
+        PLEX_COMMAND_ID += 1
+        params = {"key": key, "offset": 0, "type": kind, "machineIdentifier": PLEX_MACHINE_ID,
+                  "protocol": server.scheme, "address": server.hostname, "port": server.port or (443 if server.scheme == "https" else 32400),
+                  "containerKey": f"/playQueues/{queue.get('playQueueID')}?own=1&window=200",
+                  "commandID": PLEX_COMMAND_ID, "X-Plex-Token": PLEX_TOKEN}
+        async with session.get(f"{PLEX_URL}/player/playback/playMedia", params=params, headers=headers) as resp:
+            if resp.status != 200:
+                log.warning(f"SmartPlex: client {client_id} refused direct play (HTTP {resp.status}), using play_media")
+                return False
+        breaker_result("plex", True)
+        return True
+    except Exception as e:
+        log.warning(f"SmartPlex: direct play failed, using play_media: {repr(e)}")
+        breaker_result("plex", False, e)
+        return False
 
 # === 5. ЛОГИКА ===
+def parse_command_locally(cmd, min_score=None):
+    # Возвращает такой же JSON control/query, как ИИ, или None, если команда не простая
+    # "<глагол> [тип] <название> [в <комнате>]" или совпадение названия ниже min_score (LOCAL_PARSER_MIN_SCORE)
+    min_score = LOCAL_PARSER_MIN_SCORE if min_score is None else min_score
+    words = command_words(cmd)
+
+    # Комната вырезается вместе с предлогом перед ней
+    room, span = detect_room(words)
+    if span:
+        start = span[0]
+        for prefix in sorted(PARSER_WORDS["room_prefix"], key=len, reverse=True):
+            p = prefix.split()
+            if start >= len(p) and words[start - len(p):start] == p:
+                start -= len(p); break
+        words = words[:start] + words[span[1]:]
+
+    # Глаголы в любом порядке: "включи", "продолжи", "перемешай"...
+    verbs = set()
+    for _ in range(3):
+        for key in ["resume", "start", "shuffle"]:
+            found, words = take_phrase(words, key)
+            if found: verbs.add(key)
+    if not verbs: return None
+    resume, shuffle = "resume" in verbs, "shuffle" in verbs
+    m_type = None
+    for t in ["movie", "show", "music"]:
+        found, words = take_phrase(words, t)
+        if found: m_type = t; break
+    title = " ".join(words)
+    if not title: return None
+
+    matches = []
+    for t in [m_type] if m_type else ["movie", "show", "music"]:
+        item, score = match_in_cache(t, title)
+        if item and score >= min_score: matches.append((t, item))
+    # Одно название в нескольких библиотеках пусть разбирает ИИ
+    if len(matches) != 1: return None
+    m_type, item = matches[0]
+
+    query = {"movie": {"title": item["title"]}, "show": {"show_name": item["title"]}, "music": {"artist": item["title"]}}[m_type]
+    control = {"room": room, "type": m_type, "resume_mode": "resume" if resume else "start", "sort_order": "default", "shuffle": shuffle}
+    return {"control": control, "query": query}
+
+def command_words(cmd):
+    return re.sub(r"[^\w]+", " ", cmd.lower()).split()
+
+def detect_room(words):
+    # Комната, названная в команде: побеждает самый длинный вариант ("малой спальне", а не "спальне").
+    # Возвращает (комната, (начало, конец) названия в words) или (None, None)
+    room, span = None, None
+    for key, zone in ZONES.items():
+        for alias in [key.replace("_", " ")] + zone.get("aliases", []):
+            a = alias.split()
+            for i in range(len(words) - len(a) + 1):
+                if words[i:i + len(a)] == a and (span is None or len(a) > span[1] - span[0]):
+                    room, span = key, (i, i + len(a))
+    return room, span
+
+def take_phrase(words, key):
+    # Отрезает самую длинную фразу из PARSER_WORDS[key] от начала words
+    for phrase in sorted(PARSER_WORDS[key], key=len, reverse=True):
+        p = phrase.split()
+        if words[:len(p)] == p: return True, words[len(p):]
+    return False, words
+
+# Схема ответа ИИ: допустимые значения control и поля query
+AI_TYPES = ["movie", "show", "music", "music_video", "playlist"]
+AI_CHOICES = {"resume_mode": ["start", "resume"], "sort_order": ["default", "newest", "oldest", "top_rated", "random"]}
+AI_TEXT_FIELDS = ["title", "show_name", "artist", "album", "actor", "director", "genre", "studio", "collection", "country", "contentRating", "mood"]
+AI_NUMBER_FIELDS = ["season", "episode", "year", "decade"]
+
+def build_compact_prompt():
+    # Одинаковый текст для всех команд, сама команда добавляется в конец (провайдеры кэшируют общее начало)
+    rooms = "; ".join([f"{', '.join(zone.get('aliases', [])) or key} -> {key}" for key, zone in ZONES.items()])
+    return (
+        "Ты — SmartPlex, разбор голосовых команд для Plex. Заполни поля для команды пользователя.\n"
+        "type: movie (фильм), show (сериал), music (музыка), music_video (клипы) или playlist (плейлист).\n"
+        f"room: {rooms}.\n"
+        "resume_mode: resume для 'продолжи', 'досмотри', иначе start.\n"
+        f"sort_order: newest для 'свежий', 'новый', 'последний' (year={time.localtime().tm_year}), oldest для 'старый', 'классика' (year=2000), "
+        "top_rated для 'лучший', 'популярный', random для 'любое', 'случайное' (shuffle=true), иначе default.\n"
+        "shuffle: true для 'перемешай' или общего запроса.\n"
+        "unwatched: true для 'непросмотренный', 'еще не смотрел'.\n"
+        "Удали 4k/uhd/imax/hdr из названий. Сериалы: show_name, season, episode. Музыка: artist, album, title (песня), mood. "
+        "Жанры на русском в именительном падеже (Комедия, Боевик, Драма, Фантастика). Неизвестные поля оставь пустыми.\n"
+    )
+
+def build_ai_structure():
+    # ai_task "structure": плоские поля с селекторами HA, normalize_ai_data раскладывает их в control/query
+    structure = {
+        "room": {"required": True, "selector": {"select": {"options": list(ZONES)}}},
+        "type": {"required": True, "selector": {"select": {"options": AI_TYPES}}},
+        "shuffle": {"selector": {"boolean": {}}},
+        "unwatched": {"selector": {"boolean": {}}},
+    }
+    for field, options in AI_CHOICES.items():
+        structure[field] = {"selector": {"select": {"options": options}}}
+    for field in AI_TEXT_FIELDS: structure[field] = {"selector": {"text": {}}}
+    for field in AI_NUMBER_FIELDS: structure[field] = {"selector": {"number": {"mode": "box"}}}
+    return structure
+
+AI_PROMPT_STATIC = build_compact_prompt()
+AI_STRUCTURE = build_ai_structure()
+
+def normalize_ai_data(data):
+    # Любой ответ ИИ (текст JSON, возможно внутри текста или ```json, или словарь structure; вложенные
+    # control/query или плоские поля) -> {"control": {...}, "query": {...}}, где все поля control допустимы,
+    # а в query только заполненные поля. ValueError, если JSON-объекта нет совсем
+    if isinstance(data, str):
+        found = re.search(r"\{.*\}", data, re.S)
+        if not found: raise ValueError(f"no JSON in AI answer: {data[:100]}")
+        data = json.loads(found.group(0))
+    if not isinstance(data, dict): raise ValueError(f"AI answer is not a JSON object: {data}")
+    src_control = data["control"] if isinstance(data.get("control"), dict) else data
+    src_query = data["query"] if isinstance(data.get("query"), dict) else data
+
+    room = src_control.get("room")
+    control = {
+        "room": room if isinstance(room, str) and room in ZONES else next(iter(ZONES)),
+        "type": src_control.get("type") if src_control.get("type") in AI_TYPES else "movie",
+        "shuffle": ai_flag(src_control.get("shuffle")),
+    }
+    for field, options in AI_CHOICES.items():
+        control[field] = src_control.get(field) if src_control.get(field) in options else options[0]
+
+    query = {}
+    for field in AI_TEXT_FIELDS:
+        value = src_query.get(field)
+        if isinstance(value, (int, float)) and not isinstance(value, bool): value = str(value)
+        if isinstance(value, str) and value.strip() and value.strip().lower() not in ["...", "null", "none"]:
+            query[field] = value.strip()
+    for field in AI_NUMBER_FIELDS:
+        try: query[field] = int(float(src_query[field]))
+        except (KeyError, TypeError, ValueError): pass
+    if ai_flag(src_query.get("unwatched")): query["unwatched"] = True
+    return {"control": control, "query": query}
+
+def ai_flag(value):
+    # Логические значения могут прийти текстом ("false", "yes")
+    if isinstance(value, str): return value.strip().lower() in ["true", "1", "yes"]
+    return bool(value)
+
+# Запомненные ответы ИИ: нормализованный текст команды -> control/query, давно не использованные первыми.
+# Отпечаток учитывает промпт, ZONES и сущность ИИ, при любом изменении всё начинается заново
+def intent_fingerprint(prompt_text):
+    text = json.dumps([prompt_text, ZONES, AI_ENTITY_ID], sort_keys=True, ensure_ascii=False)
+    return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+async def lookup_intent(key, fingerprint):
+    if INTENT_CACHE is None: await load_intent_cache()
+    if INTENT_CACHE["fingerprint"] != fingerprint:
+        INTENT_CACHE.update({"fingerprint": fingerprint, "entries": {}})
+    entries = INTENT_CACHE["entries"]
+    entry = entries.get(key)
+    # Устаревшие ответы остаются, пока их не заменят или не вытеснят, stale_intent еще пользуется ими
+    if entry and time.time() - entry["at"] < INTENT_TTL:
+        entries[key] = entries.pop(key)  # Последний использованный идет в конец
+        INTENT_CACHE["hits"] += 1
+    else:
+        entry = None
+        INTENT_CACHE["misses"] += 1
+    publish_intent_stats()
+    return entry["data"] if entry else None
+
+def stale_intent(key):
+    # Запомненный ответ любого возраста, для случаев, когда ИИ недоступен
+    entry = INTENT_CACHE["entries"].get(key) if INTENT_CACHE else None
+    return entry["data"] if entry else None
+
+def remember_intent(key, data):
+    entries = INTENT_CACHE["entries"]
+    entries[key] = {"data": data, "at": time.time()}
+    while len(entries) > INTENT_CACHE_SIZE: del entries[next(iter(entries))]
+    task.create(save_intent_cache)
+
+async def load_intent_cache():
+    global INTENT_CACHE
+    INTENT_CACHE = await task.executor(read_snapshot, INTENT_PATH) or {"fingerprint": None, "entries": {}, "hits": 0, "misses": 0}
+
+async def save_intent_cache():
+    # Копия в цикле событий: поток executor не должен видеть изменения словаря во время pickle
+    data = dict(INTENT_CACHE)
+    data["entries"] = dict(INTENT_CACHE["entries"])
+    try: await save_snapshot(INTENT_PATH, data)
+    except Exception as e: log.warning(f"SmartPlex: remembered commands not saved: {e}")
+
+def publish_intent_stats():
+    hits, misses = INTENT_CACHE["hits"], INTENT_CACHE["misses"]
+    state.set("sensor.smartplex_intent_cache", len(INTENT_CACHE["entries"]),
+              new_attributes={"hits": hits, "misses": misses, "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None,
+                              "unit_of_measurement": "commands", "friendly_name": "SmartPlex remembered commands"})
+
+@service
+async def plex_smart_forget_commands():
+    # Забыть все запомненные ответы ИИ, например если ИИ неправильно понял команду
+    if INTENT_CACHE is None: await load_intent_cache()
+    INTENT_CACHE["entries"] = {}
+    publish_intent_stats()
+    await save_intent_cache()
+
 @service
 def plex_smart_launch(command_text=None):
     if not command_text: return
     task.create(smartplex_execution, cmd=command_text)
 
 async def smartplex_execution(cmd):
-    if not PLEX_LIBS: await update_plex_cache()
-
-    # === ПРОМПТ ===
-    prompt = (
-        "Ты — SmartPlex, драйвер API Plex. Выдай JSON.\n"
-        "ОЧИСТКА: Удали '4k', 'uhd', 'imax', 'hdr' из title.\n\n"
-        "1. ЖЕСТКИЕ СЦЕНАРИИ (ПРИОРЕТЕТ):\n"
-        "- 'свежий', 'новый', 'последний' -> sort_order='newest', shuffle=false, year=2024 (не оставляй year пустым).\n"
-        "- 'ранний', 'классика', 'старый' -> sort_order='oldest', year=2000 (примерный предел).\n"
-        "- 'лучший', 'популярный' -> sort_order='top_rated'.\n"
-        "- 'Любое', 'Случайное' -> sort_order='random', shuffle=true.\n"
-        "- 'Linkin Park 2023' (Музыка + Год) -> {artist: 'Linkin Park', year: 2023}.\n\n"
-
-        "2. ПРАВИЛА ПАДЕЖЕЙ И ЯЗЫКА:\n"
-        "- Жанры ТОЛЬКО в ИМЕНИТЕЛЬНОМ падеже: 'КомедиЮ' -> 'Комедия', 'УжасЫ' -> 'Ужасы'.\n"
-        "- Жанры пиши на русском: Комедия, Боевик, Драма, Фантастика.\n\n"
-
-        "3. ЗОНЫ (room):\n"
-        "- 'зал', 'гостиная' -> 'зал'\n"
-        "- 'малая', 'детская' -> 'малая_спальня'\n"
-        "- 'спальня' -> 'спальня'\n\n"
+    global COMMAND_SEQ
+    COMMAND_SEQ += 1
+    seq = COMMAND_SEQ
+    trace = trace_start()
+    info = {"command": cmd, "parsed_by": "ai"}
+    # Первая загрузка после перезапуска без снимка еще идет: работаем без кэша (поиск на сервере)
+    try: await run_within(stage_deadline(trace, "cache"), ensure_plex_cache)
+    except asyncio.TimeoutError:
+        log.warning("SmartPlex: library cache not ready, searching on the Plex server")
+        info["degraded"] = ["cache"]
+    trace_span(trace, "cache")
+
+    # Простые команды берутся из кэша, ИИ спрашиваем только если локальный разбор не уверен
+    data = parse_command_locally(cmd) if LOCAL_PARSER else None
+    trace_span(trace, "parse")
+    if data: info["parsed_by"] = "local"
+
+    spec_room, room_key, playing = None, None, False
+    try:
+        # Упреждающее включение: ТВ названной в команде комнаты запускается, пока ИИ думает
+        if data is None and SPECULATIVE_BOOT:
+            spec_room = detect_room(command_words(cmd))[0]
+            if spec_room: claim_zone_boot(spec_room, seq)
+
+        # === ПРОМПТ ===
+        prompt_rules = (
+            "Ты — SmartPlex, драйвер API Plex. Выдай JSON.\n"
+            "ОЧИСТКА: Удали '4k', 'uhd', 'imax', 'hdr' из title.\n\n"
+            "1. ЖЕСТКИЕ СЦЕНАРИИ (ПРИОРЕТЕТ):\n"
+            "- 'свежий', 'новый', 'последний' -> sort_order='newest', shuffle=false, year=2024 (не оставляй year пустым).\n"
+            "- 'ранний', 'классика', 'старый' -> sort_order='oldest', year=2000 (примерный предел).\n"
+            "- 'лучший', 'популярный' -> sort_order='top_rated'.\n"
+            "- 'Любое', 'Случайное' -> sort_order='random', shuffle=true.\n"
+            "- 'Linkin Park 2023' (Музыка + Год) -> {artist: 'Linkin Park', year: 2023}.\n\n"
+
+            "2. ПРАВИЛА ПАДЕЖЕЙ И ЯЗЫКА:\n"
+            "- Жанры ТОЛЬКО в ИМЕНИТЕЛЬНОМ падеже: 'КомедиЮ' -> 'Комедия', 'УжасЫ' -> 'Ужасы'.\n"
+            "- Жанры пиши на русском: Комедия, Боевик, Драма, Фантастика.\n\n"
+
+            "3. ЗОНЫ (room):\n"
+            "- 'зал', 'гостиная' -> 'зал'\n"
+            "- 'малая', 'детская' -> 'малая_спальня'\n"
+            "- 'спальня' -> 'спальня'\n\n"
         
-        "4. ТИПЫ (type):\n"
-        "- 'movie': Фильмы.\n"
-        "- 'show': Сериалы.\n"
-        "- 'music': Музыка.\n"
-        "- 'music_video': Музыкальные Клипы.\n"
-        "- 'playlist': Плейлисты.\n\n"
-
-        "5. ПРАВИЛА ЗАПОЛНЕНИЯ query:\n"
-        "--- MOVIE ---\n"
-        "   * РАЗРЕШЕНО: title, year, genre, actor, director, studio, collection, country, decade, contentRating.\n"
-        "--- SHOW ---\n"
-        "   * РАЗРЕШЕНО: show_name, season, episode, genre, year, studio.\n"
-        "--- MUSIC ---\n"
-        "   * РАЗРЕШЕНО: artist, album, title, year, genre, mood.\n"
-        "--- MUSIC_VIDEO ---\n"
-        "   * РАЗРЕШЕНО: artist.\n\n"
-
-        "6. УПРАВЛЕНИЕ (control):\n"
-        "- resume_mode: 'resume' (продолжи, досмотри), 'start' (включи, заново). DEFAULT: 'start'.\n"
-        "- sort_order: 'newest', 'oldest', 'top_rated', 'random', 'default'.\n"
-        "- shuffle: true (если 'перемешай' или запрос общий).\n\n"
+            "4. ТИПЫ (type):\n"
+            "- 'movie': Фильмы.\n"
+            "- 'show': Сериалы.\n"
+            "- 'music': Музыка.\n"
+            "- 'music_video': Музыкальные Клипы.\n"
+            "- 'playlist': Плейлисты.\n\n"
+
+            "5. ПРАВИЛА ЗАПОЛНЕНИЯ query:\n"
+            "--- MOVIE ---\n"
+            "   * РАЗРЕШЕНО: title, year, genre, actor, director, studio, collection, country, decade, contentRating.\n"
+            "--- SHOW ---\n"
+            "   * РАЗРЕШЕНО: show_name, season, episode, genre, year, studio.\n"
+            "--- MUSIC ---\n"
+            "   * РАЗРЕШЕНО: artist, album, title, year, genre, mood.\n"
+            "--- MUSIC_VIDEO ---\n"
+            "   * РАЗРЕШЕНО: artist.\n\n"
+
+            "6. УПРАВЛЕНИЕ (control):\n"
+            "- resume_mode: 'resume' (продолжи, досмотри), 'start' (включи, заново). DEFAULT: 'start'.\n"
+            "- sort_order: 'newest', 'oldest', 'top_rated', 'random', 'default'.\n"
+            "- shuffle: true (если 'перемешай' или запрос общий).\n\n"
         
-        "JSON OUTPUT:\n"
-        "{\n"
-        "  \"control\": { \"room\": \"...\", \"type\": \"...\", \"resume_mode\": \"start/resume\", \"sort_order\": \"...\", \"shuffle\": false },\n"
-        "  \"query\": { \"title\": \"...\", \"show_name\": \"...\", \"artist\": \"...\", \"album\": \"...\", \"season\": null, \"episode\": null, \"actor\": \"...\", \"genre\": \"...\", \"year\": null, \"studio\": \"...\", \"collection\": \"...\", \"decade\": null, \"contentRating\": \"...\", \"mood\": \"...\" }\n"
-        "}\n"
-        f"USER COMMAND: {cmd}"
-    )
+            "JSON OUTPUT:\n"
+            "{\n"
+            "  \"control\": { \"room\": \"...\", \"type\": \"...\", \"resume_mode\": \"start/resume\", \"sort_order\": \"...\", \"shuffle\": false },\n"
+            "  \"query\": { \"title\": \"...\", \"show_name\": \"...\", \"artist\": \"...\", \"album\": \"...\", \"season\": null, \"episode\": null, \"actor\": \"...\", \"genre\": \"...\", \"year\": null, \"studio\": \"...\", \"collection\": \"...\", \"decade\": null, \"contentRating\": \"...\", \"mood\": \"...\" }\n"
+            "}\n"
+        )
+        prompt = f"{prompt_rules}USER COMMAND: {cmd}"
 
-    try:
-        response = await service.call("ai_task", "generate_data", 
-                                      entity_id=AI_ENTITY_ID, 
-                                      task_name="SmartPlex", 
-                                      instructions=prompt, return_response=True)
-        data = json.loads(response.get('data', '').replace('```json', '').replace('```', '').strip())
+        # Та же команда при том же промпте и зонах: запомненный ответ, без вызова ИИ
+        intent_key = None
+        if data is None and INTENT_CACHE_SIZE:
+            intent_key = " ".join(command_words(cmd))
+            data = await lookup_intent(intent_key, intent_fingerprint(AI_PROMPT_STATIC if AI_COMPACT_PROMPT else prompt_rules))
+            if data: info["parsed_by"] = "memory"
+            trace_span(trace, "memory")
+
+        if data is None and breaker_allows("ai"):
+            if AI_COMPACT_PROMPT:
+                # Сначала постоянные правила, команда в конце, ответ приходит в полях AI_STRUCTURE
+                ai_args = {"instructions": f"{AI_PROMPT_STATIC}USER COMMAND: {cmd}", "structure": AI_STRUCTURE}
+            else:
+                ai_args = {"instructions": prompt}
+            try:
+                response = await run_within(stage_deadline(trace, "ai"), service.call, "ai_task", "generate_data", 
+                                            entity_id=AI_ENTITY_ID, 
+                                            task_name="SmartPlex", 
+                                            return_response=True, **ai_args)
+                data = response.get("data")
+                breaker_result("ai", True)
+            except Exception as e:
+                log.warning(f"SmartPlex: {AI_ENTITY_ID} did not answer: {repr(e)}")
+                breaker_result("ai", False, e)
+            trace_span(trace, "ai")
+        elif data is not None:
+            log.debug(f"SmartPlex: parsed locally, AI skipped: {data}")
+
+        if data is None:
+            # ИИ недоступен: запомненный ответ, даже устаревший, иначе локальный разбор с более низким порогом
+            data = stale_intent(intent_key) if intent_key else None
+            info["parsed_by"] = "memory_stale"
+            if data is None and LOCAL_PARSER:
+                data = parse_command_locally(cmd, LOCAL_PARSER_FALLBACK_SCORE)
+                info["parsed_by"] = "local_fallback"
+            if data is None: info["parsed_by"] = None; raise RuntimeError(f"{AI_ENTITY_ID} unavailable and the command is not understood without it")
+            info.setdefault("degraded", []).append("ai")
+            log.warning(f"SmartPlex: AI unavailable, command parsed by {info['parsed_by']}: {data}")
         
-        control = data.get("control", {})
-        query = data.get("query", {})
+        data = normalize_ai_data(data)
+        if intent_key and info["parsed_by"] == "ai": remember_intent(intent_key, data)
+        control = data["control"]
+        query = data["query"]
         
-        room_key = control.get("room", "зал")
-        if room_key not in ZONES: room_key = "зал"
+        room_key = control["room"]
         zone = ZONES[room_key]
+        info.update({"room": room_key, "type": control["type"]})
         
-        hw_task = task.create(boot_hardware_process(zone))
+        if spec_room and spec_room != room_key:
+            # ИИ выбрал другую комнату: догадка отбрасывается (выключается, если ее не использует другая команда)
+            log.debug(f"SmartPlex: speculative boot of {spec_room} not needed, AI chose {room_key}")
+            release_zone_boot(spec_room, seq)
+        if not claim_zone_command(room_key, seq):
+            info["error"] = "superseded"
+            log.debug(f"SmartPlex: a newer command for {room_key} is running, dropping '{cmd}'")
+            return
+        # Использует уже идущее включение этой зоны (упреждающее или от предыдущей команды)
+        hw_task = claim_zone_boot(room_key, seq)
         
         payload = {"allow_multiple": 1}
-        m_type = control.get("type", "movie")
+        m_type = control["type"]
         
-        if control.get("resume_mode") == "resume": payload["resume"] = 1
+        if control["resume_mode"] == "resume": payload["resume"] = 1
         else: payload["resume"] = 0; payload["offset"] = 0
 
-        sort_mode = control.get("sort_order", "default")
+        sort_mode = control["sort_order"]
         
         if sort_mode == "newest": 
             payload["sort"] = "originallyAvailableAt:desc"
@@ -231,7 +1534,7 @@ async def smartplex_execution(cmd):
         elif sort_mode == "top_rated": 
             payload["sort"] = "audienceRating:desc"
             payload["shuffle"] = 0
-        elif control.get("shuffle") or sort_mode == "random": 
+        elif control["shuffle"] or sort_mode == "random": 
             payload["shuffle"] = 1
 
         media_type = "MOVIE"
@@ -239,38 +1542,58 @@ async def smartplex_execution(cmd):
         # >>> СЕРИАЛЫ
         if m_type == "show":
             media_type = "EPISODE"
-            lib_data = PLEX_LIBS.get("show")
-            if lib_data: payload["library_name"] = lib_data["title"]
             
             s_name = query.get("show_name") or query.get("title")
-            cached = find_in_cache("show", s_name)
+            cached = await find_title("show", s_name)
+            lib_name = library_name("show", cached)
+            if lib_name: payload["library_name"] = lib_name
             exact_episode = query.get("episode")
-            
-            if cached:
-                if exact_episode: payload["show.id"] = cached["id"]
-                else: payload["show.title"] = cached["title"] 
+            resume = control["resume_mode"] == "resume"
+
+            # Конкретная серия или «продолжи X»: id серии берется из индекса серий, без поиска на сервере
+            episode_key = None
+            if cached and (exact_episode or (resume and not query.get("season"))):
+                try: episode_key = await run_within(stage_deadline(trace, "match"), resolve_episode, cached, query)
+                except asyncio.TimeoutError as e:
+                    log.warning("SmartPlex: episode list not loaded in time, searching on the Plex server")
+                    breaker_result("plex", False, e)
+                    info.setdefault("degraded", []).append("episodes")
+
+            if episode_key:
+                payload["id"] = episode_key
             else:
-                if s_name: payload["show.title"] = s_name
+                if cached:
+                    if exact_episode: payload["show.id"] = cached["id"]
+                    else: payload["show.title"] = cached["title"] 
+                else:
+                    if s_name: payload["show.title"] = s_name
 
-            if query.get("season"): payload["season.index"] = int(query["season"])
-            if query.get("episode"): payload["episode.index"] = int(query["episode"])
-            
-            if not exact_episode and control.get("resume_mode") == "resume":
-                payload["episode.unwatched"] = 1 
-                payload["resume"] = 1
+                if query.get("season"): payload["season.index"] = int(query["season"])
+                if query.get("episode"): payload["episode.index"] = int(query["episode"])
+                
+                if not exact_episode and resume:
+                    payload["episode.unwatched"] = 1 
+                    payload["resume"] = 1
 
         # >>> МУЗЫКА
         elif m_type == "music":
             media_type = "MUSIC"
-            lib_data = PLEX_LIBS.get("music")
-            if lib_data: payload["library_name"] = lib_data["title"]
             
             artist = query.get("artist")
-            cached = find_in_cache("music", artist)
+            cached = await find_title("music", artist)
+            lib_name = library_name("music", cached)
+            if lib_name: payload["library_name"] = lib_name
             
             filter_active = query.get("year") or query.get("album") or query.get("title") or query.get("genre") or query.get("mood")
+            # Песня или альбом известного артиста: ищется среди треков / альбомов этого артиста
+            tier_item = None
+            if cached and not (query.get("year") or query.get("genre") or query.get("mood")):
+                if query.get("title"): tier_item = find_by_artist("track", cached, query["title"])
+                elif query.get("album"): tier_item = find_by_artist("album", cached, query["album"])
             
-            if cached and not filter_active:
+            if tier_item:
+                payload["id"] = tier_item["id"]
+            elif cached and not filter_active:
                 payload["id"] = cached["id"]
                 payload["shuffle"] = 1
             else:
@@ -285,11 +1608,11 @@ async def smartplex_execution(cmd):
         # >>> КЛИПЫ
         elif m_type == "music_video":
             media_type = "MUSIC" 
-            lib_data = PLEX_LIBS.get("music")
-            if lib_data: payload["library_name"] = lib_data["title"]
             
             artist = query.get("artist")
-            cached = find_in_cache("music", artist)
+            cached = await find_title("music", artist)
+            lib_name = library_name("music", cached)
+            if lib_name: payload["library_name"] = lib_name
             
             if cached:
                 payload["id"] = cached["id"]
@@ -301,14 +1624,36 @@ async def smartplex_execution(cmd):
         # >>> ФИЛЬМЫ
         elif m_type == "movie":
             media_type = "MOVIE"
-            lib_data = PLEX_LIBS.get("movie")
-            if lib_data: payload["library_name"] = lib_data["title"]
             
             f_title = query.get("title")
             has_filters = query.get("actor") or query.get("genre") or query.get("studio") or query.get("collection") or query.get("decade")
+            cached = await find_title("movie", f_title) if f_title and not has_filters else None
+            # Самый новый / самый старый / лучший по рейтингу / случайный фильм без других фильтров: выбирается из кэша
+            pick_mode = "random" if sort_mode == "default" and control["shuffle"] else sort_mode
+            if not f_title and pick_mode != "default" and not set(query) - {"unwatched"}:
+                cached = pick_in_cache("movie", pick_mode, query.get("unwatched"))
+            elif not f_title:
+                # Фильтры: подходящие фильмы из индекса фасетов, опечатки исправлены. Единственное совпадение
+                # (не для актера / режиссера, в кэше только часть из них) или выбор по сортировке / случайный
+                # среди совпадений включается по id; иначе сервер получает исправленные фильтры и, как раньше, включает все совпадения
+                filtered = filter_in_cache("movie", query)
+                if filtered:
+                    found, corrected = filtered
+                    if corrected:
+                        log.debug(f"SmartPlex: filters corrected {corrected}")
+                        query = dict(query, **corrected)
+                    single = sum(len(positions) for _, _, positions in found) == 1 and not set(query) & set(FACET_PARTIAL)
+                    if pick_mode != "default" or single:
+                        cached = pick_among(found, pick_mode)
+            if cached and not f_title:
+                payload.pop("sort", None)
+                payload["shuffle"] = 0
+            lib_name = library_name("movie", cached)
+            if lib_name: payload["library_name"] = lib_name
             
-            if f_title and not has_filters:
-                cached = find_in_cache("movie", f_title)
+            if cached and not f_title:
+                payload["id"] = cached["id"]
+            elif f_title and not has_filters:
                 if cached: payload["id"] = cached["id"]
                 else: payload["title"] = f_title
             else:
@@ -328,30 +1673,210 @@ async def smartplex_execution(cmd):
         elif m_type == "playlist":
             media_type = "PLAYLIST"
             p_title = query.get("title")
-            await hw_task
+            trace_span(trace, "match")
+            client = await wait_for_boot(hw_task, stage_deadline(trace, "hardware"))
+            trace_span(trace, "hardware")
+            info["device"] = device_timings(client)
+            if client.get("deadline"): info.setdefault("degraded", []).append("hardware")
+            if not client["found"]: log.warning(f"SmartPlex: {zone['plex_client']} did not appear in {client['elapsed']:.0f} s, trying anyway")
             target_dev = zone.get("plex_device_id")
             target_ent = zone.get("plex_client")
-            await service.call("media_player", "play_media", 
-                               device_id=target_dev, entity_id=target_ent,
-                               media_content_id=json.dumps({"playlist_name": p_title, "shuffle": 1}), 
-                               media_content_type="PLAYLIST")
+            playing = True
+            await run_within(stage_deadline(trace, "play"), service.call, "media_player", "play_media", 
+                             device_id=target_dev, entity_id=target_ent,
+                             media_content_id=json.dumps({"playlist_name": p_title, "shuffle": 1}), 
+                             media_content_type="PLAYLIST")
+            trace_span(trace, "play_media")
             return
 
         # 3. ФИНАЛ
-        await hw_task 
+        trace_span(trace, "match")
+        client = await wait_for_boot(hw_task, stage_deadline(trace, "hardware"))
+        trace_span(trace, "hardware")
+        info["device"] = device_timings(client)
+        if client.get("deadline"): info.setdefault("degraded", []).append("hardware")
+        if not client["found"]: log.warning(f"SmartPlex: {zone['plex_client']} did not appear in {client['elapsed']:.0f} s, trying anyway")
         log.debug(f"SmartPlex Payload: {payload}")
         target_dev = zone.get("plex_device_id")
         target_ent = zone.get("plex_client") if not target_dev else None
         
-        await service.call("media_player", "play_media", 
-                           device_id=target_dev, entity_id=target_ent,
-                           media_content_id=json.dumps(payload), 
-                           media_content_type=media_type)
+        # Дальше телевизор остается включенным: запрос воспроизведения с таймаутом все еще может его запустить
+        playing = True
+        # Прямому воспроизведению — его доля дедлайна запуска, play_media — остаток
+        play_deadline, play_started = stage_deadline(trace, "play"), time.monotonic()
+        try: direct = await run_within(play_deadline * DIRECT_PLAY_SHARE, direct_play, zone, payload, media_type)
+        except asyncio.TimeoutError as e:
+            log.warning("SmartPlex: direct play timed out, using play_media")
+            breaker_result("plex", False, e)
+            direct = False
+        info["dispatch"] = "direct" if direct else "play_media"
+        if info["dispatch"] == "play_media":
+            await run_within(max(play_deadline - (time.monotonic() - play_started), 0.1), service.call, "media_player", "play_media", 
+                             device_id=target_dev, entity_id=target_ent,
+                             media_content_id=json.dumps(payload), 
+                             media_content_type=media_type)
+        trace_span(trace, "play_media")
 
+    except asyncio.CancelledError:
+        # Новая команда для той же зоны перехватила управление
+        info["error"] = "superseded"
+        raise
     except Exception as e:
+        info["error"] = str(e)
         log.error(f"SmartPlex Error: {e}")
+    finally:
+        # Вытеснена, ошиблась или отброшена до воспроизведения: включения, нужные только этой команде, останавливаются или откатываются
+        if not playing:
+            for room in {spec_room, room_key}:
+                if room: release_zone_boot(room, seq)
+        publish_command_trace(trace, info)
+
+# === 6. ЗАМЕРЫ ВРЕМЕНИ ===
+# Каждая команда замеряется по этапам: "spans" идут друг за другом и в сумме дают total,
+# "device" показывает, сколько ТВ занимал в фоне (включение, запуск приложения, поиск клиента)
+def trace_start():
+    now = time.monotonic()
+    return {"at": time.strftime("%Y-%m-%d %H:%M:%S"), "start": now, "mark": now, "spans": {}}
+
+def trace_span(trace, stage):
+    # Время с предыдущего этапа, в мс
+    now = time.monotonic()
+    trace["spans"][stage] = trace["spans"].get(stage, 0) + round((now - trace["mark"]) * 1000)
+    trace["mark"] = now
+
+def device_timings(client):
+    return {"boot": round(client.get("boot", 0) * 1000), "app": round(client.get("app", 0) * 1000),
+            "scan": round(client["elapsed"] * 1000), "scans": client["scans"], "found": client["found"]}
+
+def publish_command_trace(trace, info):
+    entry = dict(info)
+    entry.update({"at": trace["at"], "total_ms": round((time.monotonic() - trace["start"]) * 1000), "spans": trace["spans"]})
+    TRACE_COMMANDS.append(entry)
+    del TRACE_COMMANDS[:-TRACE_HISTORY]
+    attrs = dict(entry)
+    attrs.update({"history": list(TRACE_COMMANDS), "unit_of_measurement": "ms", "friendly_name": "SmartPlex last command"})
+    state.set("sensor.smartplex_last_command", entry["total_ms"], new_attributes=attrs)
+    if TRACE_LOG: log.info(f"SmartPlex trace: {json.dumps(entry, ensure_ascii=False)}")
+
+def publish_cache_stats(mode, started, changed):
+    # mode: "full" полная загрузка, "delta" обновление или "snapshot" загрузка с диска; changed: типы библиотек с новыми данными
+    counts = {l_type: cache_count(l_type) for l_type in PLEX_CACHE}
+    sections = {lib_info["title"]: cache_size(PLEX_CACHE.get(l_type, {}).get(lib_info["id"]))
+                for l_type, libs in PLEX_LIBS.items() for lib_info in libs}
+    stats = {"mode": mode, "duration_ms": round((time.monotonic() - started) * 1000), "changed": changed,
+             "items": counts, "sections": sections, "at": time.strftime("%Y-%m-%d %H:%M:%S")}
+    attrs = dict(stats)
+    attrs.update({"unit_of_measurement": "items", "friendly_name": "SmartPlex cache"})
+    state.set("sensor.smartplex_cache", sum(counts.values()), new_attributes=attrs)
+    if TRACE_LOG: log.info(f"SmartPlex cache: {json.dumps(stats)}")
 
 @time_trigger('startup')
 @time_trigger('cron(0 * * * *)') 
 async def cron_cache():
+    # Команды сразу обслуживаются из снимка, обновление ниже доводит его до актуального
+    await ensure_plex_cache()
+    if ZONE_TIMINGS is None: await load_zone_timings()
+    if INTENT_CACHE is None: await load_intent_cache()
+    # sensor.smartplex_health показывает оба выключателя с самого начала
+    for name in ["plex", "ai"]: breaker_state(name)
+    publish_breakers()
+    # Пока поток уведомлений работает, он держит кэш актуальным, опрос — только запасной вариант
+    if NOTIFY_STATE["connected"]: return
     await update_plex_cache()
+
+@time_trigger('shutdown')
+async def close_plex_session():
+    global PLEX_SESSION
+    if PLEX_SESSION is not None:
+        await PLEX_SESSION.close()
+        PLEX_SESSION = None
+
+# === 7. УВЕДОМЛЕНИЯ СЕРВЕРА ===
+# Сервер Plex сообщает об изменениях библиотеки через websocket. Каждое изменение попадает в кэш за
+# секунды через дельта-обновление, удаления — через проверку размера раздела в refresh_section
+@time_trigger('startup')
+async def plex_notifications():
+    # Работает все время жизни скрипта. После обрыва переподключается с растущими паузами
+    # (NOTIFY_BACKOFF_MIN, удваиваясь до NOTIFY_BACKOFF_MAX), тем временем опрашивает cron_cache
+    if not LIVE_UPDATES: return
+    task.unique("smartplex_notifications")
+    backoff = NOTIFY_BACKOFF_MIN
+    while True:
+        connected_at = time.monotonic()
+        try:
+            url = f"{PLEX_URL}/:/websockets/notifications?X-Plex-Token={PLEX_TOKEN}"
+            async with plex_session().ws_connect(url, heartbeat=NOTIFY_HEARTBEAT) as ws:
+                publish_notify_state(True)
+                # Все, что изменилось, пока поток был недоступен, подхватит первое обновление
+                queue_notifications(None)
+                while True:
+                    msg = await ws.receive()
+                    if msg.type != aiohttp.WSMsgType.TEXT: break
+                    queue_notifications(msg.data)
+            log.debug("SmartPlex: notification stream closed by the server")
+        except Exception as e:
+            log.warning(f"SmartPlex: notification stream unavailable, hourly refresh until it is back: {type(e).__name__} {e}")
+        publish_notify_state(False)
+        # После долгого соединения отсчет снова начинается с самой короткой паузы
+        if time.monotonic() - connected_at > NOTIFY_BACKOFF_MAX: backoff = NOTIFY_BACKOFF_MIN
+        await task.sleep(backoff * random.uniform(0.5, 1.0))
+        backoff = min(backoff * 2, NOTIFY_BACKOFF_MAX)
+
+def queue_notifications(text):
+    # text: одно сообщение уведомлений, None = обновить в любом случае. Изменения ждут apply_notifications в NOTIFY_PENDING
+    global NOTIFY_PENDING, NOTIFY_APPLY
+    if NOTIFY_PENDING is None: NOTIFY_PENDING = {"changes": 0, "deleted": set(), "episodes": False}
+    if text is not None and not read_timeline(text, NOTIFY_PENDING): return
+    if text is None: NOTIFY_PENDING["changes"] += 1
+    if NOTIFY_APPLY is None or NOTIFY_APPLY.done(): NOTIFY_APPLY = task.create(apply_notifications)
+
+async def apply_notifications():
+    # Сканирование библиотеки присылает пачки изменений: они собираются NOTIFY_DEBOUNCE секунд и применяются
+    # одним дельта-обновлением. У разделов с удалениями размер проверяется сразу
+    global NOTIFY_PENDING
+    while NOTIFY_PENDING and NOTIFY_PENDING["changes"]:
+        await task.sleep(NOTIFY_DEBOUNCE)
+        pending, NOTIFY_PENDING = NOTIFY_PENDING, None
+        # Обновление, начатое до этих изменений, их не увидит, а его задачи разделов запишут обратно
+        # прочитанные точки синхронизации: проверки удалений назначаем, когда оно закончится
+        while PLEX_REFRESH is not None and not PLEX_REFRESH.done(): await asyncio.shield(PLEX_REFRESH)
+        for key, sync in PLEX_SYNC.items():
+            if key.split(":")[0] in pending["deleted"] or "" in pending["deleted"]: PLEX_SYNC[key] = dict(sync, reconciled_at=0)
+        if pending["episodes"]: EPISODE_INDEX.clear()
+        await update_plex_cache()
+        NOTIFY_STATE["changes"] += pending["changes"]
+        NOTIFY_STATE["refreshes"] += 1
+        publish_notify_state(NOTIFY_STATE["connected"])
+
+def publish_notify_state(connected):
+    if connected and not NOTIFY_STATE["connected"]:
+        NOTIFY_STATE.update({"since": time.strftime("%Y-%m-%d %H:%M:%S"), "connects": NOTIFY_STATE["connects"] + 1})
+    NOTIFY_STATE["connected"] = connected
+    attrs = dict(NOTIFY_STATE)
+    attrs["friendly_name"] = "SmartPlex notifications"
+    state.set("sensor.smartplex_notifications", "connected" if connected else "disconnected", new_attributes=attrs)
+
+@pyscript_compile
+def read_timeline(text, pending):
+    # Изменения библиотеки в одном уведомлении ({"NotificationContainer": {"type": "timeline", "TimelineEntry": [...]}}).
+    # Готовые элементы (state 5) считаются изменениями, удаленные (state 9) еще и отмечают свой раздел для
+    # проверки размера, серии сбрасывают загруженные списки серий. Возвращает число учтенных записей
+    try: data = json.loads(text)
+    except ValueError: return 0
+    container = data.get("NotificationContainer") if isinstance(data, dict) else None
+    if not isinstance(container, dict): return 0
+    if container.get("type") == "playing":
+        # Остановленное воспроизведение могло поменять отметку просмотра, ее прочитает дельта-обновление
+        count = sum(1 for entry in container.get("PlaySessionStateNotification", []) if entry.get("state") == "stopped")
+        pending["changes"] += count
+        return count
+    if container.get("type") != "timeline": return 0
+    count = 0
+    for entry in container.get("TimelineEntry", []):
+        if entry.get("identifier") != "com.plexapp.plugins.library" or entry.get("type") not in NOTIFY_TYPES: continue
+        if entry.get("state") == 9: pending["deleted"].add(str(entry.get("sectionID", "")))
+        elif entry.get("state") != 5: continue
+        if entry.get("type") == 4: pending["episodes"] = True
+        count += 1
+    pending["changes"] += count
+    return count
@@ -0,0 +1,147 @@
+"""Minimal stand-ins for the pyscript runtime (service, state, task, log and decorators).
+
+Just enough of pyscript to exec plex_smart_launch.py as plain Python and drive it with
+scripted devices. Every sleep and timeout goes through ``scale`` so a benchmark
+can run faster than real time.
+"""
+import asyncio
+import re
+import time
+
+ENTITY_RE = re.compile(r"\b(?:media_player|remote|button|sensor|binary_sensor|switch|pyscript)\.\w+")
+
+
+class FakeLog:
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.lines = []
+
+    def _log(self, level, msg):
+        self.lines.append((level, msg))
+        if self.verbose or level in ("warning", "error"):
+            print(f"[{level}] {msg}")
+
+    def debug(self, msg): self._log("debug", msg)
+    def info(self, msg): self._log("info", msg)
+    def warning(self, msg): self._log("warning", msg)
+    def error(self, msg): self._log("error", msg)
+
+
+class FakeState:
+    def __init__(self):
+        self.values, self.attrs = {}, {}
+        self.changed = asyncio.Event()
+
+    def get(self, entity):
+        return self.values.get(entity)
+
+    def getattr(self, entity):
+        return dict(self.attrs.get(entity, {}))
+
+    def set(self, entity, value=None, new_attributes=None, **kwargs):
+        self.values[entity] = value
+        if new_attributes is not None:
+            self.attrs[entity] = dict(new_attributes)
+        self.attrs.setdefault(entity, {}).update(kwargs)
+        # Wake every wait_until so it re-checks its trigger
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def persist(self, entity, default_value=None, default_attributes=None):
+        if entity not in self.values:
+            self.set(entity, default_value, default_attributes or {})
+
+    def check(self, expr):
+        names = {}
+        def sub(m):
+            names[f"_e{len(names)}"] = self.values.get(m.group(0))
+            return f"_e{len(names) - 1}"
+        return bool(eval(ENTITY_RE.sub(sub, expr), {}, names))
+
+
+class FakeService:
+    """``@service`` decorator plus ``service.call`` routed to scripted async handlers."""
+
+    def __init__(self):
+        self.handlers, self.calls = {}, []
+
+    def __call__(self, func=None, *args, **kwargs):
+        return func if callable(func) else (lambda f: f)
+
+    async def call(self, domain, name, **kwargs):
+        self.calls.append((domain, name, kwargs))
+        handler = self.handlers.get((domain, name))
+        if handler:
+            return await handler(**kwargs)
+        return None
+
+
+class FakeTask:
+    def __init__(self, state, scale=1.0):
+        self.state, self.scale = state, scale
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds * self.scale)
+
+    def create(self, func, *args, **kwargs):
+        return asyncio.ensure_future(func if asyncio.iscoroutine(func) else func(*args, **kwargs))
+
+    def cancel(self, task_id=None):
+        (task_id or asyncio.current_task()).cancel()
+
+    def current_task(self):
+        return asyncio.current_task()
+
+    async def executor(self, func, *args, **kwargs):
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def wait(self, task_set, timeout=None, return_when=asyncio.ALL_COMPLETED):
+        return await asyncio.wait(task_set, timeout=None if timeout is None else timeout * self.scale, return_when=return_when)
+
+    async def wait_until(self, state_trigger=None, timeout=None, state_check_now=True, **kwargs):
+        deadline = None if timeout is None else time.monotonic() + timeout * self.scale
+        if state_trigger and state_check_now and self.state.check(state_trigger):
+            return {"trigger_type": "state"}
+        while True:
+            changed = self.state.changed
+            left = None if deadline is None else deadline - time.monotonic()
+            if left is not None and left <= 0:
+                return {"trigger_type": "timeout"}
+            try:
+                await asyncio.wait_for(changed.wait(), left)
+            except asyncio.TimeoutError:
+                return {"trigger_type": "timeout"}
+            if state_trigger and self.state.check(state_trigger):
+                return {"trigger_type": "state"}
+
+    def unique(self, name, kill_me=False):
+        pass
+
+
+def passthrough_decorator(*args, **kwargs):
+    if len(args) == 1 and callable(args[0]) and not kwargs:
+        return args[0]
+    return lambda func: func
+
+
+class FakePyscript:
+    """Loads a pyscript file into a namespace backed by the fakes above."""
+
+    def __init__(self, scale=1.0, verbose=False):
+        self.log = FakeLog(verbose)
+        self.state = FakeState()
+        self.service = FakeService()
+        self.task = FakeTask(self.state, scale)
+
+    def load(self, path):
+        with open(path, encoding="utf-8") as f:
+            source = f.read()
+        ns = {
+            "__name__": "pyscript_bench",
+            "log": self.log, "state": self.state, "service": self.service, "task": self.task,
+            "time_trigger": passthrough_decorator, "state_trigger": passthrough_decorator,
+            "event_trigger": passthrough_decorator, "task_unique": passthrough_decorator,
+            "pyscript_compile": passthrough_decorator, "pyscript_executor": passthrough_decorator,
+        }
+        exec(compile(source, path, "exec"), ns)
+        return ns
@@ -0,0 +1,329 @@
+"""Local aiohttp stand-in for the parts of the Plex Media Server API the script uses.
+
+Serves synthetic movie, show and music sections of any size with the same XML
+shape as a real server: paging through X-Plex-Container-Start/Size, totalSize,
+the updatedAt>> / lastViewedAt>> and unwatched filters, gzip and type=9/10
+(albums and tracks of the music section), plus the episode list of every
+show (allLeaves). Movies and shows come in two sections each, like "Movies"
+and "4K Movies" on a real server, and carry release dates, audience ratings
+and watched counts. Movies also have genre, director, cast, country and
+studio tags. Direct play is served too: /identity, play queues and playMedia
+to a client (recorded in played).
+/hubs/search finds titles by word prefix like the server's search box, and
+add_late() adds the LATE titles as if they arrived after the cache was built.
+The notification websocket (/:/websockets/notifications) sends timeline
+entries to every connected client: add_title() and remove_title() change a
+section and announce it, drop_clients() cuts the connections (and with
+refuse=True turns new ones away until accept_clients()).
+"""
+import asyncio
+import json
+import random
+from urllib.parse import unquote
+from xml.sax.saxutils import quoteattr
+
+from aiohttp import web
+
+WORDS = ["star", "night", "dark", "river", "king", "ghost", "city", "blue", "iron", "storm",
+         "love", "war", "moon", "code", "house", "last", "lost", "fire", "ice", "road",
+         "silent", "golden", "broken", "wild", "secret", "empire", "shadow", "garden", "winter", "summer"]
+
+# Titles the command corpus refers to, always present in the synthetic library (per section)
+KNOWN = {
+    "1": ["Inception", "The Gentlemen", "Avatar", "Interstellar", "The Matrix", "Blade Runner 2049"],
+    "2": ["The Office", "House M.D.", "Rick and Morty", "Breaking Bad"],
+    "3": ["Linkin Park", "Rammstein", "Daft Punk", "Queen"],
+    "4": ["Dune", "Avatar"],
+    "5": ["Bluey", "Peppa Pig"],
+}
+# Titles added to the server after the first cache build (add_late), found through /hubs/search
+LATE = {"1": ["Oppenheimer"], "5": ["Hilda"]}
+SECTIONS = {"1": ("movie", "Movies"), "2": ("show", "TV Shows"), "3": ("artist", "Music"),
+            "4": ("movie", "4K Movies"), "5": ("show", "Kids Shows")}
+SHARE = {"4": 0.25, "5": 0.25}  # Second sections are smaller: this share of the movie / show count
+# Movie tags as in a section listing: a few genres, the director, the top-billed cast, country, studio
+GENRES = ["Comedy", "Drama", "Action", "Sci-Fi", "Thriller", "Horror", "Animation", "Documentary", "Romance", "Adventure"]
+NAMES = ["Tom", "Emma", "Leo", "Anna", "Chris", "Kate", "Brad", "Meryl", "Denzel", "Scarlett"]
+SURNAMES = ["Hanks", "Stone", "Watson", "Nolan", "Pratt", "Winslet", "Pitt", "Streep", "Washington", "Johansson", "Scott", "Fincher"]
+STUDIOS = ["Warner Bros.", "Universal Pictures", "Pixar", "A24", "Paramount Pictures"]
+CREDITS = {  # Known titles get their real credits
+    "Inception": {"Genre": ["Sci-Fi", "Thriller"], "Director": ["Christopher Nolan"], "Role": ["Leonardo DiCaprio", "Tom Hardy"]},
+    "Interstellar": {"Genre": ["Sci-Fi", "Drama"], "Director": ["Christopher Nolan"], "Role": ["Matthew McConaughey", "Anne Hathaway"]},
+    "The Gentlemen": {"Genre": ["Comedy", "Action"], "Director": ["Guy Ritchie"], "Role": ["Matthew McConaughey", "Hugh Grant"]},
+}
+WATCHED = {"The Office": 7, "Breaking Bad": 12}  # Episodes already watched, in order
+# Albums and songs the command corpus refers to, every other artist gets random ones
+DISCOGRAPHY = {
+    "Linkin Park": {"Meteora": ["Numb", "Faint", "Somewhere I Belong"], "Hybrid Theory": ["In the End", "Crawling"]},
+    "Queen": {"A Night at the Opera": ["Bohemian Rhapsody", "Love of My Life"]},
+    "Daft Punk": {"Discovery": ["One More Time", "Digital Love"]},
+}
+ALBUM, TRACK = "9", "10"  # Plex type numbers
+MACHINE_ID = "mock-server"
+
+
+class MockPlex:
+    def __init__(self, movies=2000, shows=300, artists=500, latency=0.0, seed=1):
+        self.latency = latency
+        self.requests = []
+        self.queues, self.played = {}, []
+        self.clients, self.accepting = set(), True
+        rnd = random.Random(seed)
+        sizes = {"movie": movies, "show": shows, "artist": artists}
+        self.items = {}
+        self.seed = seed
+        for section, (kind, _) in SECTIONS.items():
+            items = []
+            for title in KNOWN[section]:
+                items.append(self.make_item(section, len(items), title, rnd))
+            while len(items) < int(sizes[kind] * SHARE.get(section, 1)):
+                title = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 4))).title()
+                items.append(self.make_item(section, len(items), title, rnd))
+            self.items[section] = items
+        self.tiers = {ALBUM: [], TRACK: []}
+        for artist in self.items["3"]:
+            self.make_discography(artist, rnd)
+
+    @staticmethod
+    def make_item(section, n, title, rnd):
+        year = rnd.randint(1960, 2025)
+        item = {"ratingKey": str(int(section) * 1000000 + n), "title": title, "year": str(year),
+                "addedAt": 1500000000 + n * 60, "updatedAt": 1500000000 + n * 60,
+                "originallyAvailableAt": f"{year}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}"}
+        # Sort and watched fields of movies and shows: most are rated, about a third is watched
+        if SECTIONS[section][0] != "artist":
+            if rnd.random() < 0.9: item["audienceRating"] = f"{rnd.uniform(2, 9.8):.1f}"
+            if SECTIONS[section][0] == "movie":
+                if rnd.random() < 0.3: item["viewCount"] = rnd.randint(1, 3)
+                item["studio"] = rnd.choice(STUDIOS)
+                item["contentRating"] = rnd.choice(["PG", "PG-13", "R"])
+                item["tags"] = CREDITS.get(title) or {
+                    "Genre": rnd.sample(GENRES, rnd.randint(1, 3)),
+                    "Director": [f"{rnd.choice(NAMES)} {rnd.choice(SURNAMES)}"],
+                    "Role": [f"{rnd.choice(NAMES)} {rnd.choice(SURNAMES)}" for _ in range(3)],
+                    "Country": [rnd.choice(["USA", "United Kingdom", "France"])],
+                }
+            else:
+                # Like the server, a show has a viewCount once any episode was played: about a third
+                # is watched through, a few are half watched
+                item["leafCount"] = rnd.randint(6, 60)
+                roll = rnd.random()
+                item["viewedLeafCount"] = item["leafCount"] if roll < 0.3 else item["leafCount"] // 2 if roll < 0.4 else 0
+                if item["viewedLeafCount"]: item["viewCount"] = item["viewedLeafCount"]
+            if item.get("viewCount"): item["lastViewedAt"] = 1600000000 + n
+        # Like a real library: a few foreign titles, some originalTitle copies of the title, most without one
+        roll = rnd.random()
+        if roll < 0.1: item["originalTitle"] = " ".join(rnd.choice(WORDS) for _ in range(2)).title()
+        elif roll < 0.2: item["originalTitle"] = title
+        return item
+
+    def make_discography(self, artist, rnd):
+        albums = DISCOGRAPHY.get(artist["title"])
+        if albums is None:
+            albums = {" ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 3))).title():
+                      [" ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 4))).title() for _ in range(rnd.randint(6, 12))]
+                      for _ in range(rnd.randint(1, 3))}
+        for album_title, tracks in albums.items():
+            album = {"ratingKey": str(8000000 + len(self.tiers[ALBUM])), "title": album_title, "parentRatingKey": artist["ratingKey"],
+                     "year": str(rnd.randint(1960, 2025)), "updatedAt": artist["updatedAt"]}
+            self.tiers[ALBUM].append(album)
+            for n, title in enumerate(tracks, 1):
+                self.tiers[TRACK].append({"ratingKey": str(9000000 + len(self.tiers[TRACK])), "title": title, "index": n,
+                                          "parentRatingKey": album["ratingKey"], "grandparentRatingKey": artist["ratingKey"],
+                                          "updatedAt": artist["updatedAt"]})
+
+    def add_late(self):
+        rnd = random.Random(self.seed + 1)
+        for section, titles in LATE.items():
+            for title in titles:
+                item = self.make_item(section, len(self.items[section]), title, rnd)
+                item["updatedAt"] = item["addedAt"] = 1900000000
+                self.items[section].append(item)
+
+    async def add_title(self, section, title):
+        rnd = random.Random(title)
+        item = self.make_item(section, len(self.items[section]), title, rnd)
+        item["updatedAt"] = item["addedAt"] = 2000000000
+        self.items[section].append(item)
+        await self.announce(section, item, state=5)
+        return item
+
+    async def remove_title(self, section, title):
+        item = next(i for i in self.items[section] if i["title"] == title)
+        self.items[section].remove(item)
+        await self.announce(section, item, state=9)
+
+    async def announce(self, section, item, state):
+        # Same shape as a real server: state 5 = processed, 9 = deleted; type 1 movie, 2 show, 8 artist
+        kind = {"movie": 1, "show": 2, "artist": 8}[SECTIONS[section][0]]
+        entry = {"identifier": "com.plexapp.plugins.library", "sectionID": section, "itemID": item["ratingKey"],
+                 "type": kind, "title": item["title"], "state": state, "updatedAt": item["updatedAt"]}
+        message = json.dumps({"NotificationContainer": {"type": "timeline", "size": 1, "TimelineEntry": [entry]}})
+        for ws in list(self.clients):
+            await ws.send_str(message)
+
+    async def drop_clients(self, refuse=False):
+        self.accepting = not refuse
+        for ws in list(self.clients):
+            await ws.close()
+
+    def accept_clients(self):
+        self.accepting = True
+
+    def tag(self, section, kind=None):
+        if kind == TRACK: return "Track"
+        return "Video" if SECTIONS[section][0] == "movie" else "Directory"
+
+    def node(self, section, item, kind=None):
+        attrs = " ".join(f"{k}={quoteattr(str(v))}" for k, v in item.items() if k != "tags")
+        if "tags" not in item:
+            return f"<{self.tag(section, kind)} {attrs} />"
+        children = "".join(f"<{tag} tag={quoteattr(value)} />" for tag, values in item["tags"].items() for value in values)
+        return f"<{self.tag(section, kind)} {attrs}>{children}</{self.tag(section, kind)}>"
+
+    async def delay(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def xml(self, body, **attrs):
+        head = " ".join(f'{k}="{v}"' for k, v in attrs.items())
+        resp = web.Response(text=f'<?xml version="1.0" encoding="UTF-8"?>\n<MediaContainer {head}>{body}</MediaContainer>',
+                            content_type="text/xml")
+        resp.enable_compression()
+        return resp
+
+    async def sections(self, request):
+        self.requests.append(str(request.rel_url))
+        await self.delay()
+        body = "".join(f'<Directory key="{k}" type="{t}" title="{n}" />' for k, (t, n) in SECTIONS.items())
+        return self.xml(body, size=len(SECTIONS))
+
+    async def section_all(self, request):
+        self.requests.append(str(request.rel_url))
+        await self.delay()
+        section = request.match_info["section"]
+        if section not in self.items:
+            raise web.HTTPNotFound()
+        kind = request.query.get("type")
+        items = self.tiers[kind] if section == "3" and kind in self.tiers else self.items[section]
+        query = unquote(request.query_string)
+        if "updatedAt>>=" in query:
+            since = int(query.split("updatedAt>>=")[1].split("&")[0])
+            items = [i for i in items if i["updatedAt"] > since]
+        if "lastViewedAt>>=" in query:
+            since = int(query.split("lastViewedAt>>=")[1].split("&")[0])
+            items = [i for i in items if i.get("lastViewedAt", 0) > since]
+        if request.query.get("unwatched") == "1":
+            items = [i for i in items if (i["viewedLeafCount"] < i["leafCount"] if "leafCount" in i else not i.get("viewCount"))]
+        start = int(request.query.get("X-Plex-Container-Start", 0))
+        size = request.query.get("X-Plex-Container-Size")
+        page = items[start:] if size is None else items[start:start + int(size)]
+        body = "".join(self.node(section, i, kind) for i in page)
+        return self.xml(body, size=len(page), totalSize=len(items), offset=start)
+
+    async def search(self, request):
+        # Every query word must start a word of the title, results grouped in one hub per type
+        self.requests.append(str(request.rel_url))
+        await self.delay()
+        words = request.query.get("query", "").lower().split()
+        limit = int(request.query.get("limit", 10))
+        hubs = {}
+        for section, items in self.items.items():
+            kind = SECTIONS[section][0]
+            for item in items:
+                title = item["title"].lower().split()
+                if not words or not all(any(t.startswith(w) for t in title) for w in words): continue
+                hit = dict(item, type=kind, librarySectionID=section, librarySectionTitle=SECTIONS[section][1])
+                results = hubs.setdefault(kind, [])
+                if len(results) < limit: results.append(self.node(section, hit))
+        body = "".join(f'<Hub type="{kind}" hubIdentifier="{kind}" size="{len(nodes)}">{"".join(nodes)}</Hub>'
+                       for kind, nodes in hubs.items())
+        return self.xml(body, size=len(hubs))
+
+    async def notifications(self, request):
+        self.requests.append(str(request.rel_url))
+        if not self.accepting:
+            raise web.HTTPServiceUnavailable()
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.clients.add(ws)
+        try:
+            async for _ in ws:
+                pass
+        finally:
+            self.clients.discard(ws)
+        return ws
+
+    def episodes(self, show):
+        # Seasons and episodes derived from the ratingKey, so every run gets the same show layout
+        rnd = random.Random(f"{self.seed}:{show['ratingKey']}")
+        watched = WATCHED.get(show["title"], 0)
+        out, n = [], 0
+        for season in range(1, rnd.randint(1, 6) + 1):
+            for episode in range(1, rnd.randint(6, 22) + 1):
+                n += 1
+                out.append({"ratingKey": f"{show['ratingKey']}{season:02d}{episode:03d}", "type": "episode",
+                            "parentIndex": season, "index": episode, "title": f"Episode {episode}",
+                            "viewCount": 1 if n <= watched else 0, "lastViewedAt": 1600000000 + n if n <= watched else 0})
+        return out
+
+    async def all_leaves(self, request):
+        self.requests.append(str(request.rel_url))
+        await self.delay()
+        key = request.match_info["key"]
+        show = next((i for section in ("2", "5") for i in self.items[section] if i["ratingKey"] == key), None)
+        if show is None:
+            raise web.HTTPNotFound()
+        body = "".join(f"<Video {' '.join(f'{k}={quoteattr(str(v))}' for k, v in e.items())} />" for e in self.episodes(show))
+        return self.xml(body, size=body.count("<Video"))
+
+    async def identity(self, request):
+        self.requests.append(str(request.rel_url))
+        await self.delay()
+        return self.xml("", machineIdentifier=MACHINE_ID)
+
+    async def create_queue(self, request):
+        self.requests.append(str(request.rel_url))
+        await self.delay()
+        uri = request.query.get("uri", "")
+        if not uri.startswith(f"server://{MACHINE_ID}/"):
+            raise web.HTTPBadRequest()
+        key = uri.rsplit("/", 1)[-1]
+        queue_id = str(len(self.queues) + 1)
+        self.queues[queue_id] = key
+        body = f'<Video playQueueItemID="1" ratingKey="{key}" key="/library/metadata/{key}" />'
+        return self.xml(body, playQueueID=queue_id, playQueueSelectedItemID="1", size=1)
+
+    async def play_media(self, request):
+        self.requests.append(str(request.rel_url))
+        await self.delay()
+        client = request.headers.get("X-Plex-Target-Client-Identifier")
+        queue = request.query.get("containerKey", "").split("?")[0].rsplit("/", 1)[-1]
+        if not client or queue not in self.queues:
+            raise web.HTTPBadRequest()
+        self.played.append((client, self.queues[queue]))
+        return web.Response(text="")
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/library/sections", self.sections)
+        app.router.add_get("/library/sections/{section}/all", self.section_all)
+        app.router.add_get("/library/metadata/{key}/allLeaves", self.all_leaves)
+        app.router.add_get("/hubs/search", self.search)
+        app.router.add_get("/:/websockets/notifications", self.notifications)
+        app.router.add_get("/identity", self.identity)
+        app.router.add_post("/playQueues", self.create_queue)
+        app.router.add_get("/player/playback/playMedia", self.play_media)
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.runner = web.AppRunner(self.app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        await self.drop_clients()
+        await self.runner.cleanup()
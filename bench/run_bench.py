@@ -0,0 +1,295 @@
+"""Offline end-to-end latency benchmark for plex_smart_launch.py.
+
+    python bench/run_bench.py --movies 8000 --shows 1000 --artists 3000 --repeat 3
+
+Starts the mock Plex server, loads the script with the fake pyscript runtime,
+replays the command corpus and prints p50/p95/p99 per stage in milliseconds.
+
+Scripted delays (AI answer, TV boot, Plex app load, play_media, Plex HTTP) are
+real sleeps multiplied by --scale, CPU work (parsing, matching) is measured as is.
+Only compare runs made with the same settings.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_pyscript import FakePyscript  # noqa: E402
+from mock_plex import MockPlex  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SCRIPT = os.path.join(ROOT, "Smart_Plex_Ai-Task _En", "plex_smart_launch.py")
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "commands.jsonl")
+STAGES = ["cache", "llm", "matching", "boot", "scan", "play_media", "total"]
+
+
+class Recorder:
+    """Per-command stage durations. Commands are replayed one at a time."""
+
+    def __init__(self):
+        self.current = None
+        self.samples = {stage: [] for stage in STAGES}
+
+    def begin(self):
+        self.current = dict.fromkeys(STAGES, 0.0)
+
+    def add(self, stage, seconds):
+        if self.current is not None:
+            self.current[stage] += seconds
+
+    def end(self):
+        # Boot time is measured around the whole hardware task, the client scan is reported on its own
+        self.current["boot"] = max(0.0, self.current["boot"] - self.current["scan"])
+        for stage, value in self.current.items():
+            self.samples[stage].append(value)
+        self.current = None
+
+
+def timed(recorder, stage, func):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            recorder.add(stage, time.perf_counter() - start)
+    return wrapper
+
+
+def timed_async(recorder, stage, func):
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            recorder.add(stage, time.perf_counter() - start)
+    return wrapper
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+class Devices:
+    """Scripted TVs: turn_on/select_source flip HA states after zone-specific delays."""
+
+    def __init__(self, runtime, zones, args, rnd):
+        self.runtime, self.zones, self.args, self.rnd = runtime, zones, args, rnd
+        self.scale = args.scale
+        self.answer = None
+        service = runtime.service
+        service.handlers[("media_player", "turn_on")] = self.turn_on
+        service.handlers[("remote", "turn_on")] = self.turn_on
+        service.handlers[("media_player", "turn_off")] = self.turn_off
+        service.handlers[("remote", "turn_off")] = self.turn_off
+        service.handlers[("media_player", "select_source")] = self.select_source
+        service.handlers[("media_player", "play_media")] = self.play_media
+        service.handlers[("button", "press")] = self.press
+        service.handlers[("ai_task", "generate_data")] = self.generate_data
+
+    def zone_for(self, kwargs):
+        for zone in self.zones.values():
+            if kwargs.get("device_id") and kwargs["device_id"] in (zone.get("hardware_device_id"), zone.get("plex_device_id")):
+                return zone
+            if kwargs.get("entity_id") and kwargs["entity_id"] in (zone.get("hardware_entity"), zone.get("remote_entity"), zone.get("plex_client")):
+                return zone
+        return None
+
+    def reset(self, powered):
+        state = self.runtime.state
+        for zone in self.zones.values():
+            state.set(zone["hardware_entity"], "on" if powered else "off", {"source": "Plex" if powered else "TV"})
+            state.set(zone["plex_client"], "idle" if powered else "unavailable")
+
+    def later(self, seconds, entity, value, **attrs):
+        async def flip():
+            await asyncio.sleep(seconds * self.scale)
+            self.runtime.state.set(entity, value, **attrs)
+        asyncio.ensure_future(flip())
+
+    async def turn_on(self, **kwargs):
+        zone = self.zone_for(kwargs)
+        if zone and self.runtime.state.get(zone["hardware_entity"]) in ("off", "unavailable", "standby"):
+            self.later(zone["boot_delay"] * self.rnd.uniform(0.4, 1.0), zone["hardware_entity"], "on")
+
+    async def turn_off(self, **kwargs):
+        zone = self.zone_for(kwargs)
+        if zone:
+            self.runtime.state.set(zone["hardware_entity"], "off", source="TV")
+            self.runtime.state.set(zone["plex_client"], "unavailable")
+
+    async def select_source(self, **kwargs):
+        zone = self.zone_for(kwargs)
+        if zone:
+            self.runtime.state.set(zone["hardware_entity"], "on", source="Plex")
+            if self.runtime.state.get(zone["plex_client"]) in ("unavailable", "unknown", "off", None):
+                self.later(zone["app_load_delay"] * self.rnd.uniform(0.4, 1.0), zone["plex_client"], "idle")
+
+    async def press(self, **kwargs):
+        await asyncio.sleep(0.05 * self.scale)
+
+    async def play_media(self, **kwargs):
+        await asyncio.sleep(self.args.play_latency * self.scale)
+
+    async def generate_data(self, **kwargs):
+        await asyncio.sleep(self.args.llm_latency * self.rnd.uniform(0.7, 1.3) * self.scale)
+        return {"data": json.dumps(self.answer)}
+
+
+def instrument(ns, recorder):
+    ns["ensure_plex_cache"] = timed_async(recorder, "cache", ns["ensure_plex_cache"])
+    ns["best_match"] = timed(recorder, "matching", ns["best_match"])
+    ns["boot_hardware_process"] = timed_async(recorder, "boot", ns["boot_hardware_process"])
+    ns["wait_for_plex_client"] = timed_async(recorder, "scan", ns["wait_for_plex_client"])
+    ns["direct_play"] = timed_async(recorder, "play_media", ns["direct_play"])
+
+
+async def wait_until(check, timeout=30.0):
+    start = time.perf_counter()
+    while not check():
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError("condition not met")
+        await asyncio.sleep(0.005)
+    return time.perf_counter() - start
+
+
+async def live_updates(ns, plex):
+    """Notification stream: time until an added title is found and a removed one is gone, and the skipped poll."""
+    listener = asyncio.ensure_future(ns["plex_notifications"]())
+    await wait_until(lambda: ns["NOTIFY_STATE"]["connected"])
+    await wait_until(lambda: ns["NOTIFY_APPLY"] is not None and ns["NOTIFY_APPLY"].done())
+    found = lambda: ns["match_in_cache"]("movie", "tenet")[1] > 0.95  # noqa: E731
+    await plex.add_title("1", "Tenet")
+    added = await wait_until(found)
+    await plex.remove_title("1", "Tenet")
+    removed = await wait_until(lambda: not found())
+    await wait_until(lambda: ns["NOTIFY_APPLY"].done())
+    before = len(plex.requests)
+    await ns["cron_cache"]()
+    polled = len(plex.requests) - before
+    # Stream down: the next hourly run polls again
+    await plex.drop_clients(refuse=True)
+    await wait_until(lambda: not ns["NOTIFY_STATE"]["connected"])
+    before = len(plex.requests)
+    await ns["cron_cache"]()
+    fallback = len(plex.requests) - before
+    plex.accept_clients()
+    await wait_until(lambda: ns["NOTIFY_STATE"]["connected"])
+    listener.cancel()
+    return (f"live updates: added title found after {added * 1000:.0f} ms, removed title gone after {removed * 1000:.0f} ms, "
+            f"hourly poll {polled} Plex requests while connected, {fallback} after the stream dropped")
+
+
+def wrap_service(runtime, recorder, domain, name, stage):
+    handler = runtime.service.handlers[(domain, name)]
+    runtime.service.handlers[(domain, name)] = timed_async(recorder, stage, handler)
+
+
+async def run(args):
+    with open(args.corpus, encoding="utf-8") as f:
+        corpus = [json.loads(line) for line in f if line.strip()]
+    plex = MockPlex(args.movies, args.shows, args.artists, latency=args.plex_latency * args.scale)
+    url = await plex.start()
+    tmp = tempfile.mkdtemp(prefix="smartplex_bench_")
+    runtime = FakePyscript(scale=args.scale, verbose=args.verbose)
+    ns = runtime.load(args.script)
+    ns.update({"PLEX_URL": url, "SNAPSHOT_PATH": os.path.join(tmp, "cache.pickle"),
+               "TIMINGS_PATH": os.path.join(tmp, "timings.pickle"), "INTENT_PATH": os.path.join(tmp, "intents.pickle")})
+    if args.no_intent_cache:
+        ns["INTENT_CACHE_SIZE"] = 0
+    if args.direct_play:
+        for room, zone in ns["ZONES"].items():
+            zone["plex_client_id"] = f"client-{room}"
+
+    recorder = Recorder()
+    rnd = random.Random(args.seed)
+    devices = Devices(runtime, ns["ZONES"], args, rnd)
+    wrap_service(runtime, recorder, "ai_task", "generate_data", "llm")
+    wrap_service(runtime, recorder, "media_player", "play_media", "play_media")
+    instrument(ns, recorder)
+
+    lines = [f"script: {args.script}",
+             f"library: {args.movies} movies, {args.shows} shows, {args.artists} artists; "
+             f"scale {args.scale}, AI {args.llm_latency}s, devices {'on' if args.devices_on else 'off'}"]
+
+    start = time.perf_counter()
+    await ns["update_plex_cache"]()
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    await ns["update_plex_cache"]()
+    delta = time.perf_counter() - start
+    items = sum(ns["cache_count"](l_type) for l_type in ns["PLEX_CACHE"])
+    lines.append(f"cache: cold build {cold * 1000:.0f} ms, delta refresh {delta * 1000:.0f} ms, {items} items, "
+                 f"{len(plex.requests)} Plex requests")
+    # Titles the cache has not seen yet, only the server's search knows them
+    plex.add_late()
+
+    for _ in range(args.repeat):
+        for entry in corpus:
+            devices.reset(args.devices_on)
+            devices.answer = entry["ai"]
+            recorder.begin()
+            start = time.perf_counter()
+            await ns["smartplex_execution"](entry["cmd"])
+            recorder.add("total", time.perf_counter() - start)
+            recorder.end()
+
+    lines.append(f"{len(corpus) * args.repeat} commands, milliseconds:")
+    lines.append(f"{'stage':<12}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for stage in STAGES:
+        values = recorder.samples[stage]
+        row = [percentile(values, p) * 1000 for p in (50, 95, 99)] + [max(values) * 1000]
+        lines.append(f"{stage:<12}" + "".join(f"{v:>10.1f}" for v in row))
+    ai_calls = sum(1 for d, n, _ in runtime.service.calls if (d, n) == ("ai_task", "generate_data"))
+    play_calls = sum(1 for d, n, _ in runtime.service.calls if (d, n) == ("media_player", "play_media"))
+    searches = sum(1 for r in plex.requests if r.startswith("/hubs/search"))
+    learned = sum(ns["cache_count"](l_type) for l_type in ns["PLEX_CACHE"]) - items
+    lines.append(f"AI calls: {ai_calls}, play_media calls: {play_calls}, direct plays: {len(plex.played)}, "
+                 f"server searches: {searches}, titles added from search: {learned}, "
+                 f"errors logged: {sum(1 for lvl, _ in runtime.log.lines if lvl == 'error')}")
+
+    lines.append(await live_updates(ns, plex))
+
+    if "close_plex_session" in ns:
+        await ns["close_plex_session"]()
+    await plex.stop()
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--script", default=DEFAULT_SCRIPT)
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS)
+    parser.add_argument("--movies", type=int, default=8000)
+    parser.add_argument("--shows", type=int, default=1000)
+    parser.add_argument("--artists", type=int, default=3000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--scale", type=float, default=0.05, help="multiplier for every scripted delay and script sleep")
+    parser.add_argument("--llm-latency", type=float, default=2.0, help="AI answer time, seconds before scaling")
+    parser.add_argument("--play-latency", type=float, default=0.5, help="play_media time, seconds before scaling")
+    parser.add_argument("--plex-latency", type=float, default=0.05, help="Plex HTTP latency, seconds before scaling")
+    parser.add_argument("--devices-on", action="store_true", help="TVs already on with Plex open")
+    parser.add_argument("--no-intent-cache", action="store_true", help="ask the AI every time, even for repeated commands")
+    parser.add_argument("--direct-play", action="store_true", help="give every zone a plex_client_id, found items skip play_media")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the report to this file")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()